@@ -0,0 +1,142 @@
+"""A benchmark of the forest inference engine against scikit-learn.
+
+Compares the voxels per second of :class:`FlatForest <mialab.utilities.forest_inference.FlatForest>` with
+``predict`` and ``predict_proba`` of scikit-learn, and checks that the labels are identical, e.g.::
+
+    python benchmark_inference.py --model ./mia-result/<run>/model.joblib --features features.npy
+
+Without model, a forest is trained on synthetic features with the layout of the pipeline.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import sklearn.ensemble as sk_ensemble
+
+try:
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.forest_inference as finf
+except ImportError:
+    # Append the MIALab root directory to Python path
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.forest_inference as finf
+
+
+def make_synthetic(no_voxels: int, no_features: int = 7, no_classes: int = 6, seed: int = 42):
+    """Generates synthetic features and labels with the given number of features and classes."""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(no_voxels, no_features)).astype(np.float32)
+    scores = data @ rng.normal(size=(no_features, no_classes)) + 0.5 * rng.normal(size=(no_voxels, no_classes))
+    return data, scores.argmax(axis=1).astype(np.int16)
+
+
+def measure(fn: callable, no_voxels: int, repeat: int) -> float:
+    """Measures the best voxels per second of ``repeat`` calls."""
+    return no_voxels / min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main(model_file: str, features_file: str, no_voxels: int, n_estimators: int, max_depth: int,
+         threads: int, slab_size: int, repeat: int):
+    """Benchmarks the inference of a forest."""
+    if model_file:
+        classifier = clf.Classifier.load(model_file, mmap_mode=None)[0]
+        if not isinstance(classifier, clf.Forest):
+            raise ValueError('{} is not a forest but a {} model'.format(model_file, classifier.NAME))
+        forest = classifier.model
+    else:
+        print('Training a forest on synthetic features...')
+        forest = sk_ensemble.RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth,
+                                                    max_features='sqrt', random_state=42, n_jobs=threads)
+        forest.fit(*make_synthetic(min(no_voxels, 200000), seed=0))
+    forest.set_params(n_jobs=threads)
+
+    if features_file:
+        data = np.load(features_file, mmap_mode='r')[:no_voxels]
+    else:
+        data = make_synthetic(no_voxels, forest.n_features_in_, len(forest.classes_))[0]
+    no_voxels = data.shape[0]
+    print('{} voxels, {} trees, {} nodes, {} threads\n'.format(
+        no_voxels, len(forest.estimators_), sum(tree.tree_.node_count for tree in forest.estimators_), threads))
+
+    def predict_sklearn():
+        return forest.predict(data), forest.predict_proba(data)
+
+    reference = forest.predict(data)
+    sklearn_speed = measure(predict_sklearn, no_voxels, repeat)
+    print('{:<20}{:>14.0f} voxels/s'.format('sklearn', sklearn_speed))
+
+    for traversal in finf.FlatForest.TRAVERSALS:
+        engine = finf.FlatForest(forest, traversal)
+        labels = engine.predict(data, threads, slab_size)[0]
+        speed = measure(lambda: engine.predict(data, threads, slab_size), no_voxels, repeat)
+        print('{:<20}{:>14.0f} voxels/s ({:.2f}x), identical labels: {}'.format(
+            'FlatForest/' + traversal, speed, speed / sklearn_speed, bool(np.array_equal(labels, reference))))
+
+
+if __name__ == "__main__":
+    """The program's entry point."""
+
+    parser = argparse.ArgumentParser(description='Benchmark of the forest inference engine against scikit-learn')
+
+    parser.add_argument(
+        '--model',
+        type=str,
+        default=None,
+        help='Model file (model.joblib of a pipeline run). If not set, a forest is trained on synthetic features.'
+    )
+
+    parser.add_argument(
+        '--features',
+        type=str,
+        default=None,
+        help='A .npy file with a feature matrix to predict. If not set, synthetic features are predicted.'
+    )
+
+    parser.add_argument(
+        '--voxels',
+        type=int,
+        default=1000000,
+        help='Number of voxels to predict.'
+    )
+
+    parser.add_argument(
+        '--n_estimators',
+        type=int,
+        default=10,
+        help='Number of trees of the synthetic forest.'
+    )
+
+    parser.add_argument(
+        '--max_depth',
+        type=int,
+        default=10,
+        help='Maximum depth of the trees of the synthetic forest.'
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of threads (default: number of CPUs).'
+    )
+
+    parser.add_argument(
+        '--slab_size',
+        type=int,
+        default=2 ** 16,
+        help='Number of voxels per slab of the inference engine.'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of repetitions (the fastest is reported).'
+    )
+
+    args = parser.parse_args()
+    main(args.model, args.features, args.voxels, args.n_estimators, args.max_depth, args.threads, args.slab_size,
+         args.repeat)
@@ -0,0 +1,213 @@
+"""A subject-level k-fold cross-validation of the pipeline.
+
+The subjects of the training and testing directories are pooled and split into k folds. Each subject is pre-processed
+once into a shared feature store, which contains the training sample and the brain mask voxels of the subject
+(see the ``training_sample`` parameter of :class:`FeatureExtractor
+<mialab.utilities.pipeline_utilities.FeatureExtractor>`). The k fold models are then trained and evaluated in parallel
+worker processes, and the results of all folds are merged into one report.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+import sklearn.model_selection as sk_model_selection
+
+import pipeline
+
+try:
+    import mialab.data.structure as structure
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.experiment as exp
+    import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.multi_processor as mproc
+    import mialab.utilities.pipeline_utilities as putil
+except ImportError:
+    # Append the MIALab root directory to Python path
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+    import mialab.data.structure as structure
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.experiment as exp
+    import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.multi_processor as mproc
+    import mialab.utilities.pipeline_utilities as putil
+
+
+def get_subsets(img: structure.BrainImage, pre_process_params: dict) -> dict:
+    """Gets the rows of the training sample (``train``) and of the voxels to predict (``test``) of a feature matrix
+    extracted with the ``training_sample`` parameter."""
+    training_indices = putil.FeatureExtractor.get_training_indices(img, pre_process_params.get('sampling_seed'))
+    mask = sitk.GetArrayViewFromImage(img.images[structure.BrainImageTypes.BrainMask]).ravel()
+    return {'train': np.searchsorted(img.feature_indices, training_indices),
+            'test': np.flatnonzero(mask[img.feature_indices])}
+
+
+def main(result_dir: str, data_atlas_dir: str, data_dirs: list, folds: int = 5, seed: int = 42,
+         classifier: str = 'random_forest', classifier_config: dict = None, processes: int = None,
+         threads: int = None):
+    """Subject-level k-fold cross-validation.
+
+    The subjects are pre-processed once with the parameters of the pipeline, with the brain mask inference enabled.
+    The ``folds`` fold models are fitted and evaluated by ``processes`` worker processes with ``threads`` threads each.
+    Each fold writes its results to its directory, and the merged ``results.csv`` and ``results_summary.csv``
+    contain every subject once.
+    """
+    classifier_config = dict(classifier_config or {})
+    classifier_config.pop('n_jobs', None)  # the threads of the worker processes
+    classifier_params = clf.CLASSIFIERS[classifier].get_params(classifier_config)
+
+    # load atlas images
+    putil.load_atlas_images(data_atlas_dir)
+
+    pool = mproc.WorkerPool(processes, threads=threads, initializer=putil.load_atlas_images,
+                            initargs=(data_atlas_dir,))
+
+    cv_dir = os.path.join(result_dir, datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'))
+    os.makedirs(cv_dir, exist_ok=True)
+
+    data = {}
+    for data_dir in data_dirs:
+        crawler = futil.FileSystemDataCrawler(data_dir, pipeline.LOADING_KEYS, futil.BrainImageFilePathGenerator(),
+                                              futil.DataDirectoryFilter())
+        duplicates = sorted(set(data) & set(crawler.data))
+        if duplicates:
+            raise ValueError('The subjects {} of {} are also in another data directory'.format(duplicates, data_dir))
+        data.update(crawler.data)
+    if len(data) < folds:
+        raise ValueError('{} subjects cannot be split into {} folds'.format(len(data), folds))
+
+    # pre-process each subject once for the training and testing, which requires the brain mask inference
+    # (the feature matrix cache is not used since it does not contain the brain masks)
+    pre_process_params = dict(pipeline.PRE_PROCESS_PARAMS, training=False, training_sample=True,
+                              brain_mask_inference=True)
+    image_types = [structure.BrainImageTypes.GroundTruth, structure.BrainImageTypes.BrainMask]
+    if pipeline.POST_PROCESS_PARAMS.get('crf_post', False):
+        image_types += [structure.BrainImageTypes.T1w, structure.BrainImageTypes.T2w]
+    subjects = exp.SubjectStore(os.path.join(cv_dir, 'features'))
+    exp.pre_process_subjects(data, subjects, pre_process_params, pool, image_types=image_types,
+                             subsets=lambda img: get_subsets(img, pre_process_params))
+    print('-' * 5, 'Pre-processed {} subjects'.format(len(subjects)))
+
+    # split the subjects and evaluate the folds in parallel
+    ids = np.array(sorted(subjects.ids))
+    k_fold = sk_model_selection.KFold(folds, shuffle=True, random_state=seed)
+    params_list = []
+    with open(os.path.join(cv_dir, 'folds.json'), 'w') as f:
+        json.dump({'classifier': classifier, 'classifier_params': classifier_params,
+                   'folds': [ids[test_idx].tolist() for _, test_idx in k_fold.split(ids)]}, f, indent=2)
+    for fold, (train_idx, test_idx) in enumerate(k_fold.split(ids)):
+        params_list.append((os.path.join(cv_dir, 'fold-{}'.format(fold)), classifier, classifier_params,
+                            pool.threads, subjects.store_dir, subjects.store_dir, pipeline.POST_PROCESS_PARAMS,
+                            ids[train_idx].tolist(), ids[test_idx].tolist(), 'train', 'test'))
+
+    results = []
+    rows = [None] * folds
+    for fold, evaluation in mproc.MultiProcessor.run_iter(exp.fit_and_evaluate, params_list, ordered=False,
+                                                          pool=pool):
+        results.extend(evaluation['results'])
+        dice = [result.value for result in evaluation['results']
+                if result.metric == 'DICE' and not result.id_.endswith('-PP')]
+        rows[fold] = {'fold': fold,
+                      'subjects': ' '.join(params_list[fold][8]),
+                      'MEAN_DICE': np.mean(dice),
+                      'FIT_TIME': evaluation['fit_time'],
+                      'NO_SAMPLES': evaluation['no_samples']}
+        print('-' * 5, 'Evaluated fold {fold}: mean Dice {MEAN_DICE:.3f}, fit {FIT_TIME:.1f} s'.format(**rows[fold]))
+    pool.close()
+
+    with open(os.path.join(cv_dir, 'folds.csv'), 'w', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=list(rows[0]), delimiter=';')
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+    # every subject is tested in exactly one fold
+    results.sort(key=lambda result: result.id_)
+    exp.write_results(results, cv_dir, console=True)
+
+
+if __name__ == "__main__":
+    """The program's entry point."""
+
+    script_dir = os.path.dirname(sys.argv[0])
+
+    parser = argparse.ArgumentParser(description='Subject-level k-fold cross-validation for brain tissue segmentation')
+
+    parser.add_argument(
+        '--result_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, './mia-cross-validation')),
+        help='Directory for results.'
+    )
+
+    parser.add_argument(
+        '--data_atlas_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, '../data/atlas')),
+        help='Directory with atlas data.'
+    )
+
+    parser.add_argument(
+        '--data_dirs',
+        type=str,
+        nargs='+',
+        default=[os.path.normpath(os.path.join(script_dir, '../data/train/')),
+                 os.path.normpath(os.path.join(script_dir, '../data/test/'))],
+        help='Directories with the data of the subjects (default: the training and testing data).'
+    )
+
+    parser.add_argument(
+        '--folds',
+        type=int,
+        default=5,
+        help='Number of folds.'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=42,
+        help='Seed of the random split of the subjects into folds.'
+    )
+
+    parser.add_argument(
+        '--classifier',
+        type=str,
+        default='random_forest',
+        choices=sorted(clf.CLASSIFIERS),
+        help='Classifier backend.'
+    )
+
+    parser.add_argument(
+        '--classifier_config',
+        type=str,
+        default=None,
+        help='JSON file with parameters of the classifier.'
+    )
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of worker processes, i.e. folds evaluated at the same time (default: number of CPUs).'
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='Number of threads per worker process (default: number of CPUs / processes).'
+    )
+
+    args = parser.parse_args()
+
+    classifier_config = {}
+    if args.classifier_config:
+        with open(args.classifier_config) as f:
+            classifier_config = json.load(f)
+
+    main(args.result_dir, args.data_atlas_dir, args.data_dirs, args.folds, args.seed, args.classifier,
+         classifier_config, args.processes, args.threads)
@@ -17,7 +17,8 @@ class BrainImageTypes(enum.Enum):
 class BrainImage:
     """Represents a brain image."""
 
-    def __init__(self, id_: str, path: str, images: dict, transformation: sitk.Transform):
+    def __init__(self, id_: str, path: str, images: dict, transformation: sitk.Transform,
+                 image_properties: conversion.ImageProperties = None):
         """Initializes a new instance of the BrainImage class.
 
         Args:
@@ -25,6 +26,9 @@ class BrainImage:
             path (str): Full path to the image directory.
             images (dict): The images, where the key is a :py:class:`BrainImageTypes` and the value is a
              SimpleITK image.
+            transformation (sitk.Transform): The registration transformation.
+            image_properties (conversion.ImageProperties): The image properties. Only required if no images are
+             provided, e.g. if only the feature matrix is available.
         """
 
         self.id_ = id_
@@ -33,11 +37,16 @@ class BrainImage:
         self.transformation = transformation
 
         # ensure we have an image to get the image properties
-        if len(images) == 0:
-            raise ValueError('No images provided')
-
-        self.image_properties = conversion.ImageProperties(self.images[list(self.images.keys())[0]])
+        if image_properties is None:
+            if len(images) == 0:
+                raise ValueError('No images provided')
+            image_properties = conversion.ImageProperties(self.images[list(self.images.keys())[0]])
+
+        self.image_properties = image_properties
+        self.full_image_properties = None  # the image properties before cropping to a region of interest (ROI)
+        self.roi_index = None  # the index of the ROI in the full image in (x, y, z) order, None if not cropped
         self.feature_images = {}
         self.feature_matrix = None  # a tuple (features, labels),
         # where the shape of features is (n, number_of_features) and the shape of labels is (n, 1)
-        # with n being the amount of voxels
\ No newline at end of file
+        # with n being the amount of voxels
+        self.feature_indices = None  # the flat voxel indices of the feature matrix rows, None if all voxels
\ No newline at end of file
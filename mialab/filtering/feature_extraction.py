@@ -1,17 +1,37 @@
 """The feature extraction module contains classes for feature extraction."""
+import collections
+from concurrent import futures
+import os
 import sys
+import threading
 
 import numpy as np
+import pymia.data.conversion as conversion
 import pymia.filtering.filter as fltr
+import scipy.ndimage as ndimage
 import SimpleITK as sitk
 
 
 class AtlasCoordinates(fltr.Filter):
-    """Represents an atlas coordinates feature extractor."""
+    """Represents an atlas coordinates feature extractor.
 
-    def __init__(self):
-        """Initializes a new instance of the AtlasCoordinates class."""
+    The coordinate images only depend on the image geometry (size, origin, spacing and direction). They are therefore
+    cached per geometry and shared among all images on the same grid, e.g. all images registered to the atlas.
+    """
+
+    CACHE_SIZE = 4  #: The maximum number of cached coordinate images.
+
+    _cache = collections.OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, use_cache: bool = True):
+        """Initializes a new instance of the AtlasCoordinates class.
+
+        Args:
+            use_cache (bool): Whether to reuse the coordinate image of previously processed images on the same grid.
+        """
         super().__init__()
+        self.use_cache = use_cache
 
     def execute(self, image: sitk.Image, params: fltr.FilterParams = None) -> sitk.Image:
         """Executes a atlas coordinates feature extractor on an image.
@@ -31,27 +51,63 @@ class AtlasCoordinates(fltr.Filter):
         if image.GetDimension() != 3:
             raise ValueError('image needs to be 3-D')
 
-        x, y, z = image.GetSize()
+        if not self.use_cache:
+            return self._get_coordinates_image(image)
+
+        key = AtlasCoordinates._get_cache_key(conversion.ImageProperties(image))
+        with AtlasCoordinates._cache_lock:
+            img_out = AtlasCoordinates._cache.get(key)
+            if img_out is not None:
+                AtlasCoordinates._cache.move_to_end(key)
+
+        if img_out is None:
+            img_out = self._get_coordinates_image(image)
+            with AtlasCoordinates._cache_lock:
+                AtlasCoordinates._cache[key] = img_out
+                while len(AtlasCoordinates._cache) > AtlasCoordinates.CACHE_SIZE:
+                    AtlasCoordinates._cache.popitem(last=False)
 
-        # create matrix with homogenous indices in axis 3
-        coords = np.zeros((x, y, z, 4))
-        coords[..., 0] = np.arange(x)[:, np.newaxis, np.newaxis]
-        coords[..., 1] = np.arange(y)[np.newaxis, :, np.newaxis]
-        coords[..., 2] = np.arange(z)[np.newaxis, np.newaxis, :]
-        coords[..., 3] = 1
+        # SimpleITK copies the image buffer only on write, i.e. the cached image is shared read-only
+        return sitk.Image(img_out)
 
-        # reshape such that each voxel is one row
-        lin_coords = np.reshape(coords, [coords.shape[0] * coords.shape[1] * coords.shape[2], 4])
+    @staticmethod
+    def clear_cache():
+        """Clears the cached coordinate images."""
+        with AtlasCoordinates._cache_lock:
+            AtlasCoordinates._cache.clear()
 
-        # generate transformation matrix
-        tmp_mat = image.GetDirection() + image.GetOrigin()
-        tfm = np.reshape(tmp_mat, [3, 4], order='F')
-        tfm = np.vstack((tfm, [0, 0, 0, 1]))
+    @staticmethod
+    def _get_cache_key(image_properties: conversion.ImageProperties) -> tuple:
+        """Gets the cache key of an image geometry.
 
-        atlas_coords = (tfm @ np.transpose(lin_coords))[0:3, :]
-        atlas_coords = np.reshape(np.transpose(atlas_coords), [z, y, x, 3], 'F')
+        Args:
+            image_properties (conversion.ImageProperties): The image properties.
+
+        Returns:
+            tuple: The size, origin, spacing and direction.
+        """
+        return image_properties.size, image_properties.origin, image_properties.spacing, image_properties.direction
+
+    @staticmethod
+    def _get_coordinates_image(image: sitk.Image) -> sitk.Image:
+        """Computes the atlas coordinates image.
+
+        Args:
+            image (sitk.Image): The image.
+
+        Returns:
+            sitk.Image: The atlas coordinates image.
+        """
+        x, y, z = image.GetSize()
+        direction = np.reshape(image.GetDirection(), (3, 3), order='F')
 
-        img_out = sitk.GetImageFromArray(atlas_coords)
+        # the coordinates are direction @ (x, y, z) + origin, which is the sum of one term per axis
+        coords = np.empty((z, y, x, 3), dtype=np.float32)
+        coords[...] = (np.arange(z)[:, np.newaxis] * direction[:, 2] + image.GetOrigin())[:, np.newaxis, np.newaxis]
+        coords += (np.arange(y)[:, np.newaxis] * direction[:, 1])[np.newaxis, :, np.newaxis].astype(np.float32)
+        coords += (np.arange(x)[:, np.newaxis] * direction[:, 0])[np.newaxis, np.newaxis].astype(np.float32)
+
+        img_out = sitk.GetImageFromArray(coords, isVector=True)
         img_out.CopyInformation(image)
 
         return img_out
@@ -121,15 +177,129 @@ def first_order_texture_features_function(values):
                      ])
 
 
+def first_order_texture_features_volume(image: np.ndarray, kernel=(3, 3, 3)) -> np.ndarray:
+    """Calculates first-order texture features for every neighborhood of an image at once.
+
+    This is the vectorized equivalent of calling :py:func:`first_order_texture_features_function` on each
+    neighborhood. The moments (mean, variance, skewness, kurtosis, entropy and energy) are derived from box-filtered
+    raw moments and the order statistics (min, max and percentiles) from rank filters.
+
+    Args:
+        image (np.ndarray): The image array with shape (z, y, x).
+        kernel (tuple of int): The neighborhood size in (x, y, z) order. The neighborhood of a voxel starts at the
+            voxel and extends in positive direction, the image is padded symmetrically at its upper border.
+
+    Returns:
+        np.ndarray: An array of shape (z, y, x, 16) containing the first-order texture features of each voxel
+        in the order of :py:func:`first_order_texture_features_function`.
+    """
+    eps = sys.float_info.epsilon  # to avoid division by zero
+
+    size = (kernel[2], kernel[1], kernel[0])
+    origin = [-(s // 2) for s in size]  # shift the window such that it starts at the voxel
+    num_values = int(np.prod(size))
+
+    z, y, x = image.shape
+    pad = [(0, s - 1) for s in size]
+    values = np.pad(image.astype(np.float64), pad, 'symmetric')
+
+    def box_mean(arr):
+        return ndimage.uniform_filter(arr, size, origin=origin)[:z, :y, :x]
+
+    def rank(r):
+        return ndimage.rank_filter(values, r, size, origin=origin)[:z, :y, :x]
+
+    min_ = rank(0)
+    max_ = rank(num_values - 1)
+    is_constant = min_ == max_  # central moments are exactly zero, avoid cancellation errors
+
+    mean = box_mean(values)
+    sum_ = mean * num_values
+
+    # central moments from raw moments of the globally centered values to limit cancellation
+    centered = values - values.mean()
+    m1 = box_mean(centered)
+    m2 = box_mean(centered ** 2)
+    m3 = box_mean(centered ** 3)
+    m4 = box_mean(centered ** 4)
+    variance = np.maximum(m2 - m1 ** 2, 0)
+    central3 = m3 - 3 * m1 * m2 + 2 * m1 ** 3
+    central4 = m4 - 4 * m1 * m3 + 6 * m1 ** 2 * m2 - 3 * m1 ** 4
+    variance[is_constant] = 0
+    central3[is_constant] = 0
+    central4[is_constant] = 0
+    std = np.sqrt(variance)
+
+    # the per-voxel function normalizes skewness and kurtosis by len(values), i.e. the neighborhood size along z
+    n = size[0]
+    skewness = np.sqrt(n * (n - 1)) / (n - 2) * num_values * central3 / (n * std ** 3 + eps)
+    kurtosis = num_values * central4 / (n * std ** 4 + eps)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = np.where(std != 0, mean / std, 0)
+
+        # with p = values / s, the sum of p * log2(p) is sum(values * log2|values|) / s - log2|s| * sum(values) / s,
+        # which is only defined if all p are positive (i.e., all values have the sign of s)
+        s = sum_ + eps
+        log_values = np.zeros_like(values)
+        np.log2(np.abs(values), out=log_values, where=values != 0)
+        entropy = -(box_mean(values * log_values) * num_values / s - np.log2(np.abs(s)) * sum_ / s)
+        entropy[~(((s > 0) & (min_ > 0)) | ((s < 0) & (max_ < 0)))] = np.nan
+        energy = box_mean(values ** 2) * num_values / s ** 2
+
+    features = [mean, variance, std, skewness, kurtosis, entropy, energy, snr, min_, max_, max_ - min_]
+
+    # percentiles with linear interpolation between the closest ranks (as numpy.percentile)
+    for percentile in (10, 25, 50, 75, 90):
+        position = percentile / 100 * (num_values - 1)
+        lower = int(np.floor(position))
+        fraction = position - lower
+        value = rank(lower)
+        if fraction > 0:
+            value = value + (rank(lower + 1) - value) * fraction
+        features.append(value)
+
+    return np.stack(features, axis=-1).astype(np.float32)
+
+
+# per-voxel neighborhood functions, which have an equivalent implementation working on the entire image
+VECTORIZED_NEIGHBORHOOD_FUNCTIONS = {first_order_texture_features_function: first_order_texture_features_volume}
+
+
 class NeighborhoodFeatureExtractor(fltr.Filter):
-    """Represents a feature extractor filter, which works on a neighborhood."""
+    """Represents a feature extractor filter, which works on a neighborhood.
+
+    The image can be processed in tiles, i.e. slabs of consecutive z-slices, which are processed in parallel on a
+    thread pool and written into a preallocated output. Each slab is extended by a halo of ``kernel[2] - 1`` slices
+    such that the tiled result is identical to processing the image at once.
+    """
+
+    BYTES_PER_VOXEL = 448  #: Estimated peak memory in bytes per voxel used to process a slab.
+
+    def __init__(self, kernel=(3, 3, 3), function_=first_order_texture_features_function, vectorize: bool = True,
+                 number_of_threads: int = 1, slab_size: int = None, max_memory: int = None):
+        """Initializes a new instance of the NeighborhoodFeatureExtractor class.
 
-    def __init__(self, kernel=(3, 3, 3), function_=first_order_texture_features_function):
-        """Initializes a new instance of the NeighborhoodFeatureExtractor class."""
+        Args:
+            kernel (tuple of int): The neighborhood size in (x, y, z) order.
+            function_ (callable): The function to calculate the features of a neighborhood.
+            vectorize (bool): Whether to use the vectorized implementation of ``function_`` if one is registered in
+                :py:data:`VECTORIZED_NEIGHBORHOOD_FUNCTIONS`. Otherwise, ``function_`` is called for each voxel.
+            number_of_threads (int): The number of threads processing slabs in parallel.
+                Use None for the number of CPUs.
+            slab_size (int): The number of z-slices per slab. If None, the slab size is derived from ``max_memory``
+                or, if ``max_memory`` is None, the image is split evenly among the threads.
+            max_memory (int): The peak memory budget in bytes for the temporaries of all concurrently processed slabs
+                (the output image is not included).
+        """
         super().__init__()
         self.neighborhood_radius = 3
         self.kernel = kernel
         self.function = function_
+        self.vectorize = vectorize
+        self.number_of_threads = number_of_threads if number_of_threads is not None else os.cpu_count()
+        self.slab_size = slab_size
+        self.max_memory = max_memory
 
     def execute(self, image: sitk.Image, params: fltr.FilterParams = None) -> sitk.Image:
         """Executes a neighborhood feature extractor on an image.
@@ -139,7 +309,7 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
             params (fltr.FilterParams): The parameters (unused).
 
         Returns:
-            sitk.Image: The normalized image.
+            sitk.Image: The feature image.
 
         Raises:
             ValueError: If image is not 3-D.
@@ -151,7 +321,7 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
         # test the function and get the output dimension for later reshaping
         function_output = self.function(np.array([1, 2, 3]))
         if np.isscalar(function_output):
-            img_out = sitk.Image(image.GetSize(), sitk.sitkFloat32)
+            number_of_components = 1
         elif not isinstance(function_output, np.ndarray):
             raise ValueError('function must return a scalar or a 1-D np.ndarray')
         elif function_output.ndim > 1:
@@ -159,18 +329,88 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
         elif function_output.shape[0] <= 1:
             raise ValueError('function must return a scalar or a 1-D np.ndarray with at least two elements')
         else:
-            img_out = sitk.Image(image.GetSize(), sitk.sitkVectorFloat32, function_output.shape[0])
+            number_of_components = function_output.shape[0]
 
-        img_out_arr = sitk.GetArrayFromImage(img_out)
         img_arr = sitk.GetArrayFromImage(image)
         z, y, x = img_arr.shape
 
+        shape = (z, y, x) if number_of_components == 1 else (z, y, x, number_of_components)
+        img_out_arr = np.empty(shape, dtype=np.float32)
+
+        slab_size = self._get_slab_size(img_arr.shape)
+        slabs = [(z_start, min(z_start + slab_size, z)) for z_start in range(0, z, slab_size)]
+
+        if self.number_of_threads > 1 and len(slabs) > 1:
+            with futures.ThreadPoolExecutor(self.number_of_threads) as executor:
+                # consume the results to propagate exceptions
+                list(executor.map(lambda slab: self._execute_slab(img_arr, img_out_arr, *slab), slabs))
+        else:
+            for slab in slabs:
+                self._execute_slab(img_arr, img_out_arr, *slab)
+
+        img_out = sitk.GetImageFromArray(img_out_arr, isVector=number_of_components > 1)
+        img_out.CopyInformation(image)
+
+        return img_out
+
+    def _get_slab_size(self, shape: tuple) -> int:
+        """Gets the number of z-slices per slab.
+
+        Args:
+            shape (tuple): The image array shape (z, y, x).
+
+        Returns:
+            int: The number of z-slices per slab.
+        """
+        z, y, x = shape
+        if self.slab_size is not None:
+            return max(1, self.slab_size)
+        if self.max_memory is not None:
+            # the halo is processed by each slab as well
+            slab_voxels = self.max_memory // (self.number_of_threads * self.BYTES_PER_VOXEL)
+            return max(1, slab_voxels // (y * x) - (self.kernel[2] - 1))
+        return max(1, -(-z // self.number_of_threads))
+
+    def _execute_slab(self, img_arr: np.ndarray, img_out_arr: np.ndarray, z_start: int, z_stop: int):
+        """Executes the feature extraction on the z-slices [z_start, z_stop) and writes it into the output.
+
+        Args:
+            img_arr (np.ndarray): The entire image array.
+            img_out_arr (np.ndarray): The preallocated output array of the entire image.
+            z_start (int): The first z-slice of the slab.
+            z_stop (int): The z-slice after the last z-slice of the slab.
+        """
+        z = img_arr.shape[0]
+        halo = self.kernel[2] - 1
+
+        # at the upper border, the slab needs to contain all slices that are mirrored by the padding
+        slab_start = max(0, min(z_start, z - halo))
+        slab_arr = img_arr[slab_start:min(z_stop + halo, z)]
+        slab_out_arr = self._execute_array(slab_arr, img_out_arr.shape[3:])
+        img_out_arr[z_start:z_stop] = slab_out_arr[z_start - slab_start:z_stop - slab_start]
+
+    def _execute_array(self, img_arr: np.ndarray, component_shape: tuple) -> np.ndarray:
+        """Executes the feature extraction on an image array.
+
+        Args:
+            img_arr (np.ndarray): The image array with shape (z, y, x).
+            component_shape (tuple): The shape of the function output, i.e. () or (number of features,).
+
+        Returns:
+            np.ndarray: The feature array with shape (z, y, x) or (z, y, x, number of features).
+        """
+        if self.vectorize and self.function in VECTORIZED_NEIGHBORHOOD_FUNCTIONS:
+            return VECTORIZED_NEIGHBORHOOD_FUNCTIONS[self.function](img_arr, self.kernel)
+
+        z, y, x = img_arr.shape
+
         z_offset = self.kernel[2]
         y_offset = self.kernel[1]
         x_offset = self.kernel[0]
         pad = ((0, z_offset), (0, y_offset), (0, x_offset))
         img_arr_padded = np.pad(img_arr, pad, 'symmetric')
 
+        img_out_arr = np.empty(img_arr.shape + component_shape, dtype=np.float32)
         for xx in range(x):
             for yy in range(y):
                 for zz in range(z):
@@ -178,10 +418,7 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
                     val = self.function(img_arr_padded[zz:zz + z_offset, yy:yy + y_offset, xx:xx + x_offset])
                     img_out_arr[zz, yy, xx] = val
 
-        img_out = sitk.GetImageFromArray(img_out_arr)
-        img_out.CopyInformation(image)
-
-        return img_out
+        return img_out_arr
 
     def __str__(self):
         """Gets a printable string representation.
@@ -193,6 +430,83 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
             .format(self=self)
 
 
+class StratifiedVoxelSampler:
+    """Represents a stratified voxel sampler.
+
+    The sampler draws a random subset of voxels per label without replacement and returns their flat indices
+    (i.e., indices into the C-ordered (z, y, x) image array). The amount of voxels per label is either a fraction of
+    the label's voxels or an absolute budget.
+    """
+
+    def __init__(self, labels: list, label_percentages: list = None, label_counts: list = None):
+        """Initializes a new instance of the StratifiedVoxelSampler class.
+
+        Args:
+            labels (list of int): The labels to sample, e.g. [0, 1].
+            label_percentages (list of float): The fraction of voxels of a corresponding label to sample,
+                e.g. [0.2, 0.2].
+            label_counts (list of int): The absolute number of voxels of a corresponding label to sample,
+                e.g. [1000, 500]. If a label has fewer voxels, all its voxels are sampled.
+
+        Raises:
+            ValueError: If not exactly one of label_percentages and label_counts is provided or its length does not
+                match the labels.
+        """
+        if (label_percentages is None) == (label_counts is None):
+            raise ValueError('either label_percentages or label_counts needs to be provided')
+        budgets = label_percentages if label_percentages is not None else label_counts
+        if len(budgets) != len(labels):
+            raise ValueError('a sampling budget is required for each label')
+
+        self.labels = labels
+        self.label_percentages = label_percentages
+        self.label_counts = label_counts
+
+    def get_indices(self, ground_truth: sitk.Image, background_mask: sitk.Image = None, seed=None) -> np.ndarray:
+        """Gets the flat indices of the sampled voxels.
+
+        Args:
+            ground_truth (sitk.Image): The ground truth image.
+            background_mask (sitk.Image): A mask, where intensity 0 indicates voxels to exclude independent of the
+                label.
+            seed (int or np.random.SeedSequence): The seed of the random number generator.
+                Use a distinct seed (e.g., a spawned :py:class:`np.random.SeedSequence`) per image to obtain
+                reproducible samples independent of the processing order.
+
+        Returns:
+            np.ndarray: The sorted flat indices of the sampled voxels.
+        """
+        rng = np.random.default_rng(seed)
+
+        ground_truth_array = sitk.GetArrayViewFromImage(ground_truth).ravel()
+        candidates = None
+        if background_mask is not None:
+            candidates = np.flatnonzero(sitk.GetArrayViewFromImage(background_mask))
+            ground_truth_array = ground_truth_array[candidates]
+
+        # group the voxels by label in a single pass, the voxels of a label are then a contiguous range of order
+        order = np.argsort(ground_truth_array, kind='stable')
+        sorted_labels = ground_truth_array[order]
+        starts = np.searchsorted(sorted_labels, self.labels, side='left')
+        stops = np.searchsorted(sorted_labels, self.labels, side='right')
+
+        indices = []
+        for label_idx, (start, stop) in enumerate(zip(starts, stops)):
+            no_voxels = stop - start
+            if self.label_percentages is not None:
+                no_samples = int(no_voxels * self.label_percentages[label_idx])
+            else:
+                no_samples = min(no_voxels, self.label_counts[label_idx])
+            indices.append(order[start + rng.choice(no_voxels, no_samples, replace=False)])
+
+        indices = np.concatenate(indices)
+        if candidates is not None:
+            indices = candidates[indices]
+
+        # sort the indices for a cache-friendly gather and the same voxel order as a mask
+        return np.sort(indices)
+
+
 class RandomizedTrainingMaskGenerator:
     """Represents a training mask generator.
 
@@ -204,7 +518,8 @@ class RandomizedTrainingMaskGenerator:
     def get_mask(ground_truth: sitk.Image,
                  ground_truth_labels: list,
                  label_percentages: list,
-                 background_mask: sitk.Image = None) -> sitk.Image:
+                 background_mask: sitk.Image = None,
+                 seed=None) -> sitk.Image:
         """Gets a training mask.
 
         Args:
@@ -215,33 +530,17 @@ class RandomizedTrainingMaskGenerator:
                 e.g. [0.2, 0.2].
             background_mask (sitk.Image): A mask, where intensity 0 indicates voxels to exclude independent of the
             label.
+            seed (int or np.random.SeedSequence): The seed of the random number generator.
 
         Returns:
             sitk.Image: The training mask.
         """
 
-        # initialize mask
-        ground_truth_array = sitk.GetArrayFromImage(ground_truth)
-        mask_array = np.zeros(ground_truth_array.shape, dtype=np.uint8)
+        indices = StratifiedVoxelSampler(ground_truth_labels, label_percentages).get_indices(ground_truth,
+                                                                                          background_mask, seed)
 
-        # exclude background
-        if background_mask is not None:
-            background_mask_array = sitk.GetArrayFromImage(background_mask)
-            background_mask_array = np.logical_not(background_mask_array)
-            ground_truth_array = ground_truth_array.astype(float)  # convert to float because of np.nan
-            ground_truth_array[background_mask_array] = np.nan
-
-        for label_idx, label in enumerate(ground_truth_labels):
-            indices = np.transpose(np.where(ground_truth_array == label))
-            np.random.shuffle(indices)
-
-            no_mask_items = int(indices.shape[0] * label_percentages[label_idx])
-
-            for no in range(no_mask_items):
-                x = indices[no][0]
-                y = indices[no][1]
-                z = indices[no][2]
-                mask_array[x, y, z] = 1  # this is a masked item
+        mask_array = np.zeros(ground_truth.GetSize()[::-1], dtype=np.uint8)
+        mask_array.flat[indices] = 1  # these are masked items
 
         mask = sitk.GetImageFromArray(mask_array)
         mask.SetOrigin(ground_truth.GetOrigin())
@@ -133,6 +133,102 @@ class SkullStripping(pymia_fltr.Filter):
             .format(self=self)
 
 
+class SkullStrippingNormalization(pymia_fltr.Filter):
+    """Represents a fused skull-stripping and normalization filter.
+
+    The result equals :class:`SkullStripping` followed by :class:`ImageNormalization`, but the image is masked and
+    normalized in-place in a single float32 buffer. The statistics are computed slab-wise in one pass.
+
+    The statistics are computed over the non-zero voxels of the skull-stripped image (as :class:`ImageNormalization`
+    does) instead of over the brain mask, which excludes brain voxels of intensity zero. This is on purpose for parity
+    with the separate filters, i.e. the output does not change.
+    """
+
+    def __init__(self, slab_size: int = 16):
+        """Initializes a new instance of the SkullStrippingNormalization class.
+
+        Args:
+            slab_size (int): The number of z-slices processed at once.
+        """
+        super().__init__()
+        self.slab_size = slab_size
+
+    def execute(self, image: sitk.Image, params: SkullStrippingParameters = None) -> sitk.Image:
+        """Executes a skull stripping and a z-score normalization of the brain voxels on an image.
+
+        Args:
+            image (sitk.Image): The image.
+            params (SkullStrippingParameters): The parameters with the brain mask.
+
+        Returns:
+            sitk.Image: The skull-stripped and normalized image.
+        """
+        mask = None if params is None else getattr(params, 'img_mask', None)
+
+        if mask is None:
+            raise ValueError('SkullStrippingNormalization requires a brain mask in params.img_mask.')
+
+        if (mask.GetSize() != image.GetSize()
+                or mask.GetOrigin() != image.GetOrigin()
+                or mask.GetSpacing() != image.GetSpacing()
+                or mask.GetDirection() != image.GetDirection()):
+            # resample the mask to the image geometry (see SkullStripping)
+            mask = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor, 0, mask.GetPixelID())
+
+        img_arr = sitk.GetArrayFromImage(image)
+        if img_arr.dtype != np.float32:
+            img_arr = img_arr.astype(np.float32)
+        mask_arr = sitk.GetArrayViewFromImage(mask)
+
+        # first pass: skull stripping and the statistics of the non-zero brain voxels (not the whole brain mask, see
+        # the class docstring), merged over the slabs
+        count = 0
+        mean = 0.0
+        m2 = 0.0  # sum of squared differences from the mean
+        for z in range(0, img_arr.shape[0], self.slab_size):
+            slab = img_arr[z:z + self.slab_size]
+            brain = (mask_arr[z:z + self.slab_size] >= 1) & (mask_arr[z:z + self.slab_size] <= 65535)
+            slab[~brain] = 0
+
+            values = slab[slab != 0].astype(np.float64)
+            if values.size == 0:
+                continue
+            slab_mean = values.mean()
+            slab_m2 = np.sum((values - slab_mean) ** 2)
+            delta = slab_mean - mean
+            total = count + values.size
+            mean += delta * values.size / total
+            m2 += slab_m2 + delta ** 2 * count * values.size / total
+            count = total
+
+        std = np.sqrt(m2 / count) if count > 0 else 0.0
+
+        if count == 0:
+            warnings.warn('Image appears empty (all zeros). Returning skull-stripped image.')
+        elif std == 0 or np.isclose(std, 0.0):
+            warnings.warn('Standard deviation is zero; returning skull-stripped image.')
+        else:
+            # second pass: normalize the non-zero voxels in-place
+            for z in range(0, img_arr.shape[0], self.slab_size):
+                slab = img_arr[z:z + self.slab_size]
+                nonzero = slab != 0
+                slab[nonzero] = (slab[nonzero].astype(np.float64) - mean) / std
+
+        img_out = sitk.GetImageFromArray(img_arr)
+        img_out.CopyInformation(image)
+
+        return img_out
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'SkullStrippingNormalization:\n' \
+            .format(self=self)
+
+
 class ImageRegistrationParameters(pymia_fltr.FilterParams):
     """Image registration parameters."""
 
@@ -217,3 +313,182 @@ class ImageRegistration(pymia_fltr.Filter):
         """
         return 'ImageRegistration:\n' \
             .format(self=self)
+
+
+class MultiImageRegistrationParameters(pymia_fltr.FilterParams):
+    """Multi-image registration parameters."""
+
+    def __init__(self, atlas: sitk.Image, transformation: sitk.Transform, is_ground_truth=False):
+        """Initializes a new instance of the MultiImageRegistrationParameters
+
+        Args:
+            atlas (sitk.Image): The atlas image.
+            transformation (sitk.Transform): The transformation for registration.
+            is_ground_truth (bool or list of bool): Indicates weather the image (see
+                :meth:`MultiImageRegistration.execute`) or each image (see
+                :meth:`MultiImageRegistration.execute_multiple`) is a label image (e.g., ground truth or brain mask),
+                which is registered using nearest neighbor interpolation, or not.
+        """
+        self.atlas = atlas
+        self.transformation = transformation
+        self.is_ground_truth = is_ground_truth
+
+
+class MultiImageRegistration(pymia_fltr.Filter):
+    """Represents a registration filter, which registers several images of a subject with the same transformation.
+
+    The images share one resampling setup (atlas grid and transformation). Label images on the same grid are packed
+    into the bits of a single integer image, such that they are resampled in one nearest neighbor pass.
+    The result is identical to :class:`ImageRegistration` on each image.
+    """
+
+    def __init__(self):
+        """Initializes a new instance of the MultiImageRegistration class."""
+        super().__init__()
+        self.resampler = sitk.ResampleImageFilter()
+
+    def execute(self, image: sitk.Image, params: MultiImageRegistrationParameters = None) -> sitk.Image:
+        """Registers an image.
+
+        Args:
+            image (sitk.Image): The image.
+            params (MultiImageRegistrationParameters): The registration parameters.
+
+        Returns:
+            sitk.Image: The registered image.
+        """
+        if params is None:
+            raise ValueError('MultiImageRegistration requires params with atlas and transformation.')
+        is_ground_truth = params.is_ground_truth
+        if not isinstance(is_ground_truth, bool):
+            is_ground_truth, = is_ground_truth  # a list with a single entry
+        return self.execute_multiple([image], MultiImageRegistrationParameters(params.atlas, params.transformation,
+                                                                               [is_ground_truth]))[0]
+
+    def execute_multiple(self, images: list, params: MultiImageRegistrationParameters = None) -> list:
+        """Registers images.
+
+        Args:
+            images (list of sitk.Image): The images.
+            params (MultiImageRegistrationParameters): The registration parameters.
+
+        Returns:
+            list of sitk.Image: The registered images.
+        """
+        if params is None or params.atlas is None or params.transformation is None:
+            raise ValueError('MultiImageRegistration requires params with atlas and transformation.')
+        if len(params.is_ground_truth) != len(images):
+            raise ValueError('MultiImageRegistration requires is_ground_truth for each image.')
+
+        self.resampler.SetReferenceImage(params.atlas)
+        self.resampler.SetTransform(params.transformation)
+        self.resampler.SetDefaultPixelValue(0)
+
+        registered = [None] * len(images)
+
+        label_indices = [idx for idx, is_gt in enumerate(params.is_ground_truth) if is_gt]
+        bits = MultiImageRegistration._get_packing_bits([images[idx] for idx in label_indices])
+        if len(label_indices) > 1 and bits is not None:
+            for idx, image in zip(label_indices, self._execute_packed([images[idx] for idx in label_indices], bits)):
+                registered[idx] = image
+
+        for idx, image in enumerate(images):
+            if registered[idx] is not None:
+                continue
+            if params.is_ground_truth[idx]:
+                registered[idx] = self._resample(image, sitk.sitkNearestNeighbor, image.GetPixelID())
+            else:
+                registered[idx] = self._resample(image, sitk.sitkLinear, sitk.sitkFloat32)
+
+        return registered
+
+    def _resample(self, image: sitk.Image, interpolator, out_pixel_id) -> sitk.Image:
+        """Resamples an image onto the atlas grid.
+
+        Args:
+            image (sitk.Image): The image.
+            interpolator: The SimpleITK interpolator.
+            out_pixel_id: The SimpleITK pixel type of the registered image.
+
+        Returns:
+            sitk.Image: The registered image.
+        """
+        self.resampler.SetInterpolator(interpolator)
+        self.resampler.SetOutputPixelType(out_pixel_id)
+        return self.resampler.Execute(image)
+
+    def _execute_packed(self, images: list, bits: list) -> list:
+        """Registers label images by resampling their bit-packed combination.
+
+        Args:
+            images (list of sitk.Image): The label images on the same grid.
+            bits (list of int): The number of bits of each image.
+
+        Returns:
+            list of sitk.Image: The registered label images.
+        """
+        packed_type = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                           if np.iinfo(dtype).bits >= sum(bits))
+
+        packed_arr = np.zeros(images[0].GetSize()[::-1], dtype=packed_type)
+        shift = 0
+        for image, no_bits in zip(images, bits):
+            packed_arr |= sitk.GetArrayViewFromImage(image).astype(packed_type) << packed_type(shift)
+            shift += no_bits
+
+        packed = sitk.GetImageFromArray(packed_arr)
+        packed.CopyInformation(images[0])
+        registered_packed = self._resample(packed, sitk.sitkNearestNeighbor, packed.GetPixelID())
+        registered_arr = sitk.GetArrayViewFromImage(registered_packed)
+
+        registered = []
+        shift = 0
+        for image, no_bits in zip(images, bits):
+            mask = packed_type((1 << no_bits) - 1)
+            label_arr = ((registered_arr >> packed_type(shift)) & mask).astype(
+                sitk.GetArrayViewFromImage(image).dtype)
+            label = sitk.GetImageFromArray(label_arr)
+            label.CopyInformation(registered_packed)
+            registered.append(label)
+            shift += no_bits
+
+        return registered
+
+    @staticmethod
+    def _get_packing_bits(images: list):
+        """Gets the number of bits required to pack label images into a single integer image.
+
+        Args:
+            images (list of sitk.Image): The label images.
+
+        Returns:
+            list of int: The number of bits of each image or None if the images cannot be packed, i.e. if they are
+            not on the same grid, not non-negative integer images or require more than 64 bits.
+        """
+        if len(images) == 0:
+            return None
+
+        reference = images[0]
+        bits = []
+        for image in images:
+            if (image.GetSize() != reference.GetSize() or image.GetOrigin() != reference.GetOrigin()
+                    or image.GetSpacing() != reference.GetSpacing()
+                    or image.GetDirection() != reference.GetDirection()
+                    or image.GetNumberOfComponentsPerPixel() != 1):
+                return None
+
+            image_arr = sitk.GetArrayViewFromImage(image)
+            if not np.issubdtype(image_arr.dtype, np.integer) or image_arr.min() < 0:
+                return None
+            bits.append(max(1, int(image_arr.max()).bit_length()))
+
+        return bits if sum(bits) <= 64 else None
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'MultiImageRegistration:\n' \
+            .format(self=self)
@@ -0,0 +1,217 @@
+"""This module contains per-subject, per-stage checkpoints of a pipeline run.
+
+The outputs of each stage (e.g., the pre-processed images, the trained model, the predictions, the post-processed
+segmentations and the metric rows) are stored in the result directory and recorded in a manifest when complete,
+such that a resumed run skips the completed stages.
+"""
+import json
+import os
+import pickle
+import shutil
+import threading
+import typing as t
+import warnings
+
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.multi_processor as mproc
+
+
+class Checkpoints:
+    """Represents the checkpoints of a pipeline run with a manifest in the result directory.
+
+    A checkpoint is identified by a stage and optionally a subject identifier. Its files are stored in
+    ``<result_dir>/checkpoints/<stage>/<id_>`` (or anywhere in the result directory) and recorded in the manifest
+    with their sizes when the checkpoint is complete. A checkpoint is valid if it is recorded in the manifest and its
+    files still exist with the recorded sizes. The manifest also records the configuration of the run, and the
+    checkpoints of a run with another configuration are discarded.
+    """
+
+    MANIFEST_FILE = 'checkpoints.json'
+    CHECKPOINT_DIR = 'checkpoints'
+    OBJECT_FILE = 'object.pkl'
+
+    def __init__(self, result_dir: str, config: dict):
+        """Initializes a new instance of the Checkpoints class.
+
+        Args:
+            result_dir (str): The result directory.
+            config (dict): The JSON serializable configuration of the run, e.g. the pipeline parameters.
+        """
+        # absolute, since the paths of the files are recorded relative to the result directory
+        self.result_dir = os.path.abspath(result_dir)
+        self.config = json.loads(json.dumps(config, sort_keys=True, default=str))
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        manifest_file = os.path.join(self.result_dir, self.MANIFEST_FILE)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest['config'] == self.config:
+                self.entries = manifest['entries']
+            else:
+                warnings.warn('Discarding the checkpoints in {} due to another configuration'.format(result_dir))
+                shutil.rmtree(os.path.join(self.result_dir, self.CHECKPOINT_DIR), ignore_errors=True)
+        self._save_manifest()
+
+    @staticmethod
+    def find_latest(result_dir: str) -> t.Union[str, None]:
+        """Finds the latest run directory with checkpoints.
+
+        Args:
+            result_dir (str): The directory containing the run directories (named by their timestamp).
+
+        Returns:
+            str: The latest run directory or None if no run directory contains checkpoints.
+        """
+        if not os.path.isdir(result_dir):
+            return None
+        run_dirs = [entry.path for entry in os.scandir(result_dir)
+                    if entry.is_dir() and os.path.exists(os.path.join(entry.path, Checkpoints.MANIFEST_FILE))]
+        return max(run_dirs, default=None)
+
+    def is_complete(self, stage: str, id_: str = '') -> bool:
+        """Checks whether a checkpoint is complete and valid.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier (empty for stages independent of the subjects).
+
+        Returns:
+            bool: True if the checkpoint is complete and valid; otherwise, False.
+        """
+        with self.lock:
+            files = self.entries.get(self._get_key(stage, id_))
+        if files is None:
+            return False
+        for file_name, size in files.items():
+            path = os.path.join(self.result_dir, file_name)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+        return True
+
+    def get_dir(self, stage: str, id_: str = '') -> str:
+        """Gets the directory of a checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+
+        Returns:
+            str: The checkpoint directory.
+        """
+        return os.path.join(self.result_dir, self.CHECKPOINT_DIR, stage, id_)
+
+    def complete(self, stage: str, id_: str = '', file_names: t.Iterable[str] = None):
+        """Records a checkpoint as complete after its files have been written.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+            file_names (Iterable[str]): The file names in the checkpoint directory or paths (absolute or relative to
+                the working directory) of files in the result directory. All files in the checkpoint directory if None.
+        """
+        checkpoint_dir = self.get_dir(stage, id_)
+        if file_names is None:
+            file_names = os.listdir(checkpoint_dir)
+        # bare file names are in the checkpoint directory
+        paths = [os.path.abspath(file_name if os.path.dirname(file_name) else os.path.join(checkpoint_dir, file_name))
+                 for file_name in file_names]
+        files = {os.path.relpath(path, self.result_dir): os.path.getsize(path) for path in paths}
+        with self.lock:
+            self.entries[self._get_key(stage, id_)] = files
+            self._save_manifest()
+
+    def save_object(self, stage: str, id_: str, obj):
+        """Saves a picklable object as checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+            obj: The object.
+        """
+        os.makedirs(self.get_dir(stage, id_), exist_ok=True)
+        with open(os.path.join(self.get_dir(stage, id_), self.OBJECT_FILE), 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.complete(stage, id_, [self.OBJECT_FILE])
+
+    def load_object(self, stage: str, id_: str = ''):
+        """Loads an object checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+
+        Returns:
+            The object.
+        """
+        with open(os.path.join(self.get_dir(stage, id_), self.OBJECT_FILE), 'rb') as f:
+            return pickle.load(f)
+
+    def save_brain_image(self, stage: str, id_: str, img: structure.BrainImage, feature_matrix: bool = True):
+        """Saves a brain image as checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+            img (structure.BrainImage): The image.
+            feature_matrix (bool): Whether to save the feature matrix. The feature indices are saved in any case.
+        """
+        picklable = mproc.BrainImageToPicklableBridge.convert(img, feature_matrix=feature_matrix)
+        picklable.feature_indices = img.feature_indices
+        self.save_object(stage, id_, picklable)
+
+    def load_brain_image(self, stage: str, id_: str) -> structure.BrainImage:
+        """Loads a brain image checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+
+        Returns:
+            structure.BrainImage: The image.
+        """
+        return mproc.PicklableToBrainImageBridge.convert(self.load_object(stage, id_))
+
+    def save_images(self, stage: str, id_: str, images: t.Sequence[sitk.Image]):
+        """Saves SimpleITK images as checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+            images (Sequence[sitk.Image]): The images.
+        """
+        os.makedirs(self.get_dir(stage, id_), exist_ok=True)
+        file_names = ['{}.mha'.format(idx) for idx in range(len(images))]
+        for image, file_name in zip(images, file_names):
+            sitk.WriteImage(image, os.path.join(self.get_dir(stage, id_), file_name), True)
+        self.complete(stage, id_, file_names)
+
+    def load_images(self, stage: str, id_: str) -> t.List[sitk.Image]:
+        """Loads a SimpleITK images checkpoint.
+
+        Args:
+            stage (str): The stage.
+            id_ (str): The subject identifier.
+
+        Returns:
+            List[sitk.Image]: The images.
+        """
+        with self.lock:
+            file_names = sorted(os.path.basename(file_name) for file_name in self.entries[self._get_key(stage, id_)])
+        file_names.sort(key=lambda file_name: int(file_name.split('.')[0]))
+        return [sitk.ReadImage(os.path.join(self.get_dir(stage, id_), file_name)) for file_name in file_names]
+
+    @staticmethod
+    def _get_key(stage: str, id_: str) -> str:
+        return '{}/{}'.format(stage, id_)
+
+    def _save_manifest(self):
+        """Saves the manifest atomically."""
+        os.makedirs(self.result_dir, exist_ok=True)
+        manifest_file = os.path.join(self.result_dir, self.MANIFEST_FILE)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump({'config': self.config, 'entries': self.entries}, f, indent=2, sort_keys=True)
+        os.replace(manifest_file + '.tmp', manifest_file)
@@ -0,0 +1,261 @@
+"""This module contains the classifier backends of the pipeline.
+
+A backend wraps a scikit-learn classifier with a common interface to fit, predict labels and probabilities at once,
+save and load, such that the pipeline can be run with any backend of :data:`CLASSIFIERS`.
+"""
+import abc
+import contextlib
+import timeit
+import typing as t
+
+import joblib
+import numpy as np
+import sklearn.ensemble as sk_ensemble
+
+import mialab.utilities.forest_inference as finf
+import mialab.utilities.model_io as model_io
+
+
+class Classifier(abc.ABC):
+    """Represents a classifier backend.
+
+    The number of estimators (e.g., trees or boosting iterations) is given by the parameter :attr:`SIZE_PARAM`, which
+    can also be set as ``n_estimators`` for all backends.
+    """
+
+    NAME = None  #: The name of the backend (see :data:`CLASSIFIERS`).
+    SIZE_PARAM = 'n_estimators'  #: The parameter of the number of estimators.
+    DEFAULT_PARAMS = {}  #: The default parameters of the scikit-learn classifier.
+
+    def __init__(self, params: dict = None, n_jobs: int = -1):
+        """Initializes a new instance of the Classifier class.
+
+        Args:
+            params (dict): The parameters of the scikit-learn classifier overriding the :attr:`DEFAULT_PARAMS`.
+            n_jobs (int): The number of threads to fit and predict (-1 means all cores).
+        """
+        self.n_jobs = n_jobs
+        self.model = self._create_model(self.get_params(params))
+        self.fit_time = None  # the time of the last fit in seconds
+        self.fit_threads = None  # the number of threads used by the last fit
+
+    @classmethod
+    def get_params(cls, params: dict = None) -> dict:
+        """Gets the parameters of the scikit-learn classifier.
+
+        Args:
+            params (dict): The parameters overriding the :attr:`DEFAULT_PARAMS`.
+
+        Returns:
+            dict: The parameters, where ``n_estimators`` has been renamed to :attr:`SIZE_PARAM`.
+        """
+        params = dict(cls.DEFAULT_PARAMS, **(params or {}))
+        if cls.SIZE_PARAM != 'n_estimators' and 'n_estimators' in params:
+            params[cls.SIZE_PARAM] = params.pop('n_estimators')
+        return params
+
+    @property
+    def classes(self) -> np.ndarray:
+        """np.ndarray: The class labels."""
+        return self.model.classes_
+
+    @property
+    @abc.abstractmethod
+    def size(self) -> int:
+        """int: The number of fitted estimators."""
+        raise NotImplementedError()
+
+    def set_n_jobs(self, n_jobs: int):
+        """Sets the number of threads to fit and predict.
+
+        Args:
+            n_jobs (int): The number of threads (-1 means all cores).
+        """
+        self.n_jobs = n_jobs
+
+    def warm_start(self, size: int):
+        """Sets up the next fit to add estimators to the fitted estimators instead of refitting them.
+
+        Args:
+            size (int): The total number of estimators after the next fit.
+
+        Raises:
+            ValueError: If the classifier has already ``size`` estimators.
+        """
+        if size <= self.size:
+            raise ValueError('The model has already {} estimators, increase {} to add estimators'.format(
+                self.size, self.SIZE_PARAM))
+        self.model.set_params(warm_start=True, **{self.SIZE_PARAM: size})
+
+    def fit(self, features: np.ndarray, labels: np.ndarray):
+        """Fits the classifier and measures the fit time.
+
+        Args:
+            features (np.ndarray): The features of shape (n, number_of_features).
+            labels (np.ndarray): The labels of shape (n,).
+        """
+        start_time = timeit.default_timer()
+        self._fit(features, labels)
+        self.fit_time = timeit.default_timer() - start_time
+
+    @abc.abstractmethod
+    def predict(self, features: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+        """Predicts the labels and probabilities.
+
+        Args:
+            features (np.ndarray): The features of shape (n, number_of_features).
+
+        Returns:
+            tuple: The labels of shape (n,) and the float32 probabilities of shape (n, number_of_classes).
+        """
+        raise NotImplementedError()
+
+    def save(self, path: str, feature_names: t.List[str], pre_process_params: dict):
+        """Saves the classifier with its feature layout and pre-processing parameters.
+
+        Args:
+            path (str): The model file path (e.g., ``model.joblib``).
+            feature_names (List[str]): The names of the features in the order of the feature matrix columns.
+            pre_process_params (dict): The pre-processing parameters used for the training.
+        """
+        model_io.save_model(path, self, feature_names, pre_process_params)
+
+    @staticmethod
+    def load(path: str, mmap_mode: str = 'r') -> t.Tuple['Classifier', t.List[str], dict]:
+        """Loads a classifier saved by :meth:`save`.
+
+        Args:
+            path (str): The model file path.
+            mmap_mode (str): The memory-map mode of the numpy arrays (see :func:`model_io.load_model
+                <mialab.utilities.model_io.load_model>`).
+
+        Returns:
+            tuple: The classifier, the feature names and the pre-processing parameters.
+
+        Raises:
+            ValueError: If the file does not contain a classifier.
+        """
+        classifier, feature_names, pre_process_params = model_io.load_model(path, mmap_mode)
+        if not isinstance(classifier, Classifier):
+            raise ValueError('{} does not contain a classifier'.format(path))
+        return classifier, feature_names, pre_process_params
+
+    @abc.abstractmethod
+    def _create_model(self, params: dict):
+        """Creates the scikit-learn classifier."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _fit(self, features: np.ndarray, labels: np.ndarray):
+        """Fits the scikit-learn classifier and sets the :attr:`fit_threads`."""
+        raise NotImplementedError()
+
+
+class Forest(Classifier, abc.ABC):
+    """Represents a backend of a forest of decision trees, which is predicted by a :class:`FlatForest
+    <mialab.utilities.forest_inference.FlatForest>`."""
+
+    DEFAULT_PARAMS = {'max_features': 'sqrt',
+                      'n_estimators': 10,
+                      'max_depth': 10,
+                      'random_state': 42}
+
+    def __init__(self, params: dict = None, n_jobs: int = -1):
+        """Initializes a new instance of the Forest class.
+
+        Args:
+            params (dict): The parameters of the scikit-learn forest overriding the :attr:`DEFAULT_PARAMS`.
+            n_jobs (int): The number of threads to fit and predict (-1 means all cores).
+        """
+        super().__init__(params, n_jobs)
+        self.engine = None
+
+    @property
+    def size(self) -> int:
+        return len(getattr(self.model, 'estimators_', []))
+
+    def set_n_jobs(self, n_jobs: int):
+        super().set_n_jobs(n_jobs)
+        self.model.set_params(n_jobs=n_jobs)
+
+    def predict(self, features: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+        return self.engine.predict(features, joblib.effective_n_jobs(self.n_jobs))
+
+    def _fit(self, features: np.ndarray, labels: np.ndarray):
+        # the trees are fitted in parallel, i.e. at most one thread per new tree
+        no_trees = self.model.n_estimators - (self.size if self.model.warm_start else 0)
+        self.fit_threads = min(joblib.effective_n_jobs(self.n_jobs), no_trees)
+        self.model.fit(features, labels)
+        self.engine = finf.FlatForest(self.model)
+
+    def __setstate__(self, state):
+        # the node arrays of the inference engine are pickled as numpy arrays, which are memory-mapped when loading
+        # (see load), i.e. the engine is not exported again but only the scikit-learn trees are attached
+        self.__dict__.update(state)
+        if self.engine is not None:
+            self.engine.attach(self.model)
+
+
+class RandomForest(Forest):
+    """Represents a :class:`sklearn.ensemble.RandomForestClassifier` backend."""
+
+    NAME = 'random_forest'
+
+    def _create_model(self, params: dict):
+        return sk_ensemble.RandomForestClassifier(n_jobs=self.n_jobs, **params)
+
+
+class ExtraTrees(Forest):
+    """Represents a :class:`sklearn.ensemble.ExtraTreesClassifier` backend.
+
+    The split thresholds are drawn at random instead of optimized, which fits faster than a random forest.
+    """
+
+    NAME = 'extra_trees'
+
+    def _create_model(self, params: dict):
+        return sk_ensemble.ExtraTreesClassifier(n_jobs=self.n_jobs, **params)
+
+
+class HistGradientBoosting(Classifier):
+    """Represents a :class:`sklearn.ensemble.HistGradientBoostingClassifier` backend.
+
+    The features are binned into at most 255 bins, which fits far faster than a forest on many samples.
+    The number of boosting iterations is given by ``max_iter`` (or ``n_estimators``). Since the classifier has no
+    ``n_jobs`` parameter, its OpenMP threads are limited by threadpoolctl (if installed).
+    """
+
+    NAME = 'hist_gradient_boosting'
+    SIZE_PARAM = 'max_iter'
+    DEFAULT_PARAMS = {'max_iter': 100,
+                      'max_depth': 10,
+                      'random_state': 42}
+
+    @property
+    def size(self) -> int:
+        return getattr(self.model, 'n_iter_', 0)
+
+    def predict(self, features: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+        with self._limit_threads():
+            probabilities = self.model.predict_proba(features)
+        return self.classes.take(probabilities.argmax(axis=1)), probabilities.astype(np.float32)
+
+    def _create_model(self, params: dict):
+        return sk_ensemble.HistGradientBoostingClassifier(**params)
+
+    def _fit(self, features: np.ndarray, labels: np.ndarray):
+        self.fit_threads = joblib.effective_n_jobs(self.n_jobs)
+        with self._limit_threads():
+            self.model.fit(features, labels)
+
+    def _limit_threads(self):
+        """Limits the OpenMP threads to ``n_jobs``."""
+        try:
+            import threadpoolctl
+        except ImportError:
+            return contextlib.nullcontext()
+        return threadpoolctl.threadpool_limits(joblib.effective_n_jobs(self.n_jobs), user_api='openmp')
+
+
+CLASSIFIERS = {classifier.NAME: classifier for classifier in (RandomForest, ExtraTrees, HistGradientBoosting)}
+"""The classifier backends by name."""
@@ -0,0 +1,253 @@
+"""This module contains the building blocks of experiments evaluating several classifiers on the same features, e.g.
+hyperparameter sweeps.
+
+The subjects are pre-processed once into a :class:`SubjectStore`. The classifiers are then fitted and evaluated by
+:func:`fit_and_evaluate` in worker processes, which memory-map the stores, i.e. all workers share one copy of the
+features in the page cache.
+"""
+import os
+import pickle
+import timeit
+import typing as t
+
+import numpy as np
+import pymia.evaluation.writer as writer
+
+import mialab.data.structure as structure
+import mialab.utilities.classifier as clf
+import mialab.utilities.feature_cache as fcache
+import mialab.utilities.feature_store as fstore
+import mialab.utilities.multi_processor as mproc
+import mialab.utilities.pipeline_utilities as putil
+
+
+class SubjectStore:
+    """Represents the pre-processed subjects of an experiment.
+
+    The features and labels are stored in a :class:`TrainingFeatureStore
+    <mialab.utilities.feature_store.TrainingFeatureStore>` and the images required for the evaluation (e.g., the
+    ground truth) are pickled per subject without feature matrix. Optionally, named subsets of the feature matrix
+    rows are stored per subject, e.g. the training sample and the voxels to predict of a feature matrix used for the
+    training and testing.
+    """
+
+    IMAGE_DIR = 'images'
+
+    def __init__(self, store_dir: str):
+        """Initializes a new instance of the SubjectStore class.
+
+        Opens the store in ``store_dir`` or creates a new store if it does not exist.
+
+        Args:
+            store_dir (str): The store directory.
+        """
+        self.store_dir = store_dir
+        self.features = fstore.TrainingFeatureStore(store_dir)
+        os.makedirs(os.path.join(self.store_dir, self.IMAGE_DIR), exist_ok=True)
+
+    @property
+    def ids(self) -> t.List[str]:
+        """List[str]: The subject identifiers in the order of the features."""
+        return list(self.features.index)
+
+    def __contains__(self, id_: str) -> bool:
+        return id_ in self.features
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def add(self, img: structure.BrainImage, subsets: t.Dict[str, np.ndarray] = None):
+        """Adds a pre-processed subject.
+
+        Args:
+            img (structure.BrainImage): The image with the feature matrix.
+            subsets (Dict[str, np.ndarray]): The sorted feature matrix rows by subset name.
+        """
+        picklable = mproc.BrainImageToPicklableBridge.convert(img, img.images.keys(), feature_matrix=False)
+        picklable.feature_indices = img.feature_indices
+        with open(self._get_image_file(img.id_), 'wb') as f:
+            pickle.dump(picklable, f, protocol=pickle.HIGHEST_PROTOCOL)
+        np.savez(self._get_subsets_file(img.id_), **(subsets or {}))
+        # the index of the feature store is written last, i.e. a subject is complete if it is in the index
+        self.features.append(img.id_, *img.feature_matrix)
+
+    def get_image(self, id_: str, subset: str = None) -> structure.BrainImage:
+        """Gets a subject.
+
+        Args:
+            id_ (str): The subject identifier.
+            subset (str): The subset of the feature matrix rows (all rows if None).
+
+        Returns:
+            structure.BrainImage: The image with the memory-mapped feature matrix (copied for a subset).
+        """
+        with open(self._get_image_file(id_), 'rb') as f:
+            img = mproc.PicklableToBrainImageBridge.convert(pickle.load(f))
+        img.feature_matrix = self.features.get(id_)
+        if subset is not None:
+            rows = self.get_rows(id_, subset)
+            img.feature_matrix = tuple(matrix[rows] for matrix in img.feature_matrix)
+            if img.feature_indices is not None:
+                img.feature_indices = img.feature_indices[rows]
+        return img
+
+    def get_features(self, ids: t.Iterable[str] = None, subset: str = None) -> t.Tuple[np.ndarray, np.ndarray]:
+        """Gets the features and labels of subjects.
+
+        Args:
+            ids (Iterable[str]): The subject identifiers. All subjects if None.
+            subset (str): The subset of the feature matrix rows of each subject (all rows if None).
+
+        Returns:
+            tuple: The features and labels, which are memory-mapped for all rows of all subjects and copied
+            otherwise.
+        """
+        if ids is None and subset is None:
+            return self.features.features, self.features.labels
+
+        features, labels = [], []
+        for id_ in self.ids if ids is None else ids:
+            rows = slice(None) if subset is None else self.get_rows(id_, subset)
+            subject_features, subject_labels = self.features.get(id_)
+            features.append(subject_features[rows])
+            labels.append(subject_labels[rows])
+        return np.concatenate(features), np.concatenate(labels)
+
+    def get_rows(self, id_: str, subset: str) -> np.ndarray:
+        """Gets a subset of the feature matrix rows of a subject.
+
+        Args:
+            id_ (str): The subject identifier.
+            subset (str): The subset name.
+
+        Returns:
+            np.ndarray: The rows.
+        """
+        with np.load(self._get_subsets_file(id_)) as subsets:
+            return subsets[subset]
+
+    def _get_image_file(self, id_: str) -> str:
+        return os.path.join(self.store_dir, self.IMAGE_DIR, id_ + '.pkl')
+
+    def _get_subsets_file(self, id_: str) -> str:
+        return os.path.join(self.store_dir, self.IMAGE_DIR, id_ + '_subsets.npz')
+
+
+def pre_process_subjects(data_batch: dict, subjects: SubjectStore, pre_process_params: dict,
+                         pool: mproc.WorkerPool = None, cache: fcache.FeatureMatrixCache = None,
+                         image_types: t.List[structure.BrainImageTypes] = (), subsets: callable = None):
+    """Pre-processes the subjects, which are not yet in the store, and adds them to the store.
+
+    The subjects are added in the order of ``data_batch`` (independent of the completion order) such that the
+    features are reproducible.
+
+    Args:
+        data_batch (dict): The paths by subject identifier (see :func:`pre_process_batch
+            <mialab.utilities.pipeline_utilities.pre_process_batch>`).
+        subjects (SubjectStore): The store.
+        pre_process_params (dict): The pre-processing parameters.
+        pool (mproc.WorkerPool): The worker pool (a temporary pool if None).
+        cache (fcache.FeatureMatrixCache): A feature matrix cache.
+        image_types (List[structure.BrainImageTypes]): The types of the images kept for the evaluation, e.g. the
+            ground truth.
+        subsets (callable): A function returning the subsets of the feature matrix rows of an image (see
+            :meth:`SubjectStore.add`).
+    """
+    data_batch = {id_: paths for id_, paths in data_batch.items() if id_ not in subjects}
+    completed = {}
+    next_idx = 0
+    for idx, img in putil.pre_process_batch_iter(data_batch, pre_process_params, cache=cache,
+                                                 shared_memory_transport=pool is None or pool.supports_shared_memory,
+                                                 pool=pool, image_types=list(image_types)):
+        completed[idx] = img
+        # add the completed subjects in order
+        while next_idx in completed:
+            img = completed.pop(next_idx)
+            subjects.add(img, subsets(img) if subsets is not None else None)
+            next_idx += 1
+
+
+def fit_and_evaluate(result_dir: str, classifier: str, classifier_params: dict, n_jobs: int, train_dir: str,
+                     test_dir: str, post_process_params: dict, train_ids: t.List[str] = None,
+                     test_ids: t.List[str] = None, train_subset: str = None, test_subset: str = None) -> dict:
+    """Fits a classifier on training subjects and evaluates it on testing subjects.
+
+    The results are written to ``results.csv`` and ``results_summary.csv`` in ``result_dir`` (see
+    :func:`write_results`).
+
+    Args:
+        result_dir (str): The result directory.
+        classifier (str): The name of the classifier backend (see :data:`CLASSIFIERS
+            <mialab.utilities.classifier.CLASSIFIERS>`).
+        classifier_params (dict): The parameters of the classifier.
+        n_jobs (int): The number of threads to fit and predict.
+        train_dir (str): The directory of the :class:`SubjectStore` of the training subjects.
+        test_dir (str): The directory of the :class:`SubjectStore` of the testing subjects.
+        post_process_params (dict): The post-processing parameters.
+        train_ids (List[str]): The training subjects (all if None).
+        test_ids (List[str]): The testing subjects (all if None).
+        train_subset (str): The subset of the feature matrix rows to train on (see :class:`SubjectStore`).
+        test_subset (str): The subset of the feature matrix rows to predict.
+
+    Returns:
+        dict: The evaluation ``results`` sorted by subject, the ``fit_time`` in seconds, the ``fit_threads``,
+        the number of training samples ``no_samples``, the ``predict_time`` in seconds and the number of predicted
+        voxels ``no_voxels``.
+    """
+    train, test = SubjectStore(train_dir), SubjectStore(test_dir)
+
+    classifier_ = clf.CLASSIFIERS[classifier](classifier_params, n_jobs)
+    features, labels = train.get_features(train_ids, train_subset)
+    classifier_.fit(features, labels)
+
+    results = []
+    predict_time = 0.0
+    no_voxels = 0
+    for id_ in sorted(test.ids if test_ids is None else test_ids):
+        img = test.get_image(id_, test_subset)
+
+        start_time = timeit.default_timer()
+        predictions, probabilities = classifier_.predict(img.feature_matrix[0])
+        predict_time += timeit.default_timer() - start_time
+        no_voxels += predictions.shape[0]
+
+        image_prediction = putil.voxels_as_image(predictions.astype(np.uint8), img)
+        image_probabilities = putil.voxels_as_image(probabilities, img,
+                                                    (classifier_.classes == 0).astype(probabilities.dtype))
+        image_post_processed = putil.post_process_batch([img], [image_prediction], [image_probabilities],
+                                                        post_process_params, multi_process=False)[0]
+
+        evaluator = putil.init_evaluator()
+        evaluator.evaluate(image_prediction, img.images[structure.BrainImageTypes.GroundTruth], img.id_)
+        evaluator.evaluate(image_post_processed, img.images[structure.BrainImageTypes.GroundTruth], img.id_ + '-PP')
+        results.extend(evaluator.results)
+
+    write_results(results, result_dir)
+    return {'results': results,
+            'fit_time': classifier_.fit_time,
+            'fit_threads': classifier_.fit_threads,
+            'no_samples': features.shape[0],
+            'predict_time': predict_time,
+            'no_voxels': no_voxels}
+
+
+def write_results(results: list, result_dir: str, console: bool = False):
+    """Writes the evaluation results to ``results.csv`` and their mean and standard deviation among all subjects
+    to ``results_summary.csv``.
+
+    Args:
+        results (list): The evaluation results (see :class:`pymia.evaluation.evaluator.Evaluator`).
+        result_dir (str): The result directory.
+        console (bool): Whether to also print the results.
+    """
+    os.makedirs(result_dir, exist_ok=True)
+    writer.CSVWriter(os.path.join(result_dir, 'results.csv')).write(results)
+    if console:
+        print('\nSubject-wise results...')
+        writer.ConsoleWriter().write(results)
+
+    functions = {'MEAN': np.mean, 'STD': np.std}
+    writer.CSVStatisticsWriter(os.path.join(result_dir, 'results_summary.csv'), functions=functions).write(results)
+    if console:
+        print('\nAggregated statistic results...')
+        writer.ConsoleStatisticsWriter(functions=functions).write(results)
@@ -0,0 +1,234 @@
+"""This module contains a persistent cache of pre-processed feature matrices.
+
+Pre-processing (loading, registration, pre-processing and feature extraction) of a subject is deterministic for given
+input files, atlas and pre-processing parameters. The cache stores the resulting feature matrix on disk, such that
+repeated runs skip the pre-processing of unchanged subjects.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import typing as t
+
+import numpy as np
+import pymia.data.conversion as conversion
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.multi_processor as mproc
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # e.g., on Windows, the eviction is only serialized within a process
+
+CACHE_VERSION = 3  #: Increase when the pre-processing changes such that existing cache entries become invalid.
+
+
+class FeatureMatrixCache:
+    """Represents a content-addressed on-disk cache of :py:attr:`BrainImage.feature_matrix <data.structure.BrainImage>`.
+
+    Each entry is a directory named by its key, which contains the features, labels, feature indices and optionally
+    the ground truth as ``.npy`` files and the remaining information (identifier, path, transformation, image
+    properties and region of interest) as pickle.
+    The key is a hash of the input files (path, size and modification time or, optionally, the content),
+    the atlas and the pre-processing parameters. Entries are evicted in least recently used order if the cache
+    exceeds its maximum size. The eviction is serialized among the threads and, by a lock file, the processes sharing
+    the cache, and entries evicted concurrently are treated as missing.
+    """
+
+    FEATURES_FILE = 'features.npy'
+    LABELS_FILE = 'labels.npy'
+    INDICES_FILE = 'indices.npy'
+    GROUND_TRUTH_FILE = 'ground_truth.npy'
+    INFO_FILE = 'info.pkl'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, cache_dir: str, max_size: int = 20 * 1024 ** 3, hash_contents: bool = False,
+                 mmap_mode: str = 'r'):
+        """Initializes a new instance of the FeatureMatrixCache class.
+
+        Args:
+            cache_dir (str): The cache directory.
+            max_size (int): The maximum size of the cache in bytes.
+            hash_contents (bool): Whether to hash the content of the input files instead of their size and
+                modification time.
+            mmap_mode (str): The memory-map mode to load the features and labels (see :py:func:`numpy.load`).
+                Use None to load them into memory.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hash_contents = hash_contents
+        self.mmap_mode = mmap_mode
+        self.lock = threading.Lock()
+        self._atlas_digest = None  # the atlas images and their digest, which is computed once
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, id_: str, paths: dict, params: dict, atlas_images: t.List[sitk.Image] = ()) -> str:
+        """Gets the cache key of a subject.
+
+        Args:
+            id_ (str): The subject identifier.
+            paths (dict): The paths as provided by :py:class:`FileSystemDataCrawler
+                <utilities.file_access_utilities.FileSystemDataCrawler>`, i.e. the key ``id_`` points to the subject
+                directory and the keys of type :py:class:`BrainImageTypes <data.structure.BrainImageTypes>`
+                to the files (including the transformation).
+            params (dict): The pre-processing parameters.
+            atlas_images (list of sitk.Image): The atlas images.
+
+        Returns:
+            str: The cache key.
+        """
+        hash_ = hashlib.sha256()
+        hash_.update('{}\n{}\n'.format(CACHE_VERSION, id_).encode())
+
+        for key, path in sorted(paths.items(), key=lambda item: str(item[0])):
+            if key == id_:
+                continue  # the subject directory is not an input file
+            hash_.update('{}={}\n'.format(key, path).encode())
+            if self.hash_contents:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                        hash_.update(chunk)
+            else:
+                stat = os.stat(path)
+                hash_.update('{} {}\n'.format(stat.st_size, stat.st_mtime_ns).encode())
+
+        hash_.update(self._get_atlas_digest(atlas_images))
+        hash_.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return hash_.hexdigest()
+
+    def load(self, key: str) -> t.Union[structure.BrainImage, None]:
+        """Loads a cache entry.
+
+        The returned image contains the feature matrix (and indices) but no images, except the ground truth if it
+        has been saved.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            structure.BrainImage: The image with the feature matrix or None if the entry does not exist.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, self.INFO_FILE), 'rb') as f:
+                info = pickle.load(f)
+            features = np.load(os.path.join(entry_dir, self.FEATURES_FILE), mmap_mode=self.mmap_mode)
+            labels = np.load(os.path.join(entry_dir, self.LABELS_FILE), mmap_mode=self.mmap_mode)
+            indices = None
+            if info['has_indices']:
+                indices = np.load(os.path.join(entry_dir, self.INDICES_FILE), mmap_mode=self.mmap_mode)
+            images = {}
+            if info['has_ground_truth']:
+                images[structure.BrainImageTypes.GroundTruth] = conversion.NumpySimpleITKImageBridge.convert(
+                    np.load(os.path.join(entry_dir, self.GROUND_TRUTH_FILE)), info['image_properties'])
+        except (OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+            return None
+
+        try:
+            os.utime(entry_dir)  # mark as recently used
+        except FileNotFoundError:
+            return None  # evicted concurrently
+
+        img = structure.BrainImage(info['id_'], info['path'], images,
+                                   info['transform'].get_sitk_transformation(), info['image_properties'])
+        img.feature_matrix = (features, labels)
+        img.feature_indices = indices
+        img.full_image_properties = info['full_image_properties']
+        img.roi_index = info['roi_index']
+        return img
+
+    def save(self, key: str, img: structure.BrainImage, save_ground_truth: bool = False):
+        """Saves the feature matrix of an image as cache entry and evicts old entries if necessary.
+
+        Args:
+            key (str): The cache key.
+            img (structure.BrainImage): The pre-processed image.
+            save_ground_truth (bool): Whether to save the ground truth image, e.g. for the evaluation of test images.
+        """
+        features, labels = img.feature_matrix
+        save_ground_truth = save_ground_truth and structure.BrainImageTypes.GroundTruth in img.images
+        info = {'id_': img.id_,
+                'path': img.path,
+                'transform': mproc.PicklableAffineTransform(img.transformation),
+                'image_properties': img.image_properties,
+                'full_image_properties': img.full_image_properties,
+                'roi_index': img.roi_index,
+                'has_indices': img.feature_indices is not None,
+                'has_ground_truth': save_ground_truth}
+
+        # write to a temporary directory first such that incomplete entries are never visible
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            np.save(os.path.join(tmp_dir, self.FEATURES_FILE), features)
+            np.save(os.path.join(tmp_dir, self.LABELS_FILE), labels)
+            if img.feature_indices is not None:
+                np.save(os.path.join(tmp_dir, self.INDICES_FILE), img.feature_indices)
+            if save_ground_truth:
+                np.save(os.path.join(tmp_dir, self.GROUND_TRUTH_FILE),
+                        sitk.GetArrayViewFromImage(img.images[structure.BrainImageTypes.GroundTruth]))
+            with open(os.path.join(tmp_dir, self.INFO_FILE), 'wb') as f:
+                pickle.dump(info, f)
+            os.replace(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # e.g., the entry has been written concurrently
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache does not exceed its maximum size."""
+        with self._lock():
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    try:
+                        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                        entries.append((entry.stat().st_mtime, size, entry.path))
+                    except FileNotFoundError:
+                        continue  # evicted concurrently
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total_size -= size
+
+    @contextlib.contextmanager
+    def _lock(self):
+        # serializes the threads of this process and, by the lock file, the processes sharing the cache
+        with self.lock, open(os.path.join(self.cache_dir, self.LOCK_FILE), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+            yield
+
+    def _get_atlas_digest(self, atlas_images: t.List[sitk.Image]) -> bytes:
+        # the atlas images are loaded once, i.e. the digest is computed once and reused as long as the same atlas
+        # images are passed
+        atlas_images = tuple(atlas_images)
+        with self.lock:
+            if self._atlas_digest is not None and len(self._atlas_digest[0]) == len(atlas_images) and \
+                    all(cached is image for cached, image in zip(self._atlas_digest[0], atlas_images)):
+                return self._atlas_digest[1]
+
+        hash_ = hashlib.sha256()
+        for atlas_image in atlas_images:
+            hash_.update(str(conversion.ImageProperties(atlas_image)).encode())
+            hash_.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(atlas_image)).data)
+        digest = hash_.digest()
+        with self.lock:
+            self._atlas_digest = (atlas_images, digest)
+        return digest
+
+    def clear(self):
+        """Removes all entries."""
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
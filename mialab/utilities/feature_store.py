@@ -0,0 +1,153 @@
+"""This module contains an out-of-core store of the training feature matrices.
+
+The features of all training subjects are appended to a memory-mapped file, such that the classifier can be trained
+on more subjects than fit into memory.
+"""
+import json
+import os
+import threading
+import typing as t
+
+import numpy as np
+
+
+class TrainingFeatureStore:
+    """Represents an append-only on-disk store of training features and labels.
+
+    The features are stored in a growable float32 :class:`numpy.memmap` of shape (capacity, number_of_features)
+    and the labels in an int16 memmap of shape (capacity,). The index maps each subject identifier to its rows
+    (start, stop) and is written after the rows of a subject, i.e. rows not in the index (e.g., of an interrupted
+    append) are ignored and overwritten by the next append.
+    """
+
+    FEATURES_FILE = 'features.f32'
+    LABELS_FILE = 'labels.i16'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, store_dir: str, initial_capacity: int = 2 ** 20):
+        """Initializes a new instance of the TrainingFeatureStore class.
+
+        Opens the store in ``store_dir`` or creates a new store if it does not exist.
+
+        Args:
+            store_dir (str): The store directory.
+            initial_capacity (int): The initial number of rows. The capacity is doubled when the store is full.
+        """
+        self.store_dir = store_dir
+        self.initial_capacity = initial_capacity
+        self.lock = threading.Lock()
+
+        self.index = {}  # (start, stop) by subject identifier, in the order of appending
+        self.size = 0
+        self.capacity = 0
+        self.number_of_features = None
+        self._features = None
+        self._labels = None
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        index_file = os.path.join(self.store_dir, self.INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                info = json.load(f)
+            self.index = {id_: tuple(rows) for id_, rows in info['index']}
+            self.size = info['size']
+            self.capacity = info['capacity']
+            self.number_of_features = info['number_of_features']
+            if self.number_of_features is not None:
+                self._map()
+
+    @property
+    def features(self) -> np.ndarray:
+        """np.ndarray: The memory-mapped features of shape (n, number_of_features) of all subjects."""
+        if self._features is None:
+            return np.empty((0, self.number_of_features or 0), np.float32)
+        return self._features[:self.size]
+
+    @property
+    def labels(self) -> np.ndarray:
+        """np.ndarray: The memory-mapped labels of shape (n,) of all subjects."""
+        if self._labels is None:
+            return np.empty((0,), np.int16)
+        return self._labels[:self.size]
+
+    def __contains__(self, id_: str) -> bool:
+        return id_ in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def append(self, id_: str, features: np.ndarray, labels: np.ndarray) -> t.Tuple[int, int]:
+        """Appends the features and labels of a subject.
+
+        Args:
+            id_ (str): The subject identifier.
+            features (np.ndarray): The features of shape (n, number_of_features).
+            labels (np.ndarray): The labels of shape (n,) or (n, 1).
+
+        Returns:
+            tuple: The rows (start, stop) of the subject.
+
+        Raises:
+            ValueError: If the subject has already been appended or the number of features differs.
+        """
+        with self.lock:
+            if id_ in self.index:
+                raise ValueError('Subject {} has already been appended'.format(id_))
+            if self.number_of_features is None:
+                self.number_of_features = features.shape[1]
+            elif features.shape[1] != self.number_of_features:
+                raise ValueError('Expected {} features but got {}'.format(self.number_of_features, features.shape[1]))
+
+            start, stop = self.size, self.size + features.shape[0]
+            if stop > self.capacity:
+                self._grow(stop)
+            self._features[start:stop] = features
+            self._labels[start:stop] = labels.reshape(-1)
+            self._features.flush()
+            self._labels.flush()
+
+            self.index[id_] = (start, stop)
+            self.size = stop
+            self._save_index()
+            return start, stop
+
+    def get(self, id_: str) -> t.Tuple[np.ndarray, np.ndarray]:
+        """Gets the features and labels of a subject.
+
+        Args:
+            id_ (str): The subject identifier.
+
+        Returns:
+            tuple: The memory-mapped features and labels.
+        """
+        start, stop = self.index[id_]
+        return self._features[start:stop], self._labels[start:stop]
+
+    def _grow(self, min_capacity: int):
+        """Increases the capacity to at least ``min_capacity`` rows."""
+        capacity = max(self.capacity, self.initial_capacity)
+        while capacity < min_capacity:
+            capacity *= 2
+
+        # release the current maps before resizing the files
+        self._features = self._labels = None
+        for file_name, row_size in ((self.FEATURES_FILE, 4 * self.number_of_features), (self.LABELS_FILE, 2)):
+            with open(os.path.join(self.store_dir, file_name), 'ab') as f:
+                f.truncate(capacity * row_size)
+        self.capacity = capacity
+        self._map()
+
+    def _map(self):
+        """Maps the files into memory."""
+        self._features = np.memmap(os.path.join(self.store_dir, self.FEATURES_FILE), np.float32, 'r+',
+                                   shape=(self.capacity, self.number_of_features))
+        self._labels = np.memmap(os.path.join(self.store_dir, self.LABELS_FILE), np.int16, 'r+',
+                                 shape=(self.capacity,))
+
+    def _save_index(self):
+        """Saves the index atomically."""
+        index_file = os.path.join(self.store_dir, self.INDEX_FILE)
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump({'index': list(self.index.items()), 'size': self.size, 'capacity': self.capacity,
+                       'number_of_features': self.number_of_features}, f)
+        os.replace(index_file + '.tmp', index_file)
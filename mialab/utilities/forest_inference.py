@@ -0,0 +1,184 @@
+"""This module contains an inference engine evaluating the labels and probabilities of a decision forest at once.
+
+The trees of a trained forest (e.g., a :class:`sklearn.ensemble.RandomForestClassifier`) are exported into contiguous
+node arrays. The samples are predicted in slabs by several threads, where each slab is passed once through every tree
+and the float32 class distributions of the reached leaves are accumulated.
+"""
+import concurrent.futures as futures
+import os
+import typing as t
+
+import numpy as np
+
+
+class FlatForest:
+    """Represents a decision forest classifier exported into contiguous node arrays.
+
+    The nodes of all trees are concatenated tree by tree, i.e. the nodes of tree ``i`` are at
+    ``offsets[i]:offsets[i + 1]``, with
+
+        - ``feature``: the feature index of the split nodes,
+        - ``threshold``: the float32 threshold of the split nodes (samples with ``x <= threshold`` go left),
+        - ``children``: the global indices of the left and right child (-1 for leaves),
+        - ``values``: the float32 class distribution of the leaves.
+
+    The thresholds are rounded down to float32, such that the float32 features take the same decisions as with the
+    float64 thresholds of scikit-learn. The trees are traversed by the compiled ``apply`` of the scikit-learn trees
+    (``'compiled'``, which releases the GIL) or by moving all samples of a slab level by level through the node
+    arrays (``'flat'``). The features must not contain missing values.
+
+    A pickled engine contains the node arrays but not the scikit-learn trees, which are pickled with the forest.
+    Call :meth:`attach` with the forest after unpickling for the ``'compiled'`` traversal.
+
+    The labels are identical to :meth:`sklearn.ensemble.RandomForestClassifier.predict` (summing the tree
+    probabilities in the order of the trees): the samples whose two most probable classes are closer than the float32
+    rounding error are recomputed in float64 like scikit-learn.
+    """
+
+    TRAVERSALS = ('compiled', 'flat')  #: The supported tree traversals.
+
+    def __init__(self, forest, traversal: str = 'compiled'):
+        """Initializes a new instance of the FlatForest class.
+
+        Args:
+            forest: The fitted forest with the ``estimators_`` (single-output decision tree classifiers) and
+                ``classes_``.
+            traversal (str): The tree traversal, either ``'compiled'`` or ``'flat'``.
+
+        Raises:
+            ValueError: If the traversal is unknown or the forest has several outputs.
+        """
+        if traversal not in self.TRAVERSALS:
+            raise ValueError('Unknown traversal {}, expected one of {}'.format(traversal, self.TRAVERSALS))
+        if getattr(forest, 'n_outputs_', 1) != 1:
+            raise ValueError('Only forests with a single output are supported')
+
+        self.traversal = traversal
+        self.classes = forest.classes_
+        self.trees = [estimator.tree_ for estimator in forest.estimators_]
+        self.no_trees = len(self.trees)
+        self.no_classes = len(self.classes)
+
+        self.offsets = np.cumsum([0] + [tree.node_count for tree in self.trees])
+        no_nodes = self.offsets[-1]
+        self.feature = np.zeros(no_nodes, np.intp)
+        self.threshold = np.zeros(no_nodes, np.float32)
+        self.children = np.full((no_nodes, 2), -1, np.intp)
+        self.values64 = np.zeros((no_nodes, self.no_classes), np.float64)  # for the samples with tied classes
+
+        for offset, tree in zip(self.offsets, self.trees):
+            nodes = slice(offset, offset + tree.node_count)
+            split = tree.children_left >= 0
+            self.feature[nodes] = np.where(split, tree.feature, 0)
+            threshold = tree.threshold.astype(np.float32)
+            self.threshold[nodes] = np.where(threshold > tree.threshold,
+                                             np.nextafter(threshold, np.float32(-np.inf)), threshold)
+            self.children[nodes] = np.where(split[:, np.newaxis],
+                                            np.stack([tree.children_left, tree.children_right], axis=1) + offset, -1)
+            self.values64[nodes] = tree.value[:, 0, :self.no_classes]
+        # the values are weighted sample counts before scikit-learn 1.4 and fractions since, they are normalized
+        # like DecisionTreeClassifier.predict_proba
+        normalizer = self.values64.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        self.values64 /= normalizer
+        self.values = self.values64.astype(np.float32)
+        self.is_leaf = self.children[:, 0] < 0
+
+        # upper bound of the difference between the float32 and float64 sums of the tree probabilities,
+        # which are at most one each
+        self.tolerance = 2 * self.no_trees * self.no_trees * np.finfo(np.float32).eps
+
+    def attach(self, forest):
+        """Attaches the scikit-learn trees of the forest, from which the engine has been exported, after unpickling.
+
+        Args:
+            forest: The forest (see :meth:`__init__`).
+        """
+        self.trees = [estimator.tree_ for estimator in forest.estimators_]
+
+    def __getstate__(self):
+        # the trees are pickled with the forest (see attach)
+        state = self.__dict__.copy()
+        state['trees'] = None
+        return state
+
+    def predict(self, data: np.ndarray, number_of_threads: int = None,
+                slab_size: int = 2 ** 16) -> t.Tuple[np.ndarray, np.ndarray]:
+        """Predicts the labels and probabilities of samples.
+
+        Args:
+            data (np.ndarray): The features of shape (n, number_of_features).
+            number_of_threads (int): The number of threads (default: number of CPUs).
+            slab_size (int): The number of samples per slab.
+
+        Returns:
+            tuple: The labels of shape (n,) and the float32 probabilities of shape (n, number_of_classes).
+        """
+        number_of_threads = number_of_threads or os.cpu_count() or 1
+        labels = np.empty(data.shape[0], self.classes.dtype)
+        probabilities = np.empty((data.shape[0], self.no_classes), np.float32)
+
+        slabs = [slice(start, min(start + slab_size, data.shape[0])) for start in range(0, data.shape[0], slab_size)]
+        if number_of_threads == 1 or len(slabs) <= 1:
+            for slab in slabs:
+                self._predict_slab(data, slab, labels, probabilities)
+        else:
+            with futures.ThreadPoolExecutor(min(number_of_threads, len(slabs))) as executor:
+                for future in [executor.submit(self._predict_slab, data, slab, labels, probabilities)
+                               for slab in slabs]:
+                    future.result()
+        return labels, probabilities
+
+    def apply(self, data: np.ndarray, tree: int) -> np.ndarray:
+        """Gets the leaves reached by samples in a tree.
+
+        Args:
+            data (np.ndarray): The float32 features of shape (n, number_of_features).
+            tree (int): The tree index.
+
+        Returns:
+            np.ndarray: The global node indices of the leaves.
+        """
+        if self.traversal == 'compiled':
+            return self.trees[tree].apply(data) + self.offsets[tree]
+
+        nodes = np.full(data.shape[0], self.offsets[tree], np.intp)
+        rows = np.arange(data.shape[0])
+        leaves = np.empty(data.shape[0], np.intp)
+        while True:
+            is_leaf = self.is_leaf[nodes]
+            if is_leaf.any():
+                leaves[rows[is_leaf]] = nodes[is_leaf]
+                rows, nodes = rows[~is_leaf], nodes[~is_leaf]
+            if not rows.size:
+                return leaves
+            go_right = data[rows, self.feature[nodes]] > self.threshold[nodes]
+            nodes = self.children[nodes, go_right.view(np.int8)]
+
+    def _predict_slab(self, data: np.ndarray, slab: slice, labels: np.ndarray, probabilities: np.ndarray):
+        """Predicts the labels and probabilities of a slab of samples."""
+        data = np.ascontiguousarray(data[slab], dtype=np.float32)
+
+        sums = np.zeros((data.shape[0], self.no_classes), np.float32)
+        for tree in range(self.no_trees):
+            sums += self.values.take(self.apply(data, tree), axis=0)
+        indices = sums.argmax(axis=1)
+
+        # recompute the samples with (nearly) tied classes in float64 like scikit-learn
+        if self.no_classes > 1:
+            top_two = np.partition(sums, -2, axis=1)[:, -2:]
+            ties = np.flatnonzero(top_two[:, 1] - top_two[:, 0] <= self.tolerance)
+        else:
+            ties = np.empty(0, np.intp)
+
+        sums /= self.no_trees
+        if ties.size:
+            sums64 = np.zeros((ties.size, self.no_classes), np.float64)
+            for tree in range(self.no_trees):
+                sums64 += self.values64.take(self.apply(data[ties], tree), axis=0)
+            sums64 /= self.no_trees
+            indices[ties] = sums64.argmax(axis=1)
+            sums[ties] = sums64
+
+        labels[slab] = self.classes.take(indices)
+        probabilities[slab] = sums
@@ -0,0 +1,140 @@
+"""This module contains the uncertainty-driven mining of hard training examples.
+
+The training is done in two rounds: a small forest is fitted on a small sample of each subject (a fixed number of
+voxels per label), and scores a larger pool of candidate voxels inside the brain mask of each subject. The candidates
+with the highest predictive entropy or misclassification are added to the small sample, up to a budget per subject,
+and the classifier is fitted on this compact training set instead of the (larger) default training sample.
+"""
+import typing as t
+import zlib
+
+import numpy as np
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.filtering.feature_extraction as fltr_feat
+import mialab.utilities.feature_store as fstore
+import mialab.utilities.pipeline_utilities as putil
+
+CRITERIA = ('entropy', 'misclassification')  #: The criteria to score the candidates.
+
+DEFAULT_PARAMS = {'sample_counts': [100, 100, 100, 50, 50, 50],  # the voxels per label of the first round sample
+                  'n_estimators': 5,  # the trees of the first round forest
+                  'max_depth': 10,  # the maximum depth of the first round trees
+                  'candidate_fraction': 0.1,  # the fraction of the brain mask voxels (except the sample) to score
+                  'budget': 1000,  # the maximum number of hard examples per subject
+                  'criterion': 'entropy'}  #: The default parameters of the hard example mining.
+
+
+def get_pre_process_params(pre_process_params: dict, sample_counts: t.List[int]) -> dict:
+    """Gets the pre-processing parameters of the training images, which extract the features of the brain mask
+    voxels and of the first round sample (see the ``training_sample`` parameter of :class:`FeatureExtractor
+    <mialab.utilities.pipeline_utilities.FeatureExtractor>`).
+
+    Args:
+        pre_process_params (dict): The pre-processing parameters.
+        sample_counts (List[int]): The number of voxels per label of the first round sample.
+
+    Returns:
+        dict: The pre-processing parameters.
+    """
+    return dict(pre_process_params, training=False, brain_mask_inference=True, training_sample=True,
+                training_label_counts=list(sample_counts))
+
+
+def split_candidates(img: structure.BrainImage, sampling_seed: int = None, candidate_fraction: float = 1.0,
+                     sample_counts: t.List[int] = None) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Splits a feature matrix extracted with the parameters of :func:`get_pre_process_params` into the first round
+    sample and the candidates, i.e. the other voxels of the brain mask.
+
+    Both are drawn by :class:`StratifiedVoxelSampler <mialab.filtering.feature_extraction.StratifiedVoxelSampler>`,
+    the sampler of the :class:`RandomizedTrainingMaskGenerator
+    <mialab.filtering.feature_extraction.RandomizedTrainingMaskGenerator>`.
+
+    Args:
+        img (structure.BrainImage): The image with the ground truth and the feature matrix.
+        sampling_seed (int): The sampling seed of the pre-processing.
+        candidate_fraction (float): The fraction of the other voxels of each label randomly drawn as candidates.
+        sample_counts (List[int]): The number of voxels per label of the first round sample.
+
+    Returns:
+        tuple: The sorted rows of the training sample and of the candidates.
+    """
+    ground_truth = img.images[structure.BrainImageTypes.GroundTruth]
+    no_rows = img.feature_matrix[0].shape[0]
+    indices = img.feature_indices if img.feature_indices is not None else np.arange(no_rows)
+    sample = np.searchsorted(indices, putil.FeatureExtractor.get_training_indices(img, sampling_seed, sample_counts))
+
+    # the candidates are sampled per label with the same sampler as the first round sample among the other voxels,
+    # i.e. the brain mask voxels which are not in the sample
+    mask = np.zeros(ground_truth.GetSize()[::-1], dtype=np.uint8)
+    mask.flat[indices] = 1
+    mask.flat[indices[sample]] = 0
+    background_mask = sitk.GetImageFromArray(mask)
+    background_mask.CopyInformation(ground_truth)
+
+    labels = np.unique(img.feature_matrix[1]).tolist()
+    sampler = fltr_feat.StratifiedVoxelSampler(labels, [candidate_fraction] * len(labels))
+    seed = None
+    if sampling_seed is not None:
+        # distinct from the seed of the training sample, see FeatureExtractor.get_training_indices
+        seed = np.random.SeedSequence(sampling_seed, spawn_key=(zlib.crc32(img.id_.encode()), 1))
+    candidates = np.searchsorted(indices, sampler.get_indices(ground_truth, background_mask, seed))
+    return sample, candidates
+
+
+def get_scores(probabilities: np.ndarray, labels: np.ndarray, classes: np.ndarray, criterion: str) -> np.ndarray:
+    """Scores the candidates, where a higher score means a harder example.
+
+    Args:
+        probabilities (np.ndarray): The predicted probabilities of shape (n, number_of_classes).
+        labels (np.ndarray): The labels of shape (n,) or (n, 1).
+        classes (np.ndarray): The sorted class labels of the probabilities.
+        criterion (str): ``'entropy'`` for the predictive entropy or ``'misclassification'`` for one minus the
+            probability of the true label (i.e., misclassified voxels score higher than correctly classified ones).
+
+    Returns:
+        np.ndarray: The scores of shape (n,).
+
+    Raises:
+        ValueError: If the criterion is unknown.
+    """
+    if criterion == 'entropy':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return -np.sum(np.where(probabilities > 0, probabilities * np.log(probabilities), 0), axis=1)
+    if criterion == 'misclassification':
+        labels = labels.reshape(-1)
+        columns = np.minimum(np.searchsorted(classes, labels), len(classes) - 1)
+        known = classes[columns] == labels  # labels unknown to the classifier have probability zero
+        return 1 - np.where(known, probabilities[np.arange(labels.size), columns], 0)
+    raise ValueError('Unknown criterion {}, expected one of {}'.format(criterion, CRITERIA))
+
+
+def mine_hard_examples(classifier, sample_store: fstore.TrainingFeatureStore,
+                       candidate_store: fstore.TrainingFeatureStore, budget: int,
+                       criterion: str = 'entropy') -> t.Tuple[np.ndarray, np.ndarray]:
+    """Mines the hard examples of the candidates of each subject and adds them to the first round sample.
+
+    Args:
+        classifier: The classifier fitted on the first round sample (see :class:`Classifier
+            <mialab.utilities.classifier.Classifier>`).
+        sample_store (fstore.TrainingFeatureStore): The first round sample of the subjects.
+        candidate_store (fstore.TrainingFeatureStore): The candidates of the subjects.
+        budget (int): The maximum number of hard examples per subject.
+        criterion (str): The criterion to score the candidates (see :func:`get_scores`).
+
+    Returns:
+        tuple: The features and labels of the first round samples and hard examples of all subjects in the order of
+        the sample store.
+    """
+    features, labels = [], []
+    for id_ in sample_store.index:
+        candidate_features, candidate_labels = candidate_store.get(id_)
+        probabilities = classifier.predict(candidate_features)[1]
+        scores = get_scores(probabilities, candidate_labels, classifier.classes, criterion)
+        rows = np.sort(np.argsort(-scores, kind='stable')[:budget])
+
+        sample_features, sample_labels = sample_store.get(id_)
+        features += [sample_features, candidate_features[rows]]
+        labels += [sample_labels, candidate_labels[rows]]
+    return np.concatenate(features), np.concatenate(labels)
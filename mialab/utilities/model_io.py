@@ -0,0 +1,53 @@
+"""This module contains the persistence of trained models.
+
+A model is saved together with its feature layout and pre-processing parameters, such that predict-only runs
+pre-process new images exactly as the training images.
+"""
+import typing as t
+
+import joblib
+
+MODEL_VERSION = 3  #: Increase when the content of the model files changes.
+
+
+def save_model(path: str, model, feature_names: t.List[str], pre_process_params: dict):
+    """Saves a trained model.
+
+    The model is saved uncompressed, such that its numpy arrays can be memory-mapped when loading.
+
+    Args:
+        path (str): The model file path (e.g., ``model.joblib``).
+        model: The trained model, e.g. a :class:`Classifier <mialab.utilities.classifier.Classifier>`.
+        feature_names (List[str]): The names of the features in the order of the feature matrix columns
+            (see :meth:`FeatureExtractor.get_feature_names
+            <mialab.utilities.pipeline_utilities.FeatureExtractor.get_feature_names>`).
+        pre_process_params (dict): The pre-processing parameters used for the training.
+    """
+    joblib.dump({'version': MODEL_VERSION,
+                 'model': model,
+                 'feature_names': list(feature_names),
+                 'pre_process_params': dict(pre_process_params)}, path)
+
+
+def load_model(path: str, mmap_mode: str = 'r') -> t.Tuple[object, t.List[str], dict]:
+    """Loads a trained model.
+
+    Args:
+        path (str): The model file path.
+        mmap_mode (str): The memory-map mode of the numpy arrays (see :func:`joblib.load`). Use None to load the
+            arrays into memory. The arrays stored as numpy attributes stay memory-mapped and are shared through the
+            page cache with other processes loading the same file, e.g. the node arrays of the :class:`FlatForest
+            <mialab.utilities.forest_inference.FlatForest>` of the forests and the nodes of the gradient boosting
+            predictors. scikit-learn copies the nodes of its decision trees into memory when unpickling, which are
+            only used by the ``'compiled'`` traversal and to add trees.
+
+    Returns:
+        tuple: The model, the feature names and the pre-processing parameters.
+
+    Raises:
+        ValueError: If the file has not been saved by :func:`save_model` of this version.
+    """
+    content = joblib.load(path, mmap_mode=mmap_mode)
+    if not isinstance(content, dict) or content.get('version') != MODEL_VERSION:
+        raise ValueError('{} is not a model file of version {}'.format(path, MODEL_VERSION))
+    return content['model'], content['feature_names'], content['pre_process_params']
@@ -1,5 +1,10 @@
 """Module for the management of multi-process function calls."""
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+import os
+import queue
 import typing as t
+import uuid
 
 import numpy as np
 import SimpleITK as sitk
@@ -44,6 +49,9 @@ class PicklableBrainImage:
         self.feature_matrix = None  # a tuple (features, labels),
         # where the shape of features is (n, number_of_features) and the shape of labels is (n, 1)
         # with n being the amount of voxels
+        self.feature_indices = None
+        self.full_image_properties = None
+        self.roi_index = None
         self.pickable_transform = PicklableAffineTransform(transform)
 
 
@@ -51,11 +59,15 @@ class BrainImageToPicklableBridge:
     """A :class:`BrainImage <data.structure.BrainImage>` to :class:`PicklableBrainImage` bridge."""
 
     @staticmethod
-    def convert(brain_image: structure.BrainImage) -> PicklableBrainImage:
+    def convert(brain_image: structure.BrainImage, image_types: t.Iterable[structure.BrainImageTypes] = None,
+                feature_matrix: bool = True) -> PicklableBrainImage:
         """Converts a :class:`BrainImage <data.structure.BrainImage>` to :class:`PicklableBrainImage`.
 
         Args:
             brain_image (BrainImage): A brain image.
+            image_types (Iterable[BrainImageTypes]): The types of the images to convert. All images and feature
+                images are converted if None, otherwise only the images of the given types (and no feature images).
+            feature_matrix (bool): Whether to convert the feature matrix (and the feature indices).
 
         Returns:
             PicklableBrainImage: The pickable brain image.
@@ -63,16 +75,23 @@ class BrainImageToPicklableBridge:
 
         np_images = {}
         for key, img in brain_image.images.items():
-            np_images[key] = sitk.GetArrayFromImage(img)
+            if image_types is None or key in image_types:
+                np_images[key] = sitk.GetArrayFromImage(img)
         np_feature_images = {}
-        for key, feat_img in brain_image.feature_images.items():
-            np_feature_images[key] = sitk.GetArrayFromImage(feat_img)
+        if image_types is None:
+            for key, feat_img in brain_image.feature_images.items():
+                np_feature_images[key] = sitk.GetArrayFromImage(feat_img)
 
         pickable_brain_image = PicklableBrainImage(brain_image.id_, brain_image.path, np_images,
                                                    brain_image.image_properties,
                                                    brain_image.transformation)
         pickable_brain_image.np_feature_images = np_feature_images
-        pickable_brain_image.feature_matrix = brain_image.feature_matrix
+        if feature_matrix and brain_image.feature_matrix is not None:
+            # memory-mapped arrays (e.g., from the feature matrix cache) are pickled as plain arrays
+            pickable_brain_image.feature_matrix = tuple(np.asarray(m) for m in brain_image.feature_matrix)
+            pickable_brain_image.feature_indices = brain_image.feature_indices
+        pickable_brain_image.full_image_properties = brain_image.full_image_properties
+        pickable_brain_image.roi_index = brain_image.roi_index
 
         return pickable_brain_image
 
@@ -102,8 +121,12 @@ class PicklableToBrainImageBridge:
 
         transform = picklable_brain_image.pickable_transform.get_sitk_transformation()
 
-        brain_image = structure.BrainImage(picklable_brain_image.id_, picklable_brain_image.path, images, transform)
+        brain_image = structure.BrainImage(picklable_brain_image.id_, picklable_brain_image.path, images, transform,
+                                           picklable_brain_image.image_properties)
         brain_image.feature_matrix = picklable_brain_image.feature_matrix
+        brain_image.feature_indices = picklable_brain_image.feature_indices
+        brain_image.full_image_properties = picklable_brain_image.full_image_properties
+        brain_image.roi_index = picklable_brain_image.roi_index
         return brain_image
 
 
@@ -164,6 +187,16 @@ class DefaultPickleHelper:
 class PreProcessingPickleHelper(DefaultPickleHelper):
     """Pre-processing pickle helper class"""
 
+    def __init__(self, image_types: t.Iterable[structure.BrainImageTypes] = None):
+        """Initializes a new instance of the PreProcessingPickleHelper class.
+
+        Args:
+            image_types (Iterable[BrainImageTypes]): The types of the images to transfer back to the original process
+                in addition to the feature matrix, e.g. only the ground truth for the evaluation. All images are
+                transferred if None.
+        """
+        self.image_types = image_types
+
     def make_return_value_picklable(self, ret_val: structure.BrainImage) -> PicklableBrainImage:
         """Ensures that all pre-processing return values ``ret_val`` can be pickled before transferring back to
         the original process.
@@ -175,7 +208,7 @@ class PreProcessingPickleHelper(DefaultPickleHelper):
             PicklableBrainImage: The modified pre-processing return values.
         """
 
-        return BrainImageToPicklableBridge.convert(ret_val)
+        return BrainImageToPicklableBridge.convert(ret_val, self.image_types)
 
     def recover_return_value(self, ret_val: PicklableBrainImage) -> structure.BrainImage:
         """Recovers (from the pickle state) the original pre-processing return values.
@@ -192,6 +225,15 @@ class PreProcessingPickleHelper(DefaultPickleHelper):
 class PostProcessingPickleHelper(DefaultPickleHelper):
     """Post-processing pickle helper class"""
 
+    def __init__(self, image_types: t.Iterable[structure.BrainImageTypes] = None):
+        """Initializes a new instance of the PostProcessingPickleHelper class.
+
+        Args:
+            image_types (Iterable[BrainImageTypes]): The types of the images to transfer to the other process,
+                e.g. the T1w and T2w images for the CRF post-processing. All images are transferred if None.
+        """
+        self.image_types = image_types
+
     def make_params_picklable(self, params: t.Tuple[structure.BrainImage, sitk.Image, sitk.Image, dict]):
         """Ensures that all post-processing parameters can be pickled before transferred to the new process.
 
@@ -202,7 +244,8 @@ class PostProcessingPickleHelper(DefaultPickleHelper):
             tuple: The modified post-processing parameters.
         """
         brain_img, segmentation, probability, fn_kwargs = params
-        picklable_brain_image = BrainImageToPicklableBridge.convert(brain_img)
+        # the post-processing does not require the feature matrix
+        picklable_brain_image = BrainImageToPicklableBridge.convert(brain_img, self.image_types, feature_matrix=False)
         np_segmentation, _ = conversion.SimpleITKNumpyImageBridge.convert(segmentation)
         np_probability, _ = conversion.SimpleITKNumpyImageBridge.convert(probability)
         return picklable_brain_image, np_segmentation, np_probability, fn_kwargs
@@ -249,44 +292,374 @@ class PostProcessingPickleHelper(DefaultPickleHelper):
         return conversion.NumpySimpleITKImageBridge.convert(np_img, image_properties)
 
 
+class SharedArray:
+    """Represents a descriptor of a numpy array in a named shared memory block.
+
+    Only the descriptor (name, shape and dtype) is pickled, the data is transferred through the shared memory.
+    The block is created by the sending process and unlinked by the receiving process when it converts the
+    descriptor back to an array.
+    """
+
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        """Initializes a new instance of the SharedArray class.
+
+        Args:
+            name (str): The name of the shared memory block.
+            shape (tuple): The array shape.
+            dtype (str): The array data type.
+        """
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @staticmethod
+    def from_array(array: np.ndarray, prefix: str) -> 'SharedArray':
+        """Copies an array into a new shared memory block.
+
+        Args:
+            array (np.ndarray): The array.
+            prefix (str): The prefix of the block name.
+
+        Returns:
+            SharedArray: The descriptor of the shared array.
+        """
+        name = '{}_{}'.format(prefix, uuid.uuid4().hex[:12])
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, array.nbytes))
+        try:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        except BaseException:
+            shm.unlink()
+            raise
+        finally:
+            shm.close()
+        return SharedArray(name, array.shape, array.dtype.str)
+
+    def to_array(self) -> np.ndarray:
+        """Copies the shared array into a new array and releases the shared memory block.
+
+        Returns:
+            np.ndarray: The array.
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        return array
+
+
+class SharedMemoryPickleHelper(DefaultPickleHelper):
+    """Pickle helper transferring the numpy arrays through shared memory.
+
+    Wraps another pickle helper and replaces the numpy arrays in its picklable parameters and return values
+    (also inside tuples, lists, dicts and :class:`PicklableBrainImage`) by :class:`SharedArray` descriptors.
+    """
+
+    MIN_SIZE = 64 * 1024  #: The minimum array size in bytes to transfer through shared memory.
+
+    def __init__(self, pickle_helper: DefaultPickleHelper, prefix: str):
+        """Initializes a new instance of the SharedMemoryPickleHelper class.
+
+        Args:
+            pickle_helper (DefaultPickleHelper): The wrapped pickle helper.
+            prefix (str): The prefix of the shared memory block names.
+        """
+        self.pickle_helper = pickle_helper
+        self.prefix = prefix
+
+    def make_params_picklable(self, params):
+        """See :meth:`DefaultPickleHelper.make_params_picklable`."""
+        return self._share(self.pickle_helper.make_params_picklable(params))
+
+    def recover_params(self, params):
+        """See :meth:`DefaultPickleHelper.recover_params`."""
+        return self.pickle_helper.recover_params(self._unshare(params))
+
+    def make_return_value_picklable(self, ret_val):
+        """See :meth:`DefaultPickleHelper.make_return_value_picklable`."""
+        return self._share(self.pickle_helper.make_return_value_picklable(ret_val))
+
+    def recover_return_value(self, ret_val):
+        """See :meth:`DefaultPickleHelper.recover_return_value`."""
+        return self.pickle_helper.recover_return_value(self._unshare(ret_val))
+
+    def _share(self, value):
+        """Replaces the numpy arrays in a value by shared arrays."""
+        if isinstance(value, np.ndarray):
+            if value.nbytes < SharedMemoryPickleHelper.MIN_SIZE or value.dtype.hasobject:
+                return value
+            return SharedArray.from_array(value, self.prefix)
+        return SharedMemoryPickleHelper._map(value, self._share)
+
+    def _unshare(self, value):
+        """Replaces the shared arrays in a value by numpy arrays."""
+        if isinstance(value, SharedArray):
+            return value.to_array()
+        return SharedMemoryPickleHelper._map(value, self._unshare)
+
+    @staticmethod
+    def _map(value, fn):
+        """Applies a function to the items of a container value."""
+        if isinstance(value, tuple):
+            return tuple(fn(item) for item in value)
+        if isinstance(value, list):
+            return [fn(item) for item in value]
+        if isinstance(value, dict):
+            return {key: fn(item) for key, item in value.items()}
+        if isinstance(value, PicklableBrainImage):
+            value.np_images = fn(value.np_images)
+            value.np_feature_images = fn(value.np_feature_images)
+            value.feature_matrix = fn(value.feature_matrix)
+            value.feature_indices = fn(value.feature_indices)
+        return value
+
+
+def _release_shared_memory(prefix: str):
+    """Releases all shared memory blocks with a name prefix, e.g. left behind by a crashed worker.
+
+    Args:
+        prefix (str): The prefix of the shared memory block names.
+    """
+    shm_dir = '/dev/shm'  # the shared memory blocks can only be listed on Linux
+    if not os.path.isdir(shm_dir):
+        return
+    for name in os.listdir(shm_dir):
+        if name.startswith(prefix):
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def init_worker(threads: int, initializer: callable = None, initargs: tuple = ()):
+    """Initializes a worker process of a :class:`WorkerPool` (or another pool).
+
+    Args:
+        threads (int): The number of SimpleITK and BLAS threads of the worker process.
+        initializer (callable): A function called after the initialization.
+        initargs (tuple): The arguments of the ``initializer``.
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    try:
+        import threadpoolctl
+        threadpoolctl.threadpool_limits(threads)
+    except ImportError:
+        # only effective for BLAS libraries loaded after the initialization
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ[var] = str(threads)
+
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_tasks(fn: callable, pickle_helper_cls: callable, shared_memory_prefix: str, params_list: list):
+    """Executes the function ``fn`` for a chunk of parameters in a worker process of a :class:`WorkerPool`.
+
+    The function and the pickle helper class are module-level objects and are therefore pickled by reference
+    (the pickle helper class might also be a :func:`functools.partial` of a class).
+    """
+    # create instance due to possible race condition (not sure if really possible)
+    helper = pickle_helper_cls()
+    if shared_memory_prefix is not None:
+        helper = SharedMemoryPickleHelper(helper, shared_memory_prefix)
+
+    ret_vals = []
+    for params in params_list:
+        params = helper.recover_params(params)
+        params, shared_params = params[:-1], params[-1]
+        ret_val = fn(*params, **shared_params)
+        ret_vals.append(helper.make_return_value_picklable(ret_val))
+    return ret_vals
+
+
+class WorkerPool:
+    """Represents a persistent pool of worker processes, which can be shared among several
+    :meth:`MultiProcessor.run` calls.
+
+    Other pools (e.g., :class:`WorkQueuePool <mialab.utilities.work_queue.WorkQueuePool>`) provide the attributes
+    ``processes``, ``chunksize`` and ``supports_shared_memory`` and the methods :meth:`apply_async`, :meth:`close`
+    and :meth:`terminate`.
+
+    Examples:
+        >>> with WorkerPool(processes=4, threads=2) as pool:
+        >>>     images = MultiProcessor.run(pre_process, params, pool=pool)
+        >>>     images = MultiProcessor.run(post_process, params, pool=pool)
+    """
+
+    def __init__(self, processes: int = None, chunksize: int = 1, maxtasksperchild: int = None, threads: int = None,
+                 initializer: callable = None, initargs: tuple = ()):
+        """Initializes a new instance of the WorkerPool class.
+
+        Args:
+            processes (int): The number of worker processes. Defaults to the number of CPUs.
+            chunksize (int): The number of function calls sent to a worker process at once.
+            maxtasksperchild (int): The number of chunks a worker process executes before it is replaced by a new
+                process (None means the worker processes live as long as the pool).
+            threads (int): The number of SimpleITK and BLAS threads of each worker process. Defaults to the number
+                of CPUs divided by the number of worker processes, such that the CPUs are not oversubscribed.
+            initializer (callable): A function called once in each worker process after its creation,
+                e.g. to load data required by all function calls.
+            initargs (tuple): The arguments of the ``initializer``.
+        """
+        self.processes = processes if processes is not None else (os.cpu_count() or 1)
+        self.chunksize = chunksize
+        self.threads = threads if threads is not None else max(1, (os.cpu_count() or 1) // self.processes)
+
+        # start the resource tracker before forking such that all processes share it (see SharedMemoryPickleHelper)
+        resource_tracker.ensure_running()
+        self.pool = pmp.Pool(self.processes, init_worker, (self.threads, initializer, initargs), maxtasksperchild)
+
+    supports_shared_memory = True  #: Whether the processes can exchange data through shared memory.
+
+    def apply_async(self, fn: callable, args: tuple, callback: callable = None, error_callback: callable = None):
+        """Submits a function call to the worker processes.
+
+        Args:
+            fn (callable): The function.
+            args (tuple): The arguments of the function.
+            callback (callable): Called with the return value when the call completes.
+            error_callback (callable): Called with the exception when the call fails.
+
+        Returns:
+            An object with the methods ``get()`` returning the return value (or raising the exception)
+            and ``wait()`` (see :class:`multiprocessing.pool.AsyncResult`).
+        """
+        return self.pool.apply_async(fn, args, callback=callback, error_callback=error_callback)
+
+    def close(self):
+        """Waits for the submitted function calls and terminates the worker processes."""
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """Terminates the worker processes immediately."""
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
 class MultiProcessor:
     """Class managing multiprocessing"""
 
     @staticmethod
-    def run(fn: callable, param_list: iter, fn_kwargs: dict = None, pickle_helper_cls: type = DefaultPickleHelper):
+    def run(fn: callable, param_list: iter, fn_kwargs: dict = None, pickle_helper_cls: type = DefaultPickleHelper,
+            shared_memory_transport: bool = False, pool: WorkerPool = None):
         """ Executes the function ``fn`` in parallel (different processes) for each parameter in the parameter list.
 
         Args:
             fn (callable): Function to be executed in another process.
             param_list (List[tuple]): List containing the parameters for each ``fn`` call.
             fn_kwargs (dict): kwargs for the ``fn`` function call.
-            pickle_helper_cls: Class responsible for the pickling of the parameters
+            pickle_helper_cls: Class responsible for the pickling of the parameters (or a callable creating an
+                instance, e.g. a :func:`functools.partial` of a class with arguments).
+            shared_memory_transport (bool): Whether to transfer the numpy arrays of the parameters and return values
+                through shared memory instead of pickling them (see :class:`SharedMemoryPickleHelper`).
+            pool (WorkerPool): The worker pool. A temporary pool with the default settings is used if None.
 
         Returns:
             list: A list of all return values of the ``fn`` calls
         """
+        return [ret_val for _, ret_val in MultiProcessor.run_iter(fn, param_list, fn_kwargs, pickle_helper_cls,
+                                                                  shared_memory_transport, pool=pool)]
+
+    @staticmethod
+    def run_iter(fn: callable, param_list: iter, fn_kwargs: dict = None, pickle_helper_cls: type = DefaultPickleHelper,
+                 shared_memory_transport: bool = False, ordered: bool = True, max_in_flight: int = None,
+                 pool: WorkerPool = None):
+        """ Executes the function ``fn`` in parallel (different processes) for each parameter in the parameter list
+        and yields the return values as they become available.
+
+        At most ``max_in_flight`` parameters are submitted to the processes at the same time, such that the memory
+        consumption depends on the number of processes and not on the number of parameters, as long as the caller
+        consumes the return values.
+
+        Args:
+            fn (callable): Function to be executed in another process.
+            param_list (iter): Iterable containing the parameters for each ``fn`` call. It is consumed lazily.
+            fn_kwargs (dict): kwargs for the ``fn`` function call.
+            pickle_helper_cls: Class responsible for the pickling of the parameters (or a callable creating an
+                instance, e.g. a :func:`functools.partial` of a class with arguments).
+            shared_memory_transport (bool): Whether to transfer the numpy arrays of the parameters and return values
+                through shared memory instead of pickling them (see :class:`SharedMemoryPickleHelper`).
+            ordered (bool): Whether to yield the return values in the order of the parameters or as they complete.
+            max_in_flight (int): The maximum number of submitted but not yet yielded calls.
+                Defaults to twice the number of processes.
+            pool (WorkerPool): The worker pool. A temporary pool with the default settings is used if None.
+
+        Yields:
+            tuple: The index of the parameters in ``param_list`` and the return value of the ``fn`` call.
+
+        Raises:
+            ValueError: If the shared memory transport is not supported by the pool.
+        """
+        if pool is None:
+            with WorkerPool() as pool:
+                yield from MultiProcessor.run_iter(fn, param_list, fn_kwargs, pickle_helper_cls,
+                                                   shared_memory_transport, ordered, max_in_flight, pool)
+            return
+
+        if shared_memory_transport and not pool.supports_shared_memory:
+            raise ValueError('The pool does not support the shared memory transport')
+
         if fn_kwargs is None:
             fn_kwargs = {}
+        if max_in_flight is None:
+            max_in_flight = 2 * pool.processes
 
         helper = pickle_helper_cls()
-        # add additional_params
-        param_list = ((*p, fn_kwargs) for p in param_list)
-        param_list = (helper.make_params_picklable(params) for params in param_list)
-
-        with pmp.Pool() as p:
-            ret_vals = p.starmap(MultiProcessor._wrap_fn(fn, pickle_helper_cls), param_list)
-        ret_vals = [helper.recover_return_value(ret_val) for ret_val in ret_vals]
-        return ret_vals
-
-    @staticmethod
-    def _wrap_fn(fn, pickle_helper_cls):
-        def wrapped_fn(*params):
-            # create instance due to possible race condition (not sure if really possible)
-            helper = pickle_helper_cls()
-            params = helper.recover_params(params)
-            params, shared_params = params[:-1], params[-1]
-            ret_val = fn(*params, **shared_params)
-            ret_val = helper.make_return_value_picklable(ret_val)
-            return ret_val
-
-        return wrapped_fn
+        prefix = None
+        if shared_memory_transport:
+            # the block names of this run share a prefix to release them if a worker crashes
+            prefix = 'mia{}'.format(uuid.uuid4().hex[:8])
+            helper = SharedMemoryPickleHelper(helper, prefix)
+
+        completed = queue.Queue()
+        in_flight = {}  # the chunks by the index of their first parameters
+        chunk_sizes = {}
+        try:
+            param_iter = enumerate(param_list)
+            exhausted = False
+            while True:
+                while not exhausted and sum(chunk_sizes.values()) < max_in_flight:
+                    chunk_start, chunk = None, []
+                    for idx, params in param_iter:
+                        chunk_start = idx if chunk_start is None else chunk_start
+                        # add additional_params
+                        chunk.append(helper.make_params_picklable((*params, fn_kwargs)))
+                        if len(chunk) == pool.chunksize:
+                            break
+                    if len(chunk) < pool.chunksize:
+                        exhausted = True
+                    if not chunk:
+                        break
+                    in_flight[chunk_start] = pool.apply_async(
+                        _run_tasks, (fn, pickle_helper_cls, prefix, chunk),
+                        callback=lambda _, i=chunk_start: completed.put(i),
+                        error_callback=lambda _, i=chunk_start: completed.put(i))
+                    chunk_sizes[chunk_start] = len(chunk)
+                if not in_flight:
+                    break
+
+                # the chunks are submitted in increasing order, i.e. the smallest index is the oldest chunk
+                chunk_start = min(in_flight) if ordered else completed.get()
+                ret_vals = in_flight.pop(chunk_start).get()
+                del chunk_sizes[chunk_start]
+                for idx, ret_val in enumerate(ret_vals, chunk_start):
+                    yield idx, helper.recover_return_value(ret_val)
+        finally:
+            if prefix is not None:
+                # wait for pending calls of the persistent pool before releasing their shared memory blocks
+                for result in in_flight.values():
+                    result.wait()
+                _release_shared_memory(prefix)
@@ -1,8 +1,10 @@
 """This module contains utility classes and functions."""
 import enum
+import functools
 import os
 import typing as t
 import warnings
+import zlib
 
 import numpy as np
 import pymia.data.conversion as conversion
@@ -15,6 +17,7 @@ import mialab.data.structure as structure
 import mialab.filtering.feature_extraction as fltr_feat
 import mialab.filtering.postprocessing as fltr_postp
 import mialab.filtering.preprocessing as fltr_prep
+import mialab.utilities.feature_cache as fcache
 import mialab.utilities.multi_processor as mproc
 
 atlas_t1 = sitk.Image()
@@ -59,6 +62,70 @@ class FeatureExtractor:
         self.coordinates_feature = kwargs.get('coordinates_feature', False)
         self.intensity_feature = kwargs.get('intensity_feature', False)
         self.gradient_intensity_feature = kwargs.get('gradient_intensity_feature', False)
+        self.sampling_seed = kwargs.get('sampling_seed', None)
+        self.brain_mask_inference = kwargs.get('brain_mask_inference', False)
+        self.training_sample = kwargs.get('training_sample', False)
+        self.training_label_counts = kwargs.get('training_label_counts', None)
+
+    @staticmethod
+    def get_feature_names(**kwargs) -> t.List[str]:
+        """Gets the names of the feature matrix columns, i.e. the feature layout, for the given parameters.
+
+        Args:
+            **kwargs: The feature extraction parameters (see :class:`FeatureExtractor`).
+
+        Returns:
+            List[str]: The feature names.
+        """
+        names = []
+        if kwargs.get('coordinates_feature', False):
+            names += ['{}_{}'.format(FeatureImageTypes.ATLAS_COORD.name, axis) for axis in 'xyz']
+        if kwargs.get('intensity_feature', False):
+            names += [FeatureImageTypes.T1w_INTENSITY.name, FeatureImageTypes.T2w_INTENSITY.name]
+        if kwargs.get('gradient_intensity_feature', False):
+            names += [FeatureImageTypes.T1w_GRADIENT_INTENSITY.name, FeatureImageTypes.T2w_GRADIENT_INTENSITY.name]
+        return names
+
+    @staticmethod
+    def get_training_indices(img: structure.BrainImage, sampling_seed: int = None,
+                             label_counts: t.List[int] = None) -> np.ndarray:
+        """Gets the voxels sampled for the training.
+
+        Args:
+            img (structure.BrainImage): The image with the ground truth.
+            sampling_seed (int): The sampling seed (see :class:`FeatureExtractor`).
+            label_counts (List[int]): The absolute number of voxels per label to sample instead of the default
+                percentages, e.g. for a small sample (see :class:`StratifiedVoxelSampler
+                <mialab.filtering.feature_extraction.StratifiedVoxelSampler>`).
+
+        Returns:
+            np.ndarray: The sorted flat indices of the sampled voxels.
+        """
+        # randomly sample the voxels used for training per label
+        # we have following labels:
+        # - 0 (background)
+        # - 1 (white matter)
+        # - 2 (grey matter)
+        # - 3 (Hippocampus)
+        # - 4 (Amygdala)
+        # - 5 (Thalamus)
+
+        # you can exclude background voxels from the training sample
+        # mask_background = img.images[structure.BrainImageTypes.BrainMask]
+        # and use background_mask=mask_background in get_indices()
+
+        # the seed is derived from the sampling seed and the image identifier such that the samples are
+        # reproducible independent of the processing order
+        seed = None
+        if sampling_seed is not None:
+            seed = np.random.SeedSequence(sampling_seed, spawn_key=(zlib.crc32(img.id_.encode()),))
+
+        if label_counts is not None:
+            sampler = fltr_feat.StratifiedVoxelSampler([0, 1, 2, 3, 4, 5], label_counts=label_counts)
+        else:
+            sampler = fltr_feat.StratifiedVoxelSampler([0, 1, 2, 3, 4, 5],
+                                                       [0.0003, 0.004, 0.003, 0.04, 0.04, 0.02])
+        return sampler.get_indices(img.images[structure.BrainImageTypes.GroundTruth], seed=seed)
 
     def execute(self) -> structure.BrainImage:
         """Extracts features from an image.
@@ -93,72 +160,148 @@ class FeatureExtractor:
     def _generate_feature_matrix(self):
         """Generates a feature matrix."""
 
-        mask = None
+        indices = None
         if self.training:
-            # generate a randomized mask where 1 represents voxels used for training
-            # the mask needs to be binary, where the value 1 is considered as a voxel which is to be loaded
-            # we have following labels:
-            # - 0 (background)
-            # - 1 (white matter)
-            # - 2 (grey matter)
-            # - 3 (Hippocampus)
-            # - 4 (Amygdala)
-            # - 5 (Thalamus)
-
-            # you can exclude background voxels from the training mask generation
-            # mask_background = self.img.images[structure.BrainImageTypes.BrainMask]
-            # and use background_mask=mask_background in get_mask()
-
-            mask = fltr_feat.RandomizedTrainingMaskGenerator.get_mask(
-                self.img.images[structure.BrainImageTypes.GroundTruth],
-                [0, 1, 2, 3, 4, 5],
-                [0.0003, 0.004, 0.003, 0.04, 0.04, 0.02])
-
-            # convert the mask to a logical array where value 1 is False and value 0 is True
-            mask = sitk.GetArrayFromImage(mask)
-            mask = np.logical_not(mask)
-
-        # generate features
-        data = np.concatenate(
-            [self._image_as_numpy_array(image, mask) for id_, image in self.img.feature_images.items()],
-            axis=1)
+            indices = self.get_training_indices(self.img, self.sampling_seed, self.training_label_counts)
+        elif self.brain_mask_inference:
+            # only voxels inside the brain mask are classified, the others are background
+            indices = np.flatnonzero(sitk.GetArrayViewFromImage(self.img.images[structure.BrainImageTypes.BrainMask]))
+            if self.training_sample:
+                # the training sample is also extracted such that the feature matrix can be used for the training
+                # and testing (e.g., in a cross-validation)
+                indices = np.union1d(indices, self.get_training_indices(self.img, self.sampling_seed,
+                                                                        self.training_label_counts))
+
+        # generate features into a preallocated matrix, one column block per feature image
+        feature_images = list(self.img.feature_images.values())
+        no_features = sum(image.GetNumberOfComponentsPerPixel() for image in feature_images)
+        ground_truth = self.img.images[structure.BrainImageTypes.GroundTruth]
+        no_voxels = int(np.prod(ground_truth.GetSize())) if indices is None else indices.size
+        data = np.empty((no_voxels, no_features), dtype=np.float32)
+
+        column = 0
+        for image in feature_images:
+            number_of_components = image.GetNumberOfComponentsPerPixel()
+            self._image_as_numpy_array(image, indices, data[:, column:column + number_of_components])
+            column += number_of_components
 
         # generate labels (note that we assume to have a ground truth even for testing)
-        labels = self._image_as_numpy_array(self.img.images[structure.BrainImageTypes.GroundTruth], mask)
+        labels = np.empty((no_voxels, 1), dtype=np.int16)
+        self._image_as_numpy_array(ground_truth, indices, labels)
 
-        self.img.feature_matrix = (data.astype(np.float32), labels.astype(np.int16))
+        self.img.feature_matrix = (data, labels)
+        self.img.feature_indices = indices
 
     @staticmethod
-    def _image_as_numpy_array(image: sitk.Image, mask: np.ndarray = None):
+    def _image_as_numpy_array(image: sitk.Image, indices: np.ndarray, out: np.ndarray):
         """Gets an image as numpy array where each row is a voxel and each column is a feature.
 
         Args:
             image (sitk.Image): The image.
-            mask (np.ndarray): A mask defining which voxels to return. True is background, False is a masked voxel.
+            indices (np.ndarray): The flat indices of the voxels to return. If None, all voxels are returned.
+            out (np.ndarray): The array with shape (number of voxels, number of components) to write the voxels to.
 
         Returns:
             np.ndarray: An array where each row is a voxel and each column is a feature.
         """
 
         number_of_components = image.GetNumberOfComponentsPerPixel()  # the number of features for this image
-        no_voxels = np.prod(image.GetSize())
-        image = sitk.GetArrayFromImage(image)
+        # the view is only valid as long as the image exists, which is ensured by the caller
+        image_arr = sitk.GetArrayViewFromImage(image).reshape((-1, number_of_components))
+
+        if indices is None:
+            out[...] = image_arr
+        else:
+            # gather column by column to keep the temporary copy small
+            for component in range(number_of_components):
+                out[:, component] = image_arr[indices, component]
+
+        return out
+
+
+def voxels_as_image(values: np.ndarray, img: structure.BrainImage, background=0) -> sitk.Image:
+    """Converts voxel-wise values corresponding to the rows of the feature matrix (e.g., predictions) to an image.
 
-        if mask is not None:
-            no_voxels = np.size(mask) - np.count_nonzero(mask)
+    Args:
+        values (np.ndarray): The values with shape (n,) or (n, number of components), n being the number of rows of
+            the feature matrix.
+        img (structure.BrainImage): The image the feature matrix belongs to.
+        background (scalar or np.ndarray): The value of voxels not contained in the feature matrix.
+            Use an array of shape (number of components,) for vector images.
+
+    Returns:
+        sitk.Image: The image.
+    """
+    if img.feature_indices is not None:
+        no_voxels = int(np.prod(img.image_properties.size))
+        full_values = np.empty((no_voxels,) + values.shape[1:], dtype=values.dtype)
+        full_values[...] = background
+        full_values[img.feature_indices] = values
+        values = full_values
+
+    return conversion.NumpySimpleITKImageBridge.convert(values, img.image_properties)
+
+
+def crop_to_brain_roi(img: structure.BrainImage, margin: int = 5):
+    """Crops all images to the bounding box of the brain mask, i.e. the region of interest (ROI).
+
+    The origin of the cropped images is adapted such that they remain at the same physical location. The image
+    properties before cropping and the ROI index are kept in the image to paste results back (see :func:`paste_roi`).
+
+    Args:
+        img (structure.BrainImage): The image. Its brain mask defines the ROI.
+        margin (int): The number of voxels to add to each side of the bounding box.
+    """
+    mask = img.images[structure.BrainImageTypes.BrainMask]
+    mask_arr = sitk.GetArrayViewFromImage(mask)
+    if not mask_arr.any():
+        warnings.warn('Brain mask of {} is empty; the images are not cropped.'.format(img.id_))
+        return
+
+    # bounding box per axis, the array axes are in (z, y, x) order
+    index = []
+    size = []
+    for axis in reversed(range(mask_arr.ndim)):
+        other_axes = tuple(a for a in range(mask_arr.ndim) if a != axis)
+        nonzero = np.flatnonzero(mask_arr.any(axis=other_axes))
+        start = max(0, int(nonzero[0]) - margin)
+        stop = min(mask_arr.shape[axis], int(nonzero[-1]) + 1 + margin)
+        index.append(start)
+        size.append(stop - start)
+
+    full_image_properties = conversion.ImageProperties(mask)
+    for key, image in img.images.items():
+        if conversion.ImageProperties(image) != full_image_properties:
+            raise ValueError('Image {} of {} is not on the grid of the brain mask'.format(key, img.id_))
+        img.images[key] = sitk.RegionOfInterest(image, size, index)
+
+    img.full_image_properties = full_image_properties
+    img.roi_index = tuple(index)
+    img.image_properties = conversion.ImageProperties(img.images[structure.BrainImageTypes.BrainMask])
+
+
+def paste_roi(image: sitk.Image, img: structure.BrainImage, background=0) -> sitk.Image:
+    """Pastes an image of the region of interest (ROI) back into the full image geometry.
 
-            if number_of_components == 1:
-                masked_image = np.ma.masked_array(image, mask=mask)
-            else:
-                # image is a vector image, make a vector mask
-                vector_mask = np.expand_dims(mask, axis=3)  # shape is now (z, x, y, 1)
-                vector_mask = np.repeat(vector_mask, number_of_components,
-                                        axis=3)  # shape is now (z, x, y, number_of_components)
-                masked_image = np.ma.masked_array(image, mask=vector_mask)
+    Args:
+        image (sitk.Image): The image of the ROI, e.g. a segmentation.
+        img (structure.BrainImage): The image, which has been cropped by :func:`crop_to_brain_roi`.
+        background (scalar or np.ndarray): The value of voxels outside the ROI.
+            Use an array of shape (number of components,) for vector images.
 
-            image = masked_image[~masked_image.mask]
+    Returns:
+        sitk.Image: The image with the full geometry or ``image`` if the image has not been cropped.
+    """
+    if img.roi_index is None:
+        return image
 
-        return image.reshape((no_voxels, number_of_components))
+    roi_arr = sitk.GetArrayViewFromImage(image)
+    full_arr = np.empty(img.full_image_properties.size[::-1] + roi_arr.shape[3:], dtype=roi_arr.dtype)
+    full_arr[...] = background
+    x, y, z = img.roi_index
+    full_arr[z:z + roi_arr.shape[0], y:y + roi_arr.shape[1], x:x + roi_arr.shape[2]] = roi_arr
+
+    return conversion.NumpySimpleITKImageBridge.convert(full_arr, img.full_image_properties)
 
 
 def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
@@ -188,29 +331,36 @@ def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
     transform = sitk.ReadTransform(path_to_transform)
     img = structure.BrainImage(id_, path, img, transform)
 
-    # construct pipeline for brain mask registration
+    # register all images at once, they share the resampling onto the atlas grid
     # we need to perform this before the T1w and T2w pipeline because the registered mask is used for skull-stripping
-    pipeline_brain_mask = fltr.FilterPipeline()
+    # (the T1w and T2w atlas images have the same image properties, see load_atlas_images)
     if kwargs.get('registration_pre', False):
-        pipeline_brain_mask.add_filter(fltr_prep.ImageRegistration())
-        pipeline_brain_mask.set_param(fltr_prep.ImageRegistrationParameters(atlas_t1, img.transformation, True),
-                                      len(pipeline_brain_mask.filters) - 1)
-
-    # execute pipeline on the brain mask image
-    img.images[structure.BrainImageTypes.BrainMask] = pipeline_brain_mask.execute(
-        img.images[structure.BrainImageTypes.BrainMask])
+        registration_keys = [structure.BrainImageTypes.BrainMask,
+                             structure.BrainImageTypes.T1w,
+                             structure.BrainImageTypes.T2w,
+                             structure.BrainImageTypes.GroundTruth]
+        registration = fltr_prep.MultiImageRegistration()
+        registered_images = registration.execute_multiple([img.images[key] for key in registration_keys],
+                                                          fltr_prep.MultiImageRegistrationParameters(
+                                                              atlas_t1, img.transformation, [True, False, False, True]))
+        img.images.update(zip(registration_keys, registered_images))
+
+    # crop all images to the bounding box of the brain mask such that subsequent steps process fewer voxels
+    if kwargs.get('roi_pre', False):
+        crop_to_brain_roi(img, kwargs.get('roi_margin', 5))
 
     # construct pipeline for T1w image pre-processing
     pipeline_t1 = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
-        pipeline_t1.add_filter(fltr_prep.ImageRegistration())
-        pipeline_t1.set_param(fltr_prep.ImageRegistrationParameters(atlas_t1, img.transformation),
+    if kwargs.get('skullstrip_pre', False) and kwargs.get('normalization_pre', False):
+        # skull stripping and normalization fused into one filter
+        pipeline_t1.add_filter(fltr_prep.SkullStrippingNormalization())
+        pipeline_t1.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
                               len(pipeline_t1.filters) - 1)
-    if kwargs.get('skullstrip_pre', False):
+    elif kwargs.get('skullstrip_pre', False):
         pipeline_t1.add_filter(fltr_prep.SkullStripping())
         pipeline_t1.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
                               len(pipeline_t1.filters) - 1)
-    if kwargs.get('normalization_pre', False):
+    elif kwargs.get('normalization_pre', False):
         pipeline_t1.add_filter(fltr_prep.ImageNormalization())
 
     # execute pipeline on the T1w image
@@ -218,31 +368,21 @@ def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
 
     # construct pipeline for T2w image pre-processing
     pipeline_t2 = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
-        pipeline_t2.add_filter(fltr_prep.ImageRegistration())
-        pipeline_t2.set_param(fltr_prep.ImageRegistrationParameters(atlas_t2, img.transformation),
+    if kwargs.get('skullstrip_pre', False) and kwargs.get('normalization_pre', False):
+        # skull stripping and normalization fused into one filter
+        pipeline_t2.add_filter(fltr_prep.SkullStrippingNormalization())
+        pipeline_t2.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
                               len(pipeline_t2.filters) - 1)
-    if kwargs.get('skullstrip_pre', False):
+    elif kwargs.get('skullstrip_pre', False):
         pipeline_t2.add_filter(fltr_prep.SkullStripping())
         pipeline_t2.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
                               len(pipeline_t2.filters) - 1)
-    if kwargs.get('normalization_pre', False):
+    elif kwargs.get('normalization_pre', False):
         pipeline_t2.add_filter(fltr_prep.ImageNormalization())
 
     # execute pipeline on the T2w image
     img.images[structure.BrainImageTypes.T2w] = pipeline_t2.execute(img.images[structure.BrainImageTypes.T2w])
 
-    # construct pipeline for ground truth image pre-processing
-    pipeline_gt = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
-        pipeline_gt.add_filter(fltr_prep.ImageRegistration())
-        pipeline_gt.set_param(fltr_prep.ImageRegistrationParameters(atlas_t1, img.transformation, True),
-                              len(pipeline_gt.filters) - 1)
-
-    # execute pipeline on the ground truth image
-    img.images[structure.BrainImageTypes.GroundTruth] = pipeline_gt.execute(
-        img.images[structure.BrainImageTypes.GroundTruth])
-
     # update image properties to atlas image properties after registration
     img.image_properties = conversion.ImageProperties(img.images[structure.BrainImageTypes.T1w])
 
@@ -318,7 +458,10 @@ def init_evaluator() -> eval_.Evaluator:
 
 
 def pre_process_batch(data_batch: t.Dict[structure.BrainImageTypes, structure.BrainImage],
-                      pre_process_params: dict = None, multi_process: bool = True) -> t.List[structure.BrainImage]:
+                      pre_process_params: dict = None, multi_process: bool = True,
+                      cache: fcache.FeatureMatrixCache = None,
+                      shared_memory_transport: bool = False, pool: mproc.WorkerPool = None,
+                      image_types: t.List[structure.BrainImageTypes] = None) -> t.List[structure.BrainImage]:
     """Loads and pre-processes a batch of images.
 
     The pre-processing includes:
@@ -331,24 +474,105 @@ def pre_process_batch(data_batch: t.Dict[structure.BrainImageTypes, structure.Br
         data_batch (Dict[structure.BrainImageTypes, structure.BrainImage]): Batch of images to be processed.
         pre_process_params (dict): Pre-processing parameters.
         multi_process (bool): Whether to use the parallel processing on multiple cores or to run sequentially.
+        cache (fcache.FeatureMatrixCache): A feature matrix cache. Cached images are not pre-processed again, but
+            only contain the feature matrix and, for testing, the ground truth. Images requiring other images
+            (see ``image_types``) are therefore pre-processed again.
+        shared_memory_transport (bool): Whether to transfer the images between the processes through shared memory.
+        pool (mproc.WorkerPool): The worker pool for the parallel processing (a temporary pool if None).
+        image_types (List[structure.BrainImageTypes]): The types of the images required by the caller in addition to
+            the feature matrix, e.g. an empty list for training, the ground truth for the evaluation, and the T1w
+            and T2w images for the CRF post-processing. Only these images are transferred from the worker processes
+            and kept. All images are kept if None.
 
     Returns:
         List[structure.BrainImage]: A list of images.
     """
+    images = [None] * len(data_batch)
+    for idx, img in pre_process_batch_iter(data_batch, pre_process_params, multi_process, cache,
+                                           shared_memory_transport, pool=pool, image_types=image_types):
+        images[idx] = img
+    return images
+
+
+def pre_process_batch_iter(data_batch: t.Dict[structure.BrainImageTypes, structure.BrainImage],
+                           pre_process_params: dict = None, multi_process: bool = True,
+                           cache: fcache.FeatureMatrixCache = None, shared_memory_transport: bool = False,
+                           max_in_flight: int = None, pool: mproc.WorkerPool = None,
+                           image_types: t.List[structure.BrainImageTypes] = None) -> t.Iterator[tuple]:
+    """Loads and pre-processes a batch of images and yields the images as they complete.
+
+    See :func:`pre_process_batch`. The images are yielded in the order of completion, i.e. cached images first.
+    Only a bounded number of images are pre-processed at the same time, such that the memory consumption does
+    not depend on the batch size if the caller does not keep the images.
+
+    Args:
+        data_batch (Dict[structure.BrainImageTypes, structure.BrainImage]): Batch of images to be processed.
+        pre_process_params (dict): Pre-processing parameters.
+        multi_process (bool): Whether to use the parallel processing on multiple cores or to run sequentially.
+        cache (fcache.FeatureMatrixCache): A feature matrix cache.
+        shared_memory_transport (bool): Whether to transfer the images between the processes through shared memory.
+        max_in_flight (int): The maximum number of images pre-processed at the same time
+            (see :meth:`MultiProcessor.run_iter <mialab.utilities.multi_processor.MultiProcessor.run_iter>`).
+        pool (mproc.WorkerPool): The worker pool for the parallel processing (a temporary pool if None).
+        image_types (List[structure.BrainImageTypes]): The types of the images required by the caller in addition to
+            the feature matrix (all if None).
+
+    Yields:
+        tuple: The index of the image in ``data_batch`` and the image.
+    """
     if pre_process_params is None:
         pre_process_params = {}
 
+    save_ground_truth = not pre_process_params.get('training', True)
+    transfer_types = image_types
+    if image_types is not None and cache is not None and save_ground_truth:
+        # the cache entries of testing images contain the ground truth
+        transfer_types = list(image_types) + [structure.BrainImageTypes.GroundTruth]
+
+    # the cache entries contain no images except the ground truth of testing images, i.e. the cached images are not
+    # used if other images are required (e.g., the T1w and T2w images for the CRF post-processing)
+    cached_types = [structure.BrainImageTypes.GroundTruth] if save_ground_truth else []
+    load_cached = image_types is not None and all(key in cached_types for key in image_types)
+
     params_list = list(data_batch.items())
+
+    keys = [None] * len(params_list)
+    missing = []
+    for idx, (id_, paths) in enumerate(params_list):
+        if cache is not None:
+            keys[idx] = cache.get_key(id_, paths, pre_process_params, [atlas_t1, atlas_t2])
+            img = cache.load(keys[idx]) if load_cached else None
+            if img is not None:
+                print('-' * 10, 'Loaded', id_, 'from cache')
+                if image_types is not None:
+                    img.images = {key: image for key, image in img.images.items() if key in image_types}
+                yield idx, img
+                continue
+        missing.append(idx)
+
+    # pre_process modifies the paths, we therefore pass a copy
+    missing_params = ((params_list[idx][0], dict(params_list[idx][1])) for idx in missing)
     if multi_process:
-        images = mproc.MultiProcessor.run(pre_process, params_list, pre_process_params, mproc.PreProcessingPickleHelper)
+        processed = mproc.MultiProcessor.run_iter(pre_process, missing_params, pre_process_params,
+                                                  functools.partial(mproc.PreProcessingPickleHelper, transfer_types),
+                                                  shared_memory_transport,
+                                                  ordered=False, max_in_flight=max_in_flight, pool=pool)
     else:
-        images = [pre_process(id_, path, **pre_process_params) for id_, path in params_list]
-    return images
+        processed = ((i, pre_process(id_, path, **pre_process_params)) for i, (id_, path) in enumerate(missing_params))
+
+    for i, img in processed:
+        idx = missing[i]
+        if cache is not None:
+            cache.save(keys[idx], img, save_ground_truth=save_ground_truth)
+        if image_types is not None:
+            img.images = {key: image for key, image in img.images.items() if key in image_types}
+        yield idx, img
 
 
 def post_process_batch(brain_images: t.List[structure.BrainImage], segmentations: t.List[sitk.Image],
                        probabilities: t.List[sitk.Image], post_process_params: dict = None,
-                       multi_process: bool = True) -> t.List[sitk.Image]:
+                       multi_process: bool = True, shared_memory_transport: bool = False,
+                       pool: mproc.WorkerPool = None) -> t.List[sitk.Image]:
     """ Post-processes a batch of images.
 
     Args:
@@ -357,17 +581,56 @@ def post_process_batch(brain_images: t.List[structure.BrainImage], segmentations
         probabilities (List[sitk.Image]): The prediction probabilities.
         post_process_params (dict): Post-processing parameters.
         multi_process (bool): Whether to use the parallel processing on multiple cores or to run sequentially.
+        shared_memory_transport (bool): Whether to transfer the images between the processes through shared memory.
+        pool (mproc.WorkerPool): The worker pool for the parallel processing (a temporary pool if None).
 
     Returns:
         List[sitk.Image]: List of post-processed images
     """
+    pp_images = [None] * len(brain_images)
+    for idx, pp_image in post_process_batch_iter(brain_images, segmentations, probabilities, post_process_params,
+                                                 multi_process, shared_memory_transport, pool=pool):
+        pp_images[idx] = pp_image
+    return pp_images
+
+
+def post_process_batch_iter(brain_images: t.List[structure.BrainImage], segmentations: t.List[sitk.Image],
+                            probabilities: t.List[sitk.Image], post_process_params: dict = None,
+                            multi_process: bool = True, shared_memory_transport: bool = False,
+                            max_in_flight: int = None,
+                            pool: mproc.WorkerPool = None) -> t.Iterator[t.Tuple[int, sitk.Image]]:
+    """ Post-processes a batch of images and yields the post-processed images as they complete.
+
+    See :func:`post_process_batch`.
+
+    Args:
+        brain_images (List[structure.BrainImageTypes]): Original images that were used for the prediction.
+        segmentations (List[sitk.Image]): The predicted segmentation.
+        probabilities (List[sitk.Image]): The prediction probabilities.
+        post_process_params (dict): Post-processing parameters.
+        multi_process (bool): Whether to use the parallel processing on multiple cores or to run sequentially.
+        shared_memory_transport (bool): Whether to transfer the images between the processes through shared memory.
+        max_in_flight (int): The maximum number of images post-processed at the same time
+            (see :meth:`MultiProcessor.run_iter <mialab.utilities.multi_processor.MultiProcessor.run_iter>`).
+        pool (mproc.WorkerPool): The worker pool for the parallel processing (a temporary pool if None).
+
+    Yields:
+        tuple: The index of the image in ``brain_images`` and the post-processed image.
+    """
     if post_process_params is None:
         post_process_params = {}
 
+    # only the CRF post-processing requires images
+    image_types = []
+    if post_process_params.get('crf_post', False):
+        image_types = [structure.BrainImageTypes.T1w, structure.BrainImageTypes.T2w]
+
     param_list = zip(brain_images, segmentations, probabilities)
     if multi_process:
-        pp_images = mproc.MultiProcessor.run(post_process, param_list, post_process_params,
-                                             mproc.PostProcessingPickleHelper)
+        yield from mproc.MultiProcessor.run_iter(post_process, param_list, post_process_params,
+                                                 functools.partial(mproc.PostProcessingPickleHelper, image_types),
+                                                 shared_memory_transport,
+                                                 ordered=False, max_in_flight=max_in_flight, pool=pool)
     else:
-        pp_images = [post_process(img, seg, prob, **post_process_params) for img, seg, prob in param_list]
-    return pp_images
+        for idx, (img, seg, prob) in enumerate(param_list):
+            yield idx, post_process(img, seg, prob, **post_process_params)
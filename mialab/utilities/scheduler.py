@@ -0,0 +1,128 @@
+"""This module contains a scheduler executing tasks concurrently according to their dependencies.
+
+The scheduler is used to overlap independent stages of the pipeline, e.g. the pre-processing of the testing images
+with the training of the classifier, or the post-processing of a subject with the prediction of another subject.
+"""
+import concurrent.futures
+import os
+import typing as t
+
+
+class Task:
+    """Represents a task of a :class:`TaskScheduler`."""
+
+    def __init__(self, name: str, fn: callable, dependencies: t.Sequence[str], args: tuple, kwargs: dict):
+        """Initializes a new instance of the Task class.
+
+        Args:
+            name (str): The unique name of the task.
+            fn (callable): The function executing the task.
+            dependencies (Sequence[str]): The names of the tasks, whose results are required by the task.
+            args (tuple): The additional arguments of ``fn``.
+            kwargs (dict): The keyword arguments of ``fn``.
+        """
+        self.name = name
+        self.fn = fn
+        self.dependencies = tuple(dependencies)
+        self.args = args
+        self.kwargs = kwargs
+        self.dependents = []
+
+
+class TaskScheduler:
+    """Represents a scheduler executing a graph of tasks in threads.
+
+    A task is executed as soon as all its dependencies have completed. Its function is called with the results of
+    the dependencies (in the order of the dependencies) followed by its additional arguments.
+    The tasks are executed in threads of the main process, i.e. they should either release the GIL (e.g., SimpleITK
+    filters, numpy or scikit-learn) or wait for other processes (e.g., a :class:`WorkerPool
+    <mialab.utilities.multi_processor.WorkerPool>`).
+
+    Examples:
+        >>> scheduler = TaskScheduler()
+        >>> scheduler.add_task('a', lambda: 1)
+        >>> scheduler.add_task('b', lambda: 2)
+        >>> scheduler.add_task('sum', lambda a, b, c: a + b + c, 3, dependencies=['a', 'b'])
+        >>> scheduler.run()
+        {'sum': 6}
+    """
+
+    def __init__(self, max_workers: int = None):
+        """Initializes a new instance of the TaskScheduler class.
+
+        Args:
+            max_workers (int): The maximum number of concurrently executed tasks.
+                Defaults to the number of CPUs plus four.
+        """
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1) + 4
+        self.tasks = {}
+
+    def add_task(self, name: str, fn: callable, *args, dependencies: t.Sequence[str] = (), **kwargs) -> str:
+        """Adds a task.
+
+        Args:
+            name (str): The unique name of the task.
+            fn (callable): The function executing the task.
+            *args: The additional arguments of ``fn``.
+            dependencies (Sequence[str]): The names of the tasks, whose results are required by the task.
+                The dependencies must have been added before, which ensures that the graph has no cycles.
+            **kwargs: The keyword arguments of ``fn``.
+
+        Returns:
+            str: The name of the task.
+
+        Raises:
+            ValueError: If the name is not unique or a dependency does not exist.
+        """
+        if name in self.tasks:
+            raise ValueError('Task {} already exists'.format(name))
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise ValueError('Dependency {} of task {} does not exist'.format(dependency, name))
+
+        task = Task(name, fn, dependencies, args, kwargs)
+        for dependency in task.dependencies:
+            self.tasks[dependency].dependents.append(name)
+        self.tasks[name] = task
+        return name
+
+    def run(self) -> dict:
+        """Executes all tasks.
+
+        The result of a task is released as soon as all its dependents have completed to limit the memory consumption.
+        If a task fails, no further tasks are started and the exception is raised after the running tasks completed.
+
+        Returns:
+            dict: The results of the tasks without dependents by the task names.
+        """
+        results = {}
+        remaining_dependencies = {name: len(task.dependencies) for name, task in self.tasks.items()}
+        remaining_dependents = {name: len(task.dependents) for name, task in self.tasks.items()}
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            def submit(task_: Task):
+                args = tuple(results[dependency] for dependency in task_.dependencies) + task_.args
+                return executor.submit(task_.fn, *args, **task_.kwargs)
+
+            running = {submit(task): name for name, task in self.tasks.items() if not task.dependencies}
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException:
+                        concurrent.futures.wait(running)
+                        raise
+
+                    task = self.tasks[name]
+                    for dependency in task.dependencies:
+                        remaining_dependents[dependency] -= 1
+                        if remaining_dependents[dependency] == 0:
+                            del results[dependency]
+                    for dependent in task.dependents:
+                        remaining_dependencies[dependent] -= 1
+                        if remaining_dependencies[dependent] == 0:
+                            running[submit(self.tasks[dependent])] = dependent
+
+        return results
@@ -0,0 +1,349 @@
+"""This module contains a work queue to distribute the function calls of the :class:`MultiProcessor
+<mialab.utilities.multi_processor.MultiProcessor>` to several hosts.
+
+The :class:`WorkQueuePool` submits the function calls as tasks to a broker, from which worker processes on any host
+with access to the broker claim the tasks and return the results (see :func:`run_worker` and
+``work_queue_worker.py``). The :class:`FileSystemBroker` stores the tasks and results in a directory, e.g.
+on a network file system shared by the hosts.
+"""
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import dill
+
+import mialab.utilities.multi_processor as mproc
+
+
+class FileSystemBroker:
+    """Represents a broker storing the tasks and results as files in a directory.
+
+    A task is claimed by a worker by atomically moving its file from the tasks to the claimed directory.
+    While executing the task, the worker renews its lease by touching the claimed file. Tasks with an expired lease,
+    e.g. of a crashed worker or host, are moved back to the tasks directory by :meth:`requeue_expired`.
+    Use one queue directory per pipeline run.
+    """
+
+    TASKS_DIR = 'tasks'
+    CLAIMED_DIR = 'claimed'
+    RESULTS_DIR = 'results'
+    INITIALIZER_FILE = 'initializer.pkl'
+
+    def __init__(self, queue_dir: str, lease_timeout: float = 600.0):
+        """Initializes a new instance of the FileSystemBroker class.
+
+        Args:
+            queue_dir (str): The queue directory.
+            lease_timeout (float): The time in seconds after which a claimed task without lease renewal is requeued.
+        """
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+
+        for dir_ in (self.TASKS_DIR, self.CLAIMED_DIR, self.RESULTS_DIR):
+            os.makedirs(os.path.join(self.queue_dir, dir_), exist_ok=True)
+
+    def submit(self, payload) -> str:
+        """Submits a task.
+
+        Args:
+            payload: The picklable task.
+
+        Returns:
+            str: The task identifier.
+        """
+        # the identifiers are ordered by the submission time such that the tasks are claimed first in, first out
+        task_id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+        self._write(os.path.join(self.queue_dir, self.TASKS_DIR, task_id), payload)
+        return task_id
+
+    def claim(self):
+        """Claims the oldest task.
+
+        Returns:
+            tuple: The task identifier and the task or None if no task is available.
+        """
+        tasks_dir = os.path.join(self.queue_dir, self.TASKS_DIR)
+        for task_id in sorted(os.listdir(tasks_dir)):
+            if task_id.startswith('.'):
+                continue  # incompletely written
+            claimed_file = os.path.join(self.queue_dir, self.CLAIMED_DIR, task_id)
+            task_file = os.path.join(tasks_dir, task_id)
+            try:
+                # start the lease before the move, such that a claimed task never has an expired lease
+                os.utime(task_file)
+                os.rename(task_file, claimed_file)
+                with open(claimed_file, 'rb') as f:
+                    return task_id, dill.load(f)
+            except FileNotFoundError:
+                continue  # claimed by another worker
+        return None
+
+    def renew(self, task_id: str):
+        """Renews the lease of a claimed task.
+
+        Args:
+            task_id (str): The task identifier.
+        """
+        try:
+            os.utime(os.path.join(self.queue_dir, self.CLAIMED_DIR, task_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task_id: str, result, failed: bool = False):
+        """Completes a claimed task.
+
+        Args:
+            task_id (str): The task identifier.
+            result: The picklable result of the task or the exception if the task failed.
+            failed (bool): Whether the task failed.
+        """
+        self._write(os.path.join(self.queue_dir, self.RESULTS_DIR, task_id), (failed, result))
+        try:
+            os.remove(os.path.join(self.queue_dir, self.CLAIMED_DIR, task_id))
+        except FileNotFoundError:
+            pass
+
+    def fetch_result(self, task_id: str):
+        """Fetches and removes the result of a task.
+
+        Args:
+            task_id (str): The task identifier.
+
+        Returns:
+            tuple: Whether the task failed and the result or exception, or None if the task is not completed.
+        """
+        result_file = os.path.join(self.queue_dir, self.RESULTS_DIR, task_id)
+        try:
+            with open(result_file, 'rb') as f:
+                result = dill.load(f)
+        except FileNotFoundError:
+            return None
+        os.remove(result_file)
+        return result
+
+    def requeue_expired(self):
+        """Moves the claimed tasks with an expired lease back to the tasks."""
+        claimed_dir = os.path.join(self.queue_dir, self.CLAIMED_DIR)
+        now = time.time()
+        for task_id in os.listdir(claimed_dir):
+            claimed_file = os.path.join(claimed_dir, task_id)
+            try:
+                if now - os.stat(claimed_file).st_mtime > self.lease_timeout:
+                    os.rename(claimed_file, os.path.join(self.queue_dir, self.TASKS_DIR, task_id))
+            except FileNotFoundError:
+                pass
+
+    def set_initializer(self, initializer: callable, initargs: tuple):
+        """Sets the function called by the workers before executing tasks.
+
+        Args:
+            initializer (callable): The function.
+            initargs (tuple): The arguments of the function.
+        """
+        self._write(os.path.join(self.queue_dir, self.INITIALIZER_FILE), (uuid.uuid4().hex, initializer, initargs))
+
+    def get_initializer(self):
+        """Gets the function called by the workers before executing tasks.
+
+        Returns:
+            tuple: The version, the function and the arguments of the function, or None if no function is set.
+        """
+        try:
+            with open(os.path.join(self.queue_dir, self.INITIALIZER_FILE), 'rb') as f:
+                return dill.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path: str, obj):
+        """Writes an object atomically, i.e. readers never see an incomplete file."""
+        tmp_path = os.path.join(os.path.dirname(path), '.tmp-' + uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            dill.dump(obj, f)
+        os.replace(tmp_path, path)
+
+
+class WorkQueueResult:
+    """Represents the result of a task submitted by a :class:`WorkQueuePool`."""
+
+    def __init__(self):
+        """Initializes a new instance of the WorkQueueResult class."""
+        self.event = threading.Event()
+        self.failed = False
+        self.value = None
+
+    def wait(self, timeout: float = None):
+        """Waits until the task completed.
+
+        Args:
+            timeout (float): The timeout in seconds.
+        """
+        self.event.wait(timeout)
+
+    def get(self, timeout: float = None):
+        """Gets the return value of the task.
+
+        Args:
+            timeout (float): The timeout in seconds.
+
+        Returns:
+            The return value.
+
+        Raises:
+            TimeoutError: If the task did not complete within the timeout.
+            Exception: The exception of the task if it failed.
+        """
+        if not self.event.wait(timeout):
+            raise TimeoutError('The task did not complete within {} s'.format(timeout))
+        if self.failed:
+            raise self.value
+        return self.value
+
+
+class WorkQueuePool:
+    """Represents a pool of worker processes on several hosts, which claim the tasks from a broker.
+
+    The pool can be used as :class:`WorkerPool <mialab.utilities.multi_processor.WorkerPool>` for the
+    :class:`MultiProcessor <mialab.utilities.multi_processor.MultiProcessor>`, except for the shared memory transport.
+    The functions and pickle helper classes are pickled by reference, i.e. ``mialab`` must be importable by the
+    workers, and paths in the parameters must be valid on all hosts.
+    """
+
+    supports_shared_memory = False  #: Whether the processes can exchange data through shared memory.
+
+    def __init__(self, broker: FileSystemBroker, processes: int = 1, chunksize: int = 1, initializer: callable = None,
+                 initargs: tuple = (), poll_interval: float = 0.5):
+        """Initializes a new instance of the WorkQueuePool class.
+
+        Args:
+            broker (FileSystemBroker): The broker.
+            processes (int): The expected total number of worker processes, which limits the number of tasks in
+                flight (see :meth:`MultiProcessor.run_iter <mialab.utilities.multi_processor.MultiProcessor.run_iter>`).
+            chunksize (int): The number of function calls per task.
+            initializer (callable): A function called once by each worker before executing tasks,
+                e.g. to load data required by all function calls.
+            initargs (tuple): The arguments of the ``initializer``.
+            poll_interval (float): The interval in seconds to poll the broker for results.
+        """
+        self.broker = broker
+        self.processes = processes
+        self.chunksize = chunksize
+        self.poll_interval = poll_interval
+
+        if initializer is not None:
+            self.broker.set_initializer(initializer, initargs)
+
+        self._pending = {}  # the results and callbacks by task identifier
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._poll_thread = threading.Thread(target=self._poll, daemon=True)
+        self._poll_thread.start()
+
+    def apply_async(self, fn: callable, args: tuple, callback: callable = None, error_callback: callable = None):
+        """Submits a function call as task to the broker.
+
+        See :meth:`WorkerPool.apply_async <mialab.utilities.multi_processor.WorkerPool.apply_async>`.
+
+        Returns:
+            WorkQueueResult: The result.
+        """
+        result = WorkQueueResult()
+        with self._lock:
+            task_id = self.broker.submit((fn, args))
+            self._pending[task_id] = (result, callback, error_callback)
+        return result
+
+    def close(self):
+        """Waits for the submitted tasks and stops polling the broker."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    break
+            time.sleep(self.poll_interval)
+        self.terminate()
+
+    def terminate(self):
+        """Stops polling the broker immediately. Submitted tasks are not revoked."""
+        self._closed.set()
+        self._poll_thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _poll(self):
+        """Polls the broker for the results of the pending tasks."""
+        while not self._closed.wait(self.poll_interval):
+            self.broker.requeue_expired()
+            with self._lock:
+                task_ids = list(self._pending)
+            for task_id in task_ids:
+                ret = self.broker.fetch_result(task_id)
+                if ret is None:
+                    continue
+                with self._lock:
+                    result, callback, error_callback = self._pending.pop(task_id)
+                result.failed, result.value = ret
+                result.event.set()
+                if result.failed and error_callback is not None:
+                    error_callback(result.value)
+                elif not result.failed and callback is not None:
+                    callback(result.value)
+
+
+def run_worker(broker: FileSystemBroker, threads: int = 1, poll_interval: float = 0.5, idle_timeout: float = None):
+    """Executes the tasks of a broker in the current process.
+
+    Args:
+        broker (FileSystemBroker): The broker.
+        threads (int): The number of SimpleITK and BLAS threads.
+        poll_interval (float): The interval in seconds to poll the broker for tasks.
+        idle_timeout (float): The time in seconds without tasks after which the worker stops (None means never).
+    """
+    mproc.init_worker(threads)
+
+    initializer_version = None
+    idle_since = time.time()
+    while True:
+        initializer = broker.get_initializer()
+        if initializer is not None and initializer[0] != initializer_version:
+            initializer_version, fn, initargs = initializer
+            fn(*initargs)
+
+        task = broker.claim()
+        if task is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        task_id, (fn, args) = task
+        print('-' * 10, 'Executing task', task_id)
+
+        # renew the lease while executing the task
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(broker.lease_timeout / 3):
+                broker.renew(task_id)
+
+        renew_thread = threading.Thread(target=renew, daemon=True)
+        renew_thread.start()
+        try:
+            result, failed = fn(*args), False
+        except Exception as e:
+            result, failed = e, True
+            if not dill.pickles(e):
+                result = RuntimeError(traceback.format_exc())
+        finally:
+            done.set()
+            renew_thread.join()
+
+        broker.complete(task_id, result, failed)
+        idle_since = time.time()
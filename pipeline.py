@@ -4,6 +4,7 @@ The pipeline is used for brain tissue segmentation using a decision forest class
 """
 import argparse
 import datetime
+import json
 import os
 import sys
 import timeit
@@ -12,22 +13,37 @@ import traceback
 import logging
 
 import SimpleITK as sitk
-import sklearn.ensemble as sk_ensemble
 import numpy as np
-import pymia.data.conversion as conversion
-import pymia.evaluation.writer as writer
 
 try:
     import mialab.data.structure as structure
+    import mialab.utilities.checkpoint as ckpt
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.experiment as exp
+    import mialab.utilities.feature_cache as fcache
+    import mialab.utilities.feature_store as fstore
     import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.hard_example_mining as mining
+    import mialab.utilities.multi_processor as mproc
     import mialab.utilities.pipeline_utilities as putil
+    import mialab.utilities.scheduler as sched
+    import mialab.utilities.work_queue as wq
 except ImportError:
     # Append the MIALab root directory to Python path
     sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
     try:
         import mialab.data.structure as structure
+        import mialab.utilities.checkpoint as ckpt
+        import mialab.utilities.classifier as clf
+        import mialab.utilities.experiment as exp
+        import mialab.utilities.feature_cache as fcache
+        import mialab.utilities.feature_store as fstore
         import mialab.utilities.file_access_utilities as futil
+        import mialab.utilities.hard_example_mining as mining
+        import mialab.utilities.multi_processor as mproc
         import mialab.utilities.pipeline_utilities as putil
+        import mialab.utilities.scheduler as sched
+        import mialab.utilities.work_queue as wq
     except ImportError as ie:
         print("ImportError: impossible d'importer les modules 'mialab'.")
         print("Chemins essayés (sys.path):")
@@ -44,8 +60,24 @@ LOADING_KEYS = [structure.BrainImageTypes.T1w,
                 structure.BrainImageTypes.BrainMask,
                 structure.BrainImageTypes.RegistrationTransform]  # the list of data we will load
 
+PRE_PROCESS_PARAMS = {'skullstrip_pre': True,
+                      'normalization_pre': True,
+                      'registration_pre': True,
+                      'roi_pre': False,
+                      'roi_margin': 5,
+                      'coordinates_feature': True,
+                      'intensity_feature': True,
+                      'gradient_intensity_feature': True,
+                      'sampling_seed': 42,
+                      'brain_mask_inference': False}
 
-def main(result_dir: str, data_atlas_dir: str, data_train_dir: str, data_test_dir: str):
+POST_PROCESS_PARAMS = {'simple_post': True}
+
+
+def main(result_dir: str, data_atlas_dir: str, data_train_dir: str, data_test_dir: str,
+         feature_cache_dir: str = None, processes: int = None, threads: int = None, work_queue_dir: str = None,
+         resume: bool = False, model_file: str = None, classifier_config: dict = None, warm_start: bool = False,
+         classifier: str = 'random_forest', mining_params: dict = None):
     """Brain tissue segmentation using decision forests.
 
     The main routine executes the medical image analysis pipeline:
@@ -58,114 +90,310 @@ def main(result_dir: str, data_atlas_dir: str, data_train_dir: str, data_test_di
         - Segmentation using the decision forest classifier model on unseen images
         - Post-processing of the segmentation
         - Evaluation of the segmentation
+
+    The stages are executed by a :class:`TaskScheduler <mialab.utilities.scheduler.TaskScheduler>` as soon as their
+    inputs are ready, e.g. the testing images are pre-processed during the training.
+
+    The feature matrices are cached in ``feature_cache_dir`` such that unchanged images are not pre-processed again
+    (no caching if None).
+
+    The pre- and post-processing share a pool of ``processes`` worker processes with ``threads`` SimpleITK and BLAS
+    threads each (see :class:`WorkerPool <mialab.utilities.multi_processor.WorkerPool>` for the defaults).
+    If ``work_queue_dir`` is given, the pre- and post-processing are instead distributed as tasks to the workers
+    of the work queue (see ``work_queue_worker.py``), where ``processes`` is the total number of workers.
+
+    The outputs of the stages are checkpointed per subject in the result directory. If ``resume`` is set, the latest
+    run in ``result_dir`` is resumed, i.e. only the stages without valid checkpoints are executed.
+
+    The trained model is saved as ``model.joblib`` in the result directory. If ``model_file`` is given, the training
+    is skipped and the testing images are pre-processed with the pre-processing parameters of the model.
+    If ``warm_start`` is set, estimators are added to the model until it has ``n_estimators`` estimators instead.
+
+    The ``classifier`` is the name of the classifier backend (see :data:`CLASSIFIERS
+    <mialab.utilities.classifier.CLASSIFIERS>`), whose default parameters are overridden by the
+    ``classifier_config``. The classifier is fitted and predicted with ``n_jobs`` threads (all cores by default).
+
+    If ``mining_params`` is given (overriding the :data:`DEFAULT_PARAMS
+    <mialab.utilities.hard_example_mining.DEFAULT_PARAMS>`), the classifier is trained in two rounds: a small forest
+    is fitted on a small sample, and the classifier on the small sample and the hard examples mined among the brain
+    mask voxels of each subject (see :mod:`mialab.utilities.hard_example_mining`).
     """
 
     # load atlas images
     putil.load_atlas_images(data_atlas_dir)
 
-    print('-' * 5, 'Training...')
+    cache = fcache.FeatureMatrixCache(feature_cache_dir) if feature_cache_dir else None
+
+    # the worker processes load the atlas images once at their start
+    if work_queue_dir:
+        pool = wq.WorkQueuePool(wq.FileSystemBroker(work_queue_dir), processes or 1,
+                                initializer=putil.load_atlas_images, initargs=(os.path.abspath(data_atlas_dir),))
+    else:
+        pool = mproc.WorkerPool(processes, threads=threads, initializer=putil.load_atlas_images,
+                                initargs=(data_atlas_dir,))
+    shared_memory_transport = pool.supports_shared_memory
 
     # crawl the training image directories
     crawler = futil.FileSystemDataCrawler(data_train_dir,
                                           LOADING_KEYS,
                                           futil.BrainImageFilePathGenerator(),
                                           futil.DataDirectoryFilter())
-    pre_process_params = {'skullstrip_pre': True,
-                          'normalization_pre': True,
-                          'registration_pre': True,
-                          'coordinates_feature': True,
-                          'intensity_feature': True,
-                          'gradient_intensity_feature': True}
-
-    # load images for training and pre-process
-    images = putil.pre_process_batch(crawler.data, pre_process_params, multi_process=False)
-
-    # generate feature matrix and label vector
-    data_train = np.concatenate([img.feature_matrix[0] for img in images])
-    labels_train = np.concatenate([img.feature_matrix[1] for img in images]).squeeze()
-
-    # DONE  by Benoit : I modifies here the RF parameters
-    forest = sk_ensemble.RandomForestClassifier(max_features='sqrt', #images[0].feature_matrix[0].shape[1],
-                                                n_estimators=10,  # initially = 1
-                                                max_depth=10,      # initially = 5
-                                                random_state=42)   # initially = None
-
-    start_time = timeit.default_timer()
-    forest.fit(data_train, labels_train)
-    print(' Time elapsed:', timeit.default_timer() - start_time, 's')
-
-    # create a result directory with timestamp
-    t = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-    result_dir = os.path.join(result_dir, t)
+    pre_process_params = dict(PRE_PROCESS_PARAMS)
+    post_process_params = dict(POST_PROCESS_PARAMS)
+
+    # the parameters of the classifier backend overriding its defaults (e.g., 10 trees of depth 10 for the forests)
+    classifier_config = dict(classifier_config or {})
+    n_jobs = classifier_config.pop('n_jobs', -1)  # fit and predict on all cores
+
+    # a trained model is tested with the pre-processing parameters of its training
+    model = None
+    if model_file:
+        # a warm-started model is modified, i.e. its arrays cannot be memory-mapped read-only
+        model, feature_names, pre_process_params = clf.Classifier.load(model_file, None if warm_start else 'r')
+        if feature_names != putil.FeatureExtractor.get_feature_names(**pre_process_params):
+            raise ValueError('The feature layout of the model {} is not supported'.format(model_file))
+        print('-' * 5, 'Loaded model', model_file, '({})'.format(model.NAME))
+        classifier = model.NAME
+        model.set_n_jobs(n_jobs)
+
+    if classifier not in clf.CLASSIFIERS:
+        raise ValueError('Unknown classifier {}, expected one of {}'.format(classifier, sorted(clf.CLASSIFIERS)))
+    classifier_params = clf.CLASSIFIERS[classifier].get_params(classifier_config)
+    if model is not None and warm_start:
+        # add estimators to the model instead of refitting it
+        model.warm_start(classifier_params[model.SIZE_PARAM])
+    if mining_params is not None:
+        mining_params = dict(mining.DEFAULT_PARAMS, **mining_params)
+        if mining_params['criterion'] not in mining.CRITERIA:
+            raise ValueError('Unknown criterion {}, expected one of {}'.format(mining_params['criterion'],
+                                                                               mining.CRITERIA))
+
+    # create a result directory with timestamp or resume the latest run
+    run_dir = ckpt.Checkpoints.find_latest(result_dir) if resume else None
+    if run_dir is None:
+        t = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+        run_dir = os.path.join(result_dir, t)
+    else:
+        print('-' * 5, 'Resuming', run_dir)
+    result_dir = run_dir
     os.makedirs(result_dir, exist_ok=True)
 
-    print('-' * 5, 'Testing...')
+    # the outputs of the stages are checkpointed per subject such that a resumed run skips the completed stages
+    checkpoints = ckpt.Checkpoints(result_dir, {'data_atlas_dir': data_atlas_dir,
+                                                'data_train_dir': data_train_dir,
+                                                'data_test_dir': data_test_dir,
+                                                'pre_process_params': pre_process_params,
+                                                'post_process_params': post_process_params,
+                                                'classifier': classifier,
+                                                'classifier_params': classifier_params,
+                                                'model_file': model_file,
+                                                'warm_start': warm_start,
+                                                'mining_params': mining_params})
+
+    # the stages are executed as soon as their inputs are ready, i.e. the testing images are pre-processed during
+    # the training and each testing image is predicted, post-processed, evaluated and written independently
+    scheduler = sched.TaskScheduler(max_workers=pool.processes + 4)
+
+    def add_stage(stage: str, id_: str, fn: callable, *args, dependencies: callable = lambda: (),
+                  save: callable = checkpoints.save_object, load: callable = checkpoints.load_object) -> str:
+        # adds the task of a stage, which either loads the complete checkpoint or adds the tasks of its dependencies
+        # and executes ``fn`` with their results
+        name = '{}/{}'.format(stage, id_)
+        if name in scheduler.tasks:
+            return name
+        if checkpoints.is_complete(stage, id_):
+            return scheduler.add_task(name, load, stage, id_)
+
+        def run(*inputs):
+            result = fn(*inputs)
+            save(stage, id_, result)
+            return result
+
+        return scheduler.add_task(name, run, *args, dependencies=dependencies())
+
+    def pre_process(id_: str, paths: dict, params: dict, image_types: list):
+        return putil.pre_process_batch({id_: paths}, params, multi_process=True, cache=cache,
+                                       shared_memory_transport=shared_memory_transport, pool=pool,
+                                       image_types=image_types)[0]
+
+    # the training features are appended to an out-of-core store, from which the classifier is trained
+    store = fstore.TrainingFeatureStore(checkpoints.get_dir('training_store'))
+
+    # with the hard example mining, the features of the brain mask voxels and of the first round sample are extracted
+    # from the training images, and the brain mask voxels except the sample are the candidates of the mining
+    train_pre_process_params, train_image_types = pre_process_params, []
+    if mining_params is not None:
+        train_pre_process_params = mining.get_pre_process_params(pre_process_params, mining_params['sample_counts'])
+        train_image_types = [structure.BrainImageTypes.GroundTruth]
+        candidate_store = fstore.TrainingFeatureStore(checkpoints.get_dir('candidate_store'))
+
+    def store_features(img: structure.BrainImage, *_):
+        if mining_params is None:
+            store.append(img.id_, *img.feature_matrix)
+            return
+
+        sample, candidates = mining.split_candidates(img, pre_process_params.get('sampling_seed'),
+                                                     mining_params['candidate_fraction'],
+                                                     mining_params['sample_counts'])
+        features, labels = img.feature_matrix
+        # the training store is appended last, i.e. a subject is complete if it is in the training store
+        if img.id_ not in candidate_store:
+            candidate_store.append(img.id_, features[candidates], labels[candidates])
+        store.append(img.id_, features[sample], labels[sample])
+
+    def mine_hard_examples():
+        # the first round forest is fitted on the small sample and scores the candidates
+        forest = clf.RandomForest({'n_estimators': mining_params['n_estimators'],
+                                   'max_depth': mining_params['max_depth']}, n_jobs)
+        forest.fit(store.features, store.labels)
+        start_time = timeit.default_timer()
+        features, labels = mining.mine_hard_examples(forest, store, candidate_store, mining_params['budget'],
+                                                     mining_params['criterion'])
+        print(' Mined {} hard examples among {} candidates by {} in addition to {} samples (fit {:.2f} s, '
+              'mining {:.2f} s)'.format(features.shape[0] - store.features.shape[0], candidate_store.features.shape[0],
+                                        mining_params['criterion'], store.features.shape[0], forest.fit_time,
+                                        timeit.default_timer() - start_time))
+        return features, labels
+
+    def train(*_):
+        print('-' * 5, 'Training...')
+
+        features, labels = store.features, store.labels
+        if mining_params is not None:
+            features, labels = mine_hard_examples()
+
+        # warm start of the loaded model or a new model
+        classifier_ = model if model is not None else clf.CLASSIFIERS[classifier](classifier_params, n_jobs)
+        classifier_.fit(features, labels)
+        print(' Time elapsed:', classifier_.fit_time, 's')
+        print(' Fit throughput: {:.0f} samples/s/core ({} samples, {}, {} cores)'.format(
+            features.shape[0] / classifier_.fit_time / classifier_.fit_threads, features.shape[0],
+            classifier_.NAME, classifier_.fit_threads))
+        return classifier_
+
+    def predict(classifier_: clf.Classifier, img: structure.BrainImage):
+        print('-' * 10, 'Testing', img.id_)
 
-    # initialize evaluator
-    evaluator = putil.init_evaluator()
+        # the labels and probabilities are predicted together
+        start_time = timeit.default_timer()
+        predictions, probabilities = classifier_.predict(img.feature_matrix[0])
+        elapsed = timeit.default_timer() - start_time
+        print(' Time elapsed:', elapsed, 's ({:.0f} voxels/s)'.format(img.feature_matrix[0].shape[0] / elapsed))
 
-    # crawl the training image directories
+        # convert prediction and probabilities back to SimpleITK images
+        # voxels without features (outside the brain mask) are background
+        image_prediction = putil.voxels_as_image(predictions.astype(np.uint8), img)
+        image_probabilities = putil.voxels_as_image(probabilities, img,
+                                                    (classifier_.classes == 0).astype(probabilities.dtype))
+        return image_prediction, image_probabilities
+
+    def post_process(prediction: tuple, img: structure.BrainImage):
+        image_prediction, image_probabilities = prediction
+        return putil.post_process_batch([img], [image_prediction], [image_probabilities], post_process_params,
+                                        multi_process=True, shared_memory_transport=shared_memory_transport,
+                                        pool=pool)[0]
+
+    def evaluate(prediction: tuple, image_post_processed: sitk.Image, img: structure.BrainImage):
+        # evaluate segmentation without and with post-processing
+        # (an evaluator per subject, since the evaluator is not thread-safe)
+        evaluator = putil.init_evaluator()
+        evaluator.evaluate(prediction[0], img.images[structure.BrainImageTypes.GroundTruth], img.id_)
+        evaluator.evaluate(image_post_processed, img.images[structure.BrainImageTypes.GroundTruth], img.id_ + '-PP')
+        return evaluator.results
+
+    def write(prediction: tuple, image_post_processed: sitk.Image, img: structure.BrainImage):
+        # save results (in the full image geometry if the images have been cropped to the brain)
+        paths = [os.path.join(result_dir, img.id_ + '_SEG.mha'), os.path.join(result_dir, img.id_ + '_SEG-PP.mha')]
+        sitk.WriteImage(putil.paste_roi(prediction[0], img), paths[0], True)
+        sitk.WriteImage(putil.paste_roi(image_post_processed, img), paths[1], True)
+        return paths
+
+    train_data = crawler.data
+
+    def add_train_dependencies():
+        # load images for training and pre-process
+        # only the feature matrix is required for training, which is stored in the order of the subjects
+        # (independent of the completion order) such that the training is reproducible
+        store_tasks = []
+        for id_, paths in train_data.items():
+            if id_ in store:
+                continue
+            image_task = scheduler.add_task('pre_process_train/' + id_, pre_process, id_, paths,
+                                            train_pre_process_params, train_image_types)
+            store_tasks = [scheduler.add_task('store/' + id_, store_features, dependencies=[image_task] + store_tasks)]
+        return store_tasks
+
+    model_path = os.path.join(result_dir, 'model.joblib')
+
+    def save_model(stage: str, id_: str, classifier_: clf.Classifier):
+        classifier_.save(model_path, putil.FeatureExtractor.get_feature_names(**pre_process_params),
+                         pre_process_params)
+        checkpoints.complete(stage, id_, [model_path])
+
+    def add_train():
+        if model is not None and not warm_start:
+            # no training if a model has been loaded
+            return 'model' if 'model' in scheduler.tasks else scheduler.add_task('model', lambda: model)
+        return add_stage('train', '', train, dependencies=add_train_dependencies, save=save_model,
+                         load=lambda stage, id_: clf.Classifier.load(model_path)[0])
+
+    # crawl the testing image directories
     crawler = futil.FileSystemDataCrawler(data_test_dir,
                                           LOADING_KEYS,
                                           futil.BrainImageFilePathGenerator(),
                                           futil.DataDirectoryFilter())
 
     # load images for testing and pre-process
-    pre_process_params['training'] = False
-    images_test = putil.pre_process_batch(crawler.data, pre_process_params, multi_process=False)
+    test_pre_process_params = dict(pre_process_params, training=False)
 
-    images_prediction = []
-    images_probabilities = []
+    # the ground truth is required for the evaluation and the T1w and T2w images for the CRF post-processing
+    image_types = [structure.BrainImageTypes.GroundTruth]
+    if post_process_params.get('crf_post', False):
+        image_types += [structure.BrainImageTypes.T1w, structure.BrainImageTypes.T2w]
 
-    for img in images_test:
-        print('-' * 10, 'Testing', img.id_)
+    def save_test_image(stage: str, id_: str, img: structure.BrainImage):
+        # the feature matrix is only required by the prediction, which is checkpointed itself
+        checkpoints.save_brain_image(stage, id_, img, feature_matrix=False)
 
-        start_time = timeit.default_timer()
-        predictions = forest.predict(img.feature_matrix[0])
-        probabilities = forest.predict_proba(img.feature_matrix[0])
-        print(' Time elapsed:', timeit.default_timer() - start_time, 's')
+    def add_test(id_: str, paths: dict):
+        def image():
+            return add_stage('pre_process_test', id_, pre_process, id_, paths, test_pre_process_params, image_types,
+                             save=save_test_image, load=checkpoints.load_brain_image)
 
-        # convert prediction and probabilities back to SimpleITK images
-        image_prediction = conversion.NumpySimpleITKImageBridge.convert(predictions.astype(np.uint8),
-                                                                        img.image_properties)
-        image_probabilities = conversion.NumpySimpleITKImageBridge.convert(probabilities, img.image_properties)
+        def features():
+            # the checkpoint of the pre-processing contains no feature matrix, i.e. a resumed prediction extracts
+            # the features again (or loads them from the feature matrix cache)
+            if checkpoints.is_complete('pre_process_test', id_):
+                return scheduler.add_task('pre_process_features/' + id_, pre_process, id_, paths,
+                                          test_pre_process_params, [])
+            return image()
 
-        # evaluate segmentation without post-processing
-        evaluator.evaluate(image_prediction, img.images[structure.BrainImageTypes.GroundTruth], img.id_)
+        def prediction():
+            return add_stage('predict', id_, predict, dependencies=lambda: [add_train(), features()],
+                             save=checkpoints.save_images, load=checkpoints.load_images)
 
-        images_prediction.append(image_prediction)
-        images_probabilities.append(image_probabilities)
+        def post_processed():
+            return add_stage('post_process', id_, post_process, dependencies=lambda: [prediction(), image()],
+                             save=lambda stage, id__, img: checkpoints.save_images(stage, id__, [img]),
+                             load=lambda stage, id__: checkpoints.load_images(stage, id__)[0])
 
-    # post-process segmentation and evaluate with post-processing
-    post_process_params = {'simple_post': True}
-    images_post_processed = putil.post_process_batch(images_test, images_prediction, images_probabilities,
-                                                     post_process_params, multi_process=True)
+        add_stage('evaluate', id_, evaluate, dependencies=lambda: [prediction(), post_processed(), image()])
+        add_stage('write', id_, write, dependencies=lambda: [prediction(), post_processed(), image()],
+                  save=checkpoints.complete, load=lambda stage, id__: None)
 
-    for i, img in enumerate(images_test):
-        evaluator.evaluate(images_post_processed[i], img.images[structure.BrainImageTypes.GroundTruth],
-                           img.id_ + '-PP')
+    for id_, paths in crawler.data.items():
+        add_test(id_, paths)
 
-        # save results
-        sitk.WriteImage(images_prediction[i], os.path.join(result_dir, images_test[i].id_ + '_SEG.mha'), True)
-        sitk.WriteImage(images_post_processed[i], os.path.join(result_dir, images_test[i].id_ + '_SEG-PP.mha'), True)
+    task_results = scheduler.run()
+    pool.close()
 
-    # use two writers to report the results
-    os.makedirs(result_dir, exist_ok=True)  # generate result directory, if it does not exists
-    result_file = os.path.join(result_dir, 'results.csv')
-    writer.CSVWriter(result_file).write(evaluator.results)
+    # the subjects complete in arbitrary order
+    results = [result for name, subject_results in task_results.items() if name.startswith('evaluate/')
+               for result in subject_results]
+    results.sort(key=lambda result: result.id_)
 
-    print('\nSubject-wise results...')
-    writer.ConsoleWriter().write(evaluator.results)
-
-    # report also mean and standard deviation among all subjects
-    result_summary_file = os.path.join(result_dir, 'results_summary.csv')
-    functions = {'MEAN': np.mean, 'STD': np.std}
-    writer.CSVStatisticsWriter(result_summary_file, functions=functions).write(evaluator.results)
-    print('\nAggregated statistic results...')
-    writer.ConsoleStatisticsWriter(functions=functions).write(evaluator.results)
-
-    # clear results such that the evaluator is ready for the next evaluation
-    evaluator.clear()
+    # report the results and their mean and standard deviation among all subjects
+    exp.write_results(results, result_dir, console=True)
 
 
 if __name__ == "__main__":
@@ -203,6 +431,141 @@ if __name__ == "__main__":
         help='Directory with testing data.'
     )
 
+    parser.add_argument(
+        '--feature_cache_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, './mia-cache')),
+        help='Directory to cache the pre-processed feature matrices.'
+    )
+
+    parser.add_argument(
+        '--no_feature_cache',
+        action='store_true',
+        help='If set, pre-process all images without using the feature matrix cache.'
+    )
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of worker processes for the pre- and post-processing (default: number of CPUs).'
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='Number of SimpleITK and BLAS threads per worker process (default: number of CPUs / processes).'
+    )
+
+    parser.add_argument(
+        '--work_queue_dir',
+        type=str,
+        default=None,
+        help='If set, distribute the pre- and post-processing to the workers of this work queue directory '
+             '(see work_queue_worker.py).'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='If set, resume the latest run in the result directory and skip the completed stages.'
+    )
+
+    parser.add_argument(
+        '--model',
+        type=str,
+        default=None,
+        help='If set, skip the training and test this model (model.joblib of a previous run).'
+    )
+
+    parser.add_argument(
+        '--warm_start',
+        action='store_true',
+        help='If set with --model, add estimators to the model until it has --n_estimators estimators.'
+    )
+
+    parser.add_argument(
+        '--classifier',
+        type=str,
+        default='random_forest',
+        choices=sorted(clf.CLASSIFIERS),
+        help='Classifier backend (ignored with --model).'
+    )
+
+    parser.add_argument(
+        '--classifier_config', '--forest_config',
+        type=str,
+        default=None,
+        help='JSON file with parameters of the classifier (overridden by the other classifier arguments).'
+    )
+
+    parser.add_argument(
+        '--n_estimators',
+        type=int,
+        default=None,
+        help='Number of trees of the forests or iterations of the boosting (default: 10 trees, 100 iterations).'
+    )
+
+    parser.add_argument(
+        '--max_depth',
+        type=int,
+        default=None,
+        help='Maximum depth of the trees (default: 10).'
+    )
+
+    parser.add_argument(
+        '--n_jobs',
+        type=int,
+        default=None,
+        help='Number of threads to fit and predict the classifier (default: -1, i.e. all cores).'
+    )
+
+    parser.add_argument(
+        '--hard_example_mining',
+        action='store_true',
+        help='If set, train in two rounds on a small sample and the hard examples mined by a small forest.'
+    )
+
+    parser.add_argument(
+        '--mining_sample_counts',
+        type=int,
+        nargs=6,
+        default=None,
+        help='Number of voxels per label of the first round sample (default: {}).'.format(
+            ' '.join(map(str, mining.DEFAULT_PARAMS['sample_counts'])))
+    )
+
+    parser.add_argument(
+        '--mining_budget',
+        type=int,
+        default=None,
+        help='Maximum number of hard examples per subject (default: {budget}).'.format(**mining.DEFAULT_PARAMS)
+    )
+
+    parser.add_argument(
+        '--mining_criterion',
+        type=str,
+        default=None,
+        choices=mining.CRITERIA,
+        help='Criterion to mine the hard examples (default: {criterion}).'.format(**mining.DEFAULT_PARAMS)
+    )
+
+    parser.add_argument(
+        '--mining_candidate_fraction',
+        type=float,
+        default=None,
+        help='Fraction of the voxels of each subject scored as candidates (default: {candidate_fraction}).'.format(
+            **mining.DEFAULT_PARAMS)
+    )
+
+    parser.add_argument(
+        '--mining_n_estimators',
+        type=int,
+        default=None,
+        help='Number of trees of the first round forest (default: {n_estimators}).'.format(**mining.DEFAULT_PARAMS)
+    )
+
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -214,8 +577,25 @@ if __name__ == "__main__":
     # configure logging minimal
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 
+    classifier_config = {}
+    if args.classifier_config:
+        with open(args.classifier_config) as f:
+            classifier_config = json.load(f)
+    for key in ('n_estimators', 'max_depth', 'n_jobs'):
+        if getattr(args, key) is not None:
+            classifier_config[key] = getattr(args, key)
+
+    mining_params = None
+    if args.hard_example_mining:
+        mining_params = {key: getattr(args, 'mining_' + key) for key in ('sample_counts', 'budget', 'criterion',
+                                                                         'candidate_fraction', 'n_estimators')
+                         if getattr(args, 'mining_' + key) is not None}
+
     try:
-        main(args.result_dir, args.data_atlas_dir, args.data_train_dir, args.data_test_dir)
+        main(args.result_dir, args.data_atlas_dir, args.data_train_dir, args.data_test_dir,
+             None if args.no_feature_cache else args.feature_cache_dir, args.processes, args.threads,
+             args.work_queue_dir, args.resume, args.model, classifier_config, args.warm_start, args.classifier,
+             mining_params)
     except Exception as e:
         # message concis en français
         print("\nUne erreur est survenue :", str(e))
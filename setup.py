@@ -14,7 +14,9 @@ with open("LICENSE") as f:
 REQUIRED_PACKAGES = [
     "pymia == 0.3.1",
     "scikit-learn >= 0.23.2",
+    "scipy >= 1.5.2",
     "pathos >= 0.2.6",
+    "dill >= 0.3.2",
 ]
 
 TEST_PACKAGES = []
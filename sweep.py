@@ -0,0 +1,216 @@
+"""A hyperparameter sweep of the classifier over the features of the pipeline.
+
+The training and testing images are pre-processed once, and the classifier configurations of a grid are then fitted
+and evaluated in parallel worker processes sharing one memory-mapped copy of the features. The grid is a JSON file
+with a list of values per parameter (or a list of such grids, see :class:`sklearn.model_selection.ParameterGrid`),
+where the parameter ``classifier`` selects the classifier backend, e.g.::
+
+    {"classifier": ["random_forest", "extra_trees"], "n_estimators": [10, 50], "max_depth": [10, 20]}
+
+Each configuration writes its ``results.csv`` and ``results_summary.csv`` to its directory in the sweep directory,
+and ``sweep.csv`` compares the configurations.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+import sklearn.model_selection as sk_model_selection
+
+import pipeline
+
+try:
+    import mialab.data.structure as structure
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.experiment as exp
+    import mialab.utilities.feature_cache as fcache
+    import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.multi_processor as mproc
+    import mialab.utilities.pipeline_utilities as putil
+except ImportError:
+    # Append the MIALab root directory to Python path
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+    import mialab.data.structure as structure
+    import mialab.utilities.classifier as clf
+    import mialab.utilities.experiment as exp
+    import mialab.utilities.feature_cache as fcache
+    import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.multi_processor as mproc
+    import mialab.utilities.pipeline_utilities as putil
+
+
+def load_grid(grid_file: str) -> list:
+    """Loads the classifier configurations of a grid file.
+
+    Args:
+        grid_file (str): The JSON file with a grid or a list of grids. Single values are used as is.
+
+    Returns:
+        list: The configurations (dicts of parameters including the ``classifier``).
+
+    Raises:
+        ValueError: If a configuration has an unknown classifier.
+    """
+    with open(grid_file) as f:
+        grids = json.load(f)
+    if isinstance(grids, dict):
+        grids = [grids]
+    grids = [{key: value if isinstance(value, list) else [value] for key, value in grid.items()} for grid in grids]
+
+    configs = list(sk_model_selection.ParameterGrid(grids))
+    for config in configs:
+        config.setdefault('classifier', 'random_forest')
+        if config['classifier'] not in clf.CLASSIFIERS:
+            raise ValueError('Unknown classifier {}, expected one of {}'.format(config['classifier'],
+                                                                                sorted(clf.CLASSIFIERS)))
+    return configs
+
+
+def main(result_dir: str, data_atlas_dir: str, data_train_dir: str, data_test_dir: str, grid_file: str,
+         feature_cache_dir: str = None, processes: int = None, threads: int = None):
+    """Hyperparameter sweep of the classifier.
+
+    The training and testing images are pre-processed once with the parameters of the pipeline into
+    :class:`SubjectStore <mialab.utilities.experiment.SubjectStore>` in the sweep directory. The configurations are
+    then evaluated by ``processes`` worker processes, each fitting and predicting with ``threads`` threads.
+    """
+    configs = load_grid(grid_file)
+
+    # load atlas images
+    putil.load_atlas_images(data_atlas_dir)
+
+    cache = fcache.FeatureMatrixCache(feature_cache_dir) if feature_cache_dir else None
+    pool = mproc.WorkerPool(processes, threads=threads, initializer=putil.load_atlas_images,
+                            initargs=(data_atlas_dir,))
+
+    sweep_dir = os.path.join(result_dir, datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'))
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    # pre-process the images once for all configurations
+    train = exp.SubjectStore(os.path.join(sweep_dir, 'features', 'train'))
+    test = exp.SubjectStore(os.path.join(sweep_dir, 'features', 'test'))
+    image_types = [structure.BrainImageTypes.GroundTruth]
+    if pipeline.POST_PROCESS_PARAMS.get('crf_post', False):
+        image_types += [structure.BrainImageTypes.T1w, structure.BrainImageTypes.T2w]
+
+    for data_dir, subjects, params, types in ((data_train_dir, train, pipeline.PRE_PROCESS_PARAMS, []),
+                                              (data_test_dir, test, dict(pipeline.PRE_PROCESS_PARAMS, training=False),
+                                               image_types)):
+        crawler = futil.FileSystemDataCrawler(data_dir, pipeline.LOADING_KEYS, futil.BrainImageFilePathGenerator(),
+                                              futil.DataDirectoryFilter())
+        exp.pre_process_subjects(crawler.data, subjects, params, pool, cache, types)
+    print('-' * 5, 'Pre-processed {} training ({} samples) and {} testing subjects'.format(
+        len(train), train.features.size, len(test)))
+
+    # evaluate the configurations in parallel
+    params_list = []
+    for idx, config in enumerate(configs):
+        config_dir = os.path.join(sweep_dir, 'config-{:03d}'.format(idx))
+        os.makedirs(config_dir, exist_ok=True)
+        with open(os.path.join(config_dir, 'config.json'), 'w') as f:
+            json.dump(config, f, indent=2)
+
+        classifier_params = {key: value for key, value in config.items() if key != 'classifier'}
+        params_list.append((config_dir, config['classifier'], classifier_params, pool.threads, train.store_dir,
+                            test.store_dir, pipeline.POST_PROCESS_PARAMS))
+
+    rows = [None] * len(configs)
+    for idx, evaluation in mproc.MultiProcessor.run_iter(exp.fit_and_evaluate, params_list, ordered=False, pool=pool):
+        dice = [result.value for result in evaluation['results']
+                if result.metric == 'DICE' and not result.id_.endswith('-PP')]
+        rows[idx] = {'config': os.path.basename(params_list[idx][0]),
+                     'classifier': configs[idx]['classifier'],
+                     'params': json.dumps(params_list[idx][2], sort_keys=True),
+                     'MEAN_DICE': np.mean(dice),
+                     'FIT_TIME': evaluation['fit_time'],
+                     'FIT_SAMPLES_PER_S_PER_CORE': evaluation['no_samples'] / evaluation['fit_time'] /
+                     evaluation['fit_threads'],
+                     'PREDICT_VOXELS_PER_S': evaluation['no_voxels'] / evaluation['predict_time']}
+        print('-' * 5, 'Evaluated {config} ({classifier} {params}): mean Dice {MEAN_DICE:.3f}, '
+                       'fit {FIT_TIME:.1f} s'.format(**rows[idx]))
+    pool.close()
+
+    # compare the configurations, the best first
+    rows.sort(key=lambda row: row['MEAN_DICE'], reverse=True)
+    with open(os.path.join(sweep_dir, 'sweep.csv'), 'w', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=list(rows[0]), delimiter=';')
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    print('-' * 5, 'Best configuration {config} ({classifier} {params}): mean Dice {MEAN_DICE:.3f}'.format(**rows[0]))
+
+
+if __name__ == "__main__":
+    """The program's entry point."""
+
+    script_dir = os.path.dirname(sys.argv[0])
+
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of the classifier for brain tissue segmentation')
+
+    parser.add_argument(
+        '--grid',
+        type=str,
+        required=True,
+        help='JSON file with the grid of classifier configurations.'
+    )
+
+    parser.add_argument(
+        '--result_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, './mia-sweep')),
+        help='Directory for results.'
+    )
+
+    parser.add_argument(
+        '--data_atlas_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, '../data/atlas')),
+        help='Directory with atlas data.'
+    )
+
+    parser.add_argument(
+        '--data_train_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, '../data/train/')),
+        help='Directory with training data.'
+    )
+
+    parser.add_argument(
+        '--data_test_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, '../data/test/')),
+        help='Directory with testing data.'
+    )
+
+    parser.add_argument(
+        '--feature_cache_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, './mia-cache')),
+        help='Directory to cache the pre-processed feature matrices.'
+    )
+
+    parser.add_argument(
+        '--no_feature_cache',
+        action='store_true',
+        help='If set, pre-process all images without using the feature matrix cache.'
+    )
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of worker processes, i.e. configurations evaluated at the same time (default: number of CPUs).'
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='Number of threads per worker process (default: number of CPUs / processes).'
+    )
+
+    args = parser.parse_args()
+    main(args.result_dir, args.data_atlas_dir, args.data_train_dir, args.data_test_dir, args.grid,
+         None if args.no_feature_cache else args.feature_cache_dir, args.processes, args.threads)
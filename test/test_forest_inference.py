@@ -0,0 +1,40 @@
+"""Tests the forest inference engine against scikit-learn."""
+import numpy as np
+import pytest
+import sklearn.ensemble as sk_ensemble
+
+import mialab.utilities.forest_inference as finf
+
+
+def make_data(no_samples: int, seed: int):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(no_samples, 7)).astype(np.float32)
+    labels = (data @ rng.normal(size=(7, 6)) + rng.normal(size=(no_samples, 6))).argmax(axis=1)
+    return data, labels
+
+
+@pytest.mark.parametrize('traversal', finf.FlatForest.TRAVERSALS)
+@pytest.mark.parametrize('forest_class', [sk_ensemble.RandomForestClassifier, sk_ensemble.ExtraTreesClassifier])
+def test_predict(traversal, forest_class):
+    data, labels = make_data(2000, 0)
+    # leaves of different sizes, such that unnormalized leaf values would weight the trees differently
+    forest = forest_class(n_estimators=10, max_depth=6, min_samples_leaf=5, random_state=42).fit(data, labels)
+    test_data = make_data(5000, 1)[0]
+
+    predictions, probabilities = finf.FlatForest(forest, traversal).predict(test_data, number_of_threads=2,
+                                                                            slab_size=1000)
+
+    np.testing.assert_array_equal(predictions, forest.predict(test_data))
+    np.testing.assert_allclose(probabilities, forest.predict_proba(test_data), atol=1e-6)
+
+
+def test_predict_sample_weight():
+    # weighted samples, i.e. the leaf values do not sum to the number of samples
+    data, labels = make_data(2000, 2)
+    forest = sk_ensemble.RandomForestClassifier(n_estimators=5, max_depth=8, random_state=0)
+    forest.fit(data, labels, sample_weight=np.random.default_rng(3).uniform(0.1, 10, data.shape[0]))
+
+    predictions, probabilities = finf.FlatForest(forest).predict(data)
+
+    np.testing.assert_array_equal(predictions, forest.predict(data))
+    np.testing.assert_allclose(probabilities, forest.predict_proba(data), atol=1e-6)
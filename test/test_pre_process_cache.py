@@ -0,0 +1,38 @@
+"""Tests the pre-processing with a warm feature matrix cache."""
+import numpy as np
+import pymia.data.conversion as conversion
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.feature_cache as fcache
+import mialab.utilities.pipeline_utilities as putil
+
+# the images required for the evaluation and the CRF post-processing
+IMAGE_TYPES = [structure.BrainImageTypes.GroundTruth, structure.BrainImageTypes.T1w, structure.BrainImageTypes.T2w]
+
+
+def fake_pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
+    images = {image_type: sitk.Image(4, 5, 6, sitk.sitkUInt8) for image_type in IMAGE_TYPES}
+    properties = conversion.ImageProperties(images[structure.BrainImageTypes.GroundTruth])
+    img = structure.BrainImage(id_, paths[id_], images, sitk.AffineTransform(3), properties)
+    img.feature_matrix = (np.zeros((120, 7), np.float32), np.zeros((120, 1), np.int16))
+    return img
+
+
+def test_warm_cache_crf_post(tmp_path, monkeypatch):
+    monkeypatch.setattr(putil, 'pre_process', fake_pre_process)
+    cache = fcache.FeatureMatrixCache(str(tmp_path))
+    data_batch = {'subject': {'subject': str(tmp_path)}}
+    params = {'training': False}
+
+    # the first run fills the cache and the second run is warm
+    for _ in range(2):
+        img = putil.pre_process_batch(data_batch, params, multi_process=False, cache=cache,
+                                      image_types=IMAGE_TYPES)[0]
+        assert sorted(img.images, key=str) == sorted(IMAGE_TYPES, key=str)
+
+    # the cached ground truth is sufficient for the evaluation only
+    img = putil.pre_process_batch(data_batch, params, multi_process=False, cache=cache,
+                                  image_types=[structure.BrainImageTypes.GroundTruth])[0]
+    assert list(img.images) == [structure.BrainImageTypes.GroundTruth]
+    assert isinstance(img.feature_matrix[0], np.memmap)
@@ -0,0 +1,69 @@
+"""A worker executing the pre- and post-processing tasks of a pipeline run distributed by a work queue.
+
+Start one or more workers on each host with access to the queue directory, e.g.::
+
+    python work_queue_worker.py --work_queue_dir /shared/mia-queue --processes 8
+
+and run the pipeline with ``--work_queue_dir /shared/mia-queue``.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+
+try:
+    import mialab.utilities.work_queue as wq
+except ImportError:
+    # Append the MIALab root directory to Python path
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+    import mialab.utilities.work_queue as wq
+
+
+def main(work_queue_dir: str, threads: int, idle_timeout: float):
+    """Executes the tasks of the work queue until the queue is idle for ``idle_timeout`` seconds."""
+    broker = wq.FileSystemBroker(work_queue_dir)
+    wq.run_worker(broker, threads, idle_timeout=idle_timeout)
+
+
+if __name__ == "__main__":
+    """The program's entry point."""
+
+    parser = argparse.ArgumentParser(description='Worker executing the tasks of a pipeline work queue')
+
+    parser.add_argument(
+        '--work_queue_dir',
+        type=str,
+        required=True,
+        help='Directory of the work queue (shared by all hosts).'
+    )
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='Number of worker processes on this host.'
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='Number of SimpleITK and BLAS threads per worker process (default: number of CPUs / processes).'
+    )
+
+    parser.add_argument(
+        '--idle_timeout',
+        type=float,
+        default=None,
+        help='Stop after this number of seconds without tasks (default: run until interrupted).'
+    )
+
+    args = parser.parse_args()
+    threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // args.processes)
+
+    workers = [multiprocessing.Process(target=main, args=(args.work_queue_dir, threads, args.idle_timeout))
+               for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()